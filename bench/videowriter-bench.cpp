@@ -0,0 +1,136 @@
+/*
+ * Copyright (C) 2019-2024 Matthias Klumpp <matthias@tenstral.net>
+ *
+ * Licensed under the GNU Lesser General Public License Version 3
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU Lesser General Public License as published by
+ * the Free Software Foundation, either version 3 of the license, or
+ * (at your option) any later version.
+ *
+ * This software is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public License
+ * along with this software.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/**
+ * Measures how many frames per second the VideoWriter can take with each
+ * codec at the resolutions of the Miniscopes, from the first pushFrame()
+ * until all frames are encoded and on disk.
+ *
+ * Each result is printed as one JSON object per line, for timelapse/mscopebench.py.
+ *
+ * Usage: videowriter-bench [FRAMES] [ENCODER_THREADS]
+ *
+ * ENCODER_THREADS defaults to 1, which keeps the codec defaults; 0 uses one thread per CPU core.
+ */
+
+#include <iostream>
+#include <thread>
+#include <vector>
+#include <QDir>
+#include <QTemporaryDir>
+#include <opencv2/core.hpp>
+
+#include "videowriter.h"
+
+struct BenchSize {
+    const char *name;
+    int width;
+    int height;
+};
+
+static std::vector<cv::Mat> makeFrames(int width, int height, int count)
+{
+    // a static pattern with noise, so the encoders can neither skip frames nor compress them to nothing
+    std::vector<cv::Mat> frames;
+    cv::Mat pattern(height, width, CV_8UC1);
+    cv::randu(pattern, 40, 120);
+    cv::RNG rng(0);
+    for (int i = 0; i < count; i++) {
+        cv::Mat noise(height, width, CV_8UC1);
+        rng.fill(noise, cv::RNG::UNIFORM, 0, 8);
+        frames.push_back(pattern + noise);
+    }
+    return frames;
+}
+
+struct BenchCodec {
+    const char *name;
+    VideoCodec codec;
+};
+
+static bool benchEncode(const QString &dir, const BenchCodec &codec, const BenchSize &size, int frameCount, int threads)
+{
+    const auto frames = makeFrames(size.width, size.height, 32);
+    const auto codecName = QString::fromUtf8(codec.name);
+
+    VideoWriter vw;
+    vw.setCodec(codec.codec);
+    vw.setContainer(codec.codec == VideoCodec::Raw ? VideoContainer::AVI : VideoContainer::Matroska);
+    vw.setLossless(true);
+    vw.setEncoderThreads(threads);
+    try {
+        vw.initialize(QDir(dir).filePath(QStringLiteral("bench-%1-%2").arg(codecName).arg(size.name)),
+                      size.width, size.height, 30, false, false);
+    } catch (const std::exception &e) {
+        std::cerr << "Skipping " << codecName.toStdString() << ": " << e.what() << std::endl;
+        return false;
+    }
+
+    size_t queueFull = 0;
+    const auto start = std::chrono::steady_clock::now();
+    for (int i = 0; i < frameCount; i++) {
+        const auto timestamp = std::chrono::milliseconds(i * 33);
+        while (!vw.pushFrame(frames[static_cast<size_t>(i) % frames.size()], timestamp)) {
+            // the encoder can not keep up, this is what we want to measure
+            queueFull++;
+            std::this_thread::sleep_for(std::chrono::milliseconds(1));
+        }
+    }
+    vw.finalize();
+    const double seconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+    const auto stats = vw.stats();
+
+    std::cout << "{\"name\": \"encode_" << codecName.toStdString() << "_" << size.name << "\", "
+              << "\"frames\": " << frameCount << ", "
+              << "\"seconds\": " << seconds << ", "
+              << "\"fps\": " << frameCount / seconds << ", "
+              << "\"queue_full\": " << queueFull << ", "
+              << "\"max_queue_depth\": " << stats.maxQueueDepth << ", "
+              << "\"mean_latency_ms\": " << stats.meanLatencyMs << ", "
+              << "\"dropped\": " << stats.droppedFrames << "}" << std::endl;
+    return true;
+}
+
+int main(int argc, char *argv[])
+{
+    int frameCount = 600;
+    int threads = 1;
+    if (argc > 1)
+        frameCount = std::stoi(argv[1]);
+    if (argc > 2)
+        threads = std::stoi(argv[2]);
+
+    QTemporaryDir dir;
+    if (!dir.isValid()) {
+        std::cerr << "Unable to create a temporary directory." << std::endl;
+        return 1;
+    }
+
+    // Miniscope V4 and V3 sensor resolutions
+    const std::vector<BenchSize> sizes = {{"608x608", 608, 608}, {"752x480", 752, 480}};
+    const std::vector<BenchCodec> codecs = {
+        {"raw", VideoCodec::Raw}, {"ffv1", VideoCodec::FFV1}, {"av1", VideoCodec::AV1}, {"vp9", VideoCodec::VP9}};
+
+    for (const auto &size : sizes) {
+        for (const auto &codec : codecs)
+            benchEncode(dir.path(), codec, size, frameCount, threads);
+    }
+
+    return 0;
+}
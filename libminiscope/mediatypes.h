@@ -65,6 +65,32 @@ enum class VideoCodec {
 std::string videoCodecToString(VideoCodec codec);
 VideoCodec stringToVideoCodec(const std::string &str);
 
+/**
+ * @brief The EncoderThreading enum
+ *
+ * How the video encoder spreads its work over several threads.
+ * Codecs that do not support the selected kind of threading
+ * encode on a single thread.
+ */
+enum class EncoderThreading {
+    Auto,  /// let FFmpeg pick what the codec supports
+    Slice, /// encode the slices of a frame in parallel, no extra latency
+    Frame  /// encode several frames in parallel, adds a frame of latency per thread
+};
+
+/**
+ * @brief Counters of a VideoWriter, to tell whether encoding keeps up with the camera
+ */
+struct EncoderStats {
+    size_t queueDepth{0};    /// frames waiting to be encoded
+    size_t maxQueueDepth{0}; /// largest number of waiting frames since the recording started
+    size_t encodedFrames{0};
+    size_t droppedFrames{0}; /// frames rejected because the queue was full
+    double lastLatencyMs{0}; /// time from pushing the last frame until it was written
+    double meanLatencyMs{0};
+    double maxLatencyMs{0};
+};
+
 } // namespace MScope
 
 #endif // MEDIATYPES_H
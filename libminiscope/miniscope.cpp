@@ -23,7 +23,9 @@
 #include <chrono>
 #include <thread>
 #include <mutex>
+#include <condition_variable>
 #include <atomic>
+#include <array>
 #include <cmath>
 #include <QDebug>
 #include <QQueue>
@@ -103,7 +105,10 @@ public:
     {
         fps = 30;
         displayQueue.clear();
+        frameSeq = 0;
         videoCodec = VideoCodec::FFV1;
+        encoderThreads = 1;
+        encoderThreading = EncoderThreading::Auto;
         videoContainer = VideoContainer::Matroska;
 
         showRed = true;
@@ -114,6 +119,9 @@ public:
 
         minFluorDisplay = 0;
         maxFluorDisplay = 255;
+        blankThreshold = 0;
+        captureCycleTime = milliseconds_t(0);
+        encodeQueueDepth = 0;
 
         recordingSliceInterval = 0; // don't slice
         bgAccumulateAlpha = 0.01;
@@ -128,11 +136,40 @@ public:
         displayFrameCallback.first = nullptr;
     }
 
+    void notifyFrameWaiters()
+    {
+        // take the lock, so waiters can not miss a change of the running state
+        // between checking their predicate and starting to wait
+        {
+            std::lock_guard<std::mutex> lock(dispFrameMutex);
+        }
+        dispFrameCond.notify_all();
+    }
+
+    /**
+     * Find the oldest frame in the ring buffer that satisfies the predicate.
+     * Must be called with dispFrameMutex held.
+     */
+    template<typename Predicate>
+    TimedFrame findFirstFrame(Predicate pred) const
+    {
+        TimedFrame result;
+        for (const auto &f : frameRing) {
+            if (f.mat.empty() || !pred(f))
+                continue;
+            if (result.mat.empty() || f.seq < result.seq)
+                result = f;
+        }
+        return result;
+    }
+
     std::thread *thread;
     std::mutex dispFrameMutex;
+    std::condition_variable dispFrameCond;
     std::mutex rawFrameMutex;
     std::mutex timeMutex;
     std::mutex cmdMutex;
+    std::mutex encoderStatsMutex;
 
     std::pair<StatusMessageCallback, void *> statusCallback;
     std::pair<ControlChangeCallback, void *> controlChangeCallback;
@@ -165,6 +202,7 @@ public:
     std::atomic_int maxFluor;
     std::atomic_int minFluorDisplay;
     std::atomic_int maxFluorDisplay;
+    std::atomic_int blankThreshold;
 
     std::atomic<DisplayMode> displayMode;
     std::atomic<double> bgAccumulateAlpha; // NOTE: Double may not actually be atomic
@@ -178,12 +216,17 @@ public:
 
     std::atomic<size_t> droppedFramesCount;
     std::atomic_uint currentFPS;
+    std::atomic<milliseconds_t> captureCycleTime;
+    std::atomic<size_t> encodeQueueDepth;
+    EncoderStats encoderStats; // of the current or last recording, guarded by encoderStatsMutex
     std::atomic<milliseconds_t> lastRecordedFrameTime;
 
     cv::Mat lastRawFrame;
     bool rawFrameRetrieved;
 
     QQueue<cv::Mat> displayQueue;
+    std::array<TimedFrame, 8> frameRing; // the newest display frames, indexed by seq
+    std::atomic<quint64> frameSeq;
     std::pair<RawDataCallback, void *> frameCallback;
     std::pair<DisplayFrameCallback, void *> displayFrameCallback;
 
@@ -198,6 +241,8 @@ public:
     VideoCodec videoCodec;
     VideoContainer videoContainer;
     bool recordLossless;
+    int encoderThreads;
+    EncoderThreading encoderThreading;
     uint recordingSliceInterval;
 
     bool printExtraDebug;
@@ -405,6 +450,11 @@ bool Miniscope::loadDeviceConfig(const QString &deviceType)
                 for (const auto &n : value.toArray())
                     numLabels.push_back(n.toDouble());
                 commandRule.numLabelMap = numLabels;
+            } else if (key == "settle") {
+                const auto settle = value.toObject();
+                control.settleFrames = settle["frames"].toInt(control.settleFrames);
+                control.settleMaxFrames = settle["maxFrames"].toInt(control.settleMaxFrames);
+                control.settleTolerance = settle["tolerance"].toDouble(control.settleTolerance);
             }
         }
 
@@ -495,6 +545,7 @@ void Miniscope::fail(const QString &msg)
     d->running = false;
     d->failed = true;
     d->lastError = msg;
+    d->notifyFrameWaiters();
 
     qCWarning(logMScope).noquote() << msg;
 }
@@ -1003,6 +1054,13 @@ bool Miniscope::run()
             return false;
     }
 
+    {
+        // don't hand out frames of a previous run as the latest frame
+        std::lock_guard<std::mutex> lock(d->dispFrameMutex);
+        for (auto &f : d->frameRing)
+            f = TimedFrame();
+    }
+
     startCaptureThread();
     return true;
 }
@@ -1011,6 +1069,7 @@ void Miniscope::stop()
 {
     d->recording = false;
     d->running = false;
+    d->notifyFrameWaiters();
     finishCaptureThread();
 }
 
@@ -1133,6 +1192,56 @@ cv::Mat Miniscope::currentDisplayFrame()
     return d->displayQueue.dequeue();
 }
 
+cv::Mat Miniscope::waitForDisplayFrame(const milliseconds_t &timeout)
+{
+    std::unique_lock<std::mutex> lock(d->dispFrameMutex);
+    d->dispFrameCond.wait_for(lock, timeout, [&] {
+        return !d->displayQueue.isEmpty() || !d->running;
+    });
+    if (d->displayQueue.isEmpty())
+        return cv::Mat();
+    return d->displayQueue.dequeue();
+}
+
+TimedFrame Miniscope::latestFrame()
+{
+    std::lock_guard<std::mutex> lock(d->dispFrameMutex);
+    return d->frameRing[d->frameSeq % d->frameRing.size()];
+}
+
+quint64 Miniscope::frameSeq() const
+{
+    return d->frameSeq;
+}
+
+TimedFrame Miniscope::waitForFrameAfter(quint64 seq, const milliseconds_t &timeout)
+{
+    std::unique_lock<std::mutex> lock(d->dispFrameMutex);
+    d->dispFrameCond.wait_for(lock, timeout, [&] {
+        return d->frameSeq > seq || !d->running;
+    });
+    return d->findFirstFrame([&](const TimedFrame &f) {
+        return f.seq > seq;
+    });
+}
+
+TimedFrame Miniscope::waitForFrameAfterTime(
+    const std::chrono::steady_clock::time_point &time,
+    const milliseconds_t &timeout)
+{
+    std::unique_lock<std::mutex> lock(d->dispFrameMutex);
+    const auto newestFrameIsAfter = [&]() {
+        const auto &newest = d->frameRing[d->frameSeq % d->frameRing.size()];
+        return !newest.mat.empty() && newest.captureTime > time;
+    };
+    d->dispFrameCond.wait_for(lock, timeout, [&] {
+        return newestFrameIsAfter() || !d->running;
+    });
+    return d->findFirstFrame([&](const TimedFrame &f) {
+        return f.captureTime > time;
+    });
+}
+
 bool Miniscope::fetchLastRawFrame(cv::Mat &output)
 {
     std::lock_guard<std::mutex> lock(d->rawFrameMutex);
@@ -1153,6 +1262,31 @@ size_t Miniscope::droppedFramesCount() const
     return d->droppedFramesCount;
 }
 
+/**
+ * @brief Time the capture thread needed for its last cycle, from grabbing a frame
+ * to having it queued for display and recording.
+ */
+milliseconds_t Miniscope::captureCycleTime() const
+{
+    return d->captureCycleTime;
+}
+
+/**
+ * @brief Number of recorded frames the video encoder had not written yet at the end
+ * of the last capture cycle. Always zero while not recording.
+ */
+size_t Miniscope::encodeQueueDepth() const
+{
+    return d->encodeQueueDepth;
+}
+
+void Miniscope::updateEncoderStats(const EncoderStats &stats)
+{
+    d->encodeQueueDepth = stats.queueDepth;
+    std::lock_guard<std::mutex> lock(d->encoderStatsMutex);
+    d->encoderStats = stats;
+}
+
 double Miniscope::fps() const
 {
     return d->fps;
@@ -1243,6 +1377,32 @@ void Miniscope::setRecordLossless(bool lossless)
     d->recordLossless = lossless;
 }
 
+int Miniscope::encoderThreads() const
+{
+    return d->encoderThreads;
+}
+
+void Miniscope::setEncoderThreads(int count)
+{
+    d->encoderThreads = count;
+}
+
+EncoderThreading Miniscope::encoderThreading() const
+{
+    return d->encoderThreading;
+}
+
+void Miniscope::setEncoderThreading(EncoderThreading threading)
+{
+    d->encoderThreading = threading;
+}
+
+EncoderStats Miniscope::encoderStats() const
+{
+    std::lock_guard<std::mutex> lock(d->encoderStatsMutex);
+    return d->encoderStats;
+}
+
 int Miniscope::minFluorDisplay() const
 {
     return d->minFluorDisplay;
@@ -1263,6 +1423,16 @@ void Miniscope::setMaxFluorDisplay(int value)
     d->maxFluorDisplay = value;
 }
 
+int Miniscope::blankThreshold() const
+{
+    return d->blankThreshold;
+}
+
+void Miniscope::setBlankThreshold(int value)
+{
+    d->blankThreshold = value;
+}
+
 int Miniscope::minFluor() const
 {
     return d->minFluor;
@@ -1380,19 +1550,35 @@ bool Miniscope::waitForAcquiredFrameCount(uint count)
     return true;
 }
 
-void Miniscope::addDisplayFrameToBuffer(const cv::Mat &frame, const milliseconds_t &timestamp)
+void Miniscope::addDisplayFrameToBuffer(
+    const cv::Mat &frame,
+    const milliseconds_t &timestamp,
+    const FrameStats &stats)
 {
     // call potential callback on this possibly edited "to be displayed" frame
     const auto displayFrameCB = d->displayFrameCallback.first;
     if (displayFrameCB != nullptr)
         displayFrameCB(frame, timestamp, d->displayFrameCallback.second);
 
-    // the display frame queue is protected
-    std::lock_guard<std::mutex> lock(d->dispFrameMutex);
-
-    // drop frames if we are displaying too slowly, otherwise add new stuff to queue
-    if (d->displayQueue.size() < 48)
-        d->displayQueue.enqueue(frame);
+    {
+        // the display frame queue is protected
+        std::lock_guard<std::mutex> lock(d->dispFrameMutex);
+
+        // the ring buffer always gets the newest frame
+        const auto seq = d->frameSeq + 1;
+        auto &slot = d->frameRing[seq % d->frameRing.size()];
+        slot.mat = frame;
+        slot.stats = stats;
+        slot.seq = seq;
+        slot.timestamp = timestamp;
+        slot.captureTime = std::chrono::steady_clock::now();
+        d->frameSeq = seq;
+
+        // drop frames if we are displaying too slowly, otherwise add new stuff to queue
+        if (d->displayQueue.size() < 48)
+            d->displayQueue.enqueue(frame);
+    }
+    d->dispFrameCond.notify_all();
 }
 
 void Miniscope::setLastRawFrame(const cv::Mat &frame)
@@ -1409,6 +1595,120 @@ inline milliseconds_t Miniscope::getCurrentFrameTimestamp()
     return milliseconds_t(static_cast<long>(d->cam.get(cv::CAP_PROP_POS_MSEC)));
 }
 
+/**
+ * Compute the statistics of a frame in a single pass over its pixels,
+ * so signal and blank detection don't need to scan the frame again.
+ */
+static FrameStats computeFrameStats(const cv::Mat &frame, int blankThreshold)
+{
+    FrameStats stats;
+    if (frame.empty())
+        return stats;
+
+    cv::Mat gray = frame;
+    if (gray.channels() != 1)
+        cv::cvtColor(gray, gray, cv::COLOR_BGR2GRAY);
+    if (gray.depth() != CV_8U)
+        gray.convertTo(gray, CV_8U);
+
+    int minValue = 255;
+    int maxValue = 0;
+    quint64 sum = 0;
+    quint64 gradSum = 0;
+    const uchar *prevRow = nullptr;
+    for (int y = 0; y < gray.rows; y++) {
+        const uchar *row = gray.ptr<uchar>(y);
+        int left = row[0];
+        for (int x = 0; x < gray.cols; x++) {
+            const int value = row[x];
+            minValue = std::min(minValue, value);
+            maxValue = std::max(maxValue, value);
+            sum += value;
+            stats.histogram[value >> 4]++;
+
+            const int dx = value - left;
+            gradSum += dx * dx;
+            left = value;
+            if (prevRow != nullptr) {
+                const int dy = value - prevRow[x];
+                gradSum += dy * dy;
+            }
+        }
+        prevRow = row;
+    }
+
+    const auto pixelCount = static_cast<double>(gray.total());
+    stats.min = minValue;
+    stats.max = maxValue;
+    stats.mean = sum / pixelCount;
+    stats.sharpness = gradSum / pixelCount;
+    stats.blank = maxValue <= blankThreshold;
+    return stats;
+}
+
+FrameAverage Miniscope::averageFrames(
+    uint count,
+    quint64 afterSeq,
+    bool withMax,
+    bool withVariance,
+    const milliseconds_t &frameTimeout)
+{
+    FrameAverage result;
+    cv::Mat sum;
+    cv::Mat sqSum;
+    int frameType = 0;
+
+    auto seq = afterSeq;
+    while (result.count < count) {
+        const auto frame = waitForFrameAfter(seq, frameTimeout);
+        if (frame.mat.empty()) {
+            d->lastError = QStringLiteral("Frame averaging stopped after %1 of %2 frames, no new frame arrived.")
+                               .arg(result.count)
+                               .arg(count);
+            break;
+        }
+        seq = frame.seq;
+
+        if (result.count == 0) {
+            frameType = frame.mat.type();
+            sum = cv::Mat::zeros(frame.mat.size(), CV_MAKETYPE(CV_64F, frame.mat.channels()));
+            if (withVariance)
+                sqSum = cv::Mat::zeros(sum.size(), sum.type());
+            if (withMax)
+                result.max = frame.mat.clone();
+            result.firstSeq = frame.seq;
+        } else if (frame.mat.size() != sum.size() || frame.mat.type() != frameType) {
+            continue;
+        } else if (withMax) {
+            cv::max(result.max, frame.mat, result.max);
+        }
+
+        cv::accumulate(frame.mat, sum);
+        if (withVariance)
+            cv::accumulateSquare(frame.mat, sqSum);
+        if (frame.stats.blank)
+            result.blankCount++;
+        result.lastSeq = frame.seq;
+        result.count++;
+    }
+
+    if (result.count == 0)
+        return result;
+
+    const auto n = static_cast<double>(result.count);
+    sum.convertTo(result.mean, frameType, 1.0 / n);
+    if (withVariance) {
+        // var = E[x^2] - E[x]^2, clamped as rounding may make it slightly negative
+        cv::Mat meanF = sum / n;
+        cv::Mat var = sqSum / n - meanF.mul(meanF);
+        cv::max(var, 0, var);
+        var.convertTo(result.variance, CV_MAKETYPE(CV_32F, sum.channels()));
+    }
+    result.stats = computeFrameStats(result.mean, d->blankThreshold);
+
+    return result;
+}
+
 static void overlayAlphaImage(cv::Mat *src, cv::Mat *overlay, const cv::Point &location)
 {
     for (int y = std::max(location.y, 0); y < src->rows; ++y) {
@@ -1559,6 +1859,8 @@ void Miniscope::captureThread(void *msPtr)
 
     d->droppedFramesCount = 0;
     d->currentFPS = static_cast<uint>(d->fps);
+    d->captureCycleTime = milliseconds_t(0);
+    d->encodeQueueDepth = 0;
 
     // load orientation sensor indicator images
     cv::Mat bnoIndGood;
@@ -1763,7 +2065,8 @@ void Miniscope::captureThread(void *msPtr)
             d->recording = false;
 
             msgInfo("Dropped frame.");
-            self->addDisplayFrameToBuffer(droppedFrameImage, frameTimestamp);
+            self->addDisplayFrameToBuffer(
+                droppedFrameImage, frameTimestamp, computeFrameStats(droppedFrameImage, d->blankThreshold));
             if (d->droppedFramesCount > 0) {
                 // reconnect in case we run into multiple failures when trying
                 // to acquire a timestamp
@@ -1796,6 +2099,8 @@ void Miniscope::captureThread(void *msPtr)
                 vwriter->setCodec(d->videoCodec);
                 vwriter->setContainer(d->videoContainer);
                 vwriter->setLossless(d->recordLossless);
+                vwriter->setEncoderThreads(d->encoderThreads);
+                vwriter->setEncoderThreading(d->encoderThreading);
 
                 auto vidFnameBase = d->videoFname;
                 if (vidFnameBase.mid(vidFnameBase.lastIndexOf(".") + 1).length() == 3)
@@ -1852,6 +2157,7 @@ void Miniscope::captureThread(void *msPtr)
                 // new frames to the video.
                 // Also reset the video writer for a clean start
                 vwriter->finalize();
+                self->updateEncoderStats(vwriter->stats());
                 vwriter.reset(new VideoWriter());
                 recordFrames = false;
                 msgInfo("Recording finalized.");
@@ -1869,6 +2175,9 @@ void Miniscope::captureThread(void *msPtr)
             }
         }
 
+        // statistics of the raw frame, handed out together with the display frame
+        const auto frameStats = computeFrameStats(frame, d->blankThreshold);
+
         // "frame" is the frame that we record to disk, while the "displayFrame"
         // is the one that we may also record as a video file
         cv::Mat displayFrame;
@@ -1906,10 +2215,16 @@ void Miniscope::captureThread(void *msPtr)
             }
         } else {
             // grayscale image
-            double minF, maxF;
-            cv::minMaxLoc(displayFrame, &minF, &maxF);
-            d->minFluor = static_cast<int>(minF);
-            d->maxFluor = static_cast<int>(maxF);
+            if (d->displayMode == DisplayMode::RawFrames) {
+                // we already know the range of the raw frame
+                d->minFluor = frameStats.min;
+                d->maxFluor = frameStats.max;
+            } else {
+                double minF, maxF;
+                cv::minMaxLoc(displayFrame, &minF, &maxF);
+                d->minFluor = static_cast<int>(minF);
+                d->maxFluor = static_cast<int>(maxF);
+            }
 
             displayFrame.convertTo(
                 displayFrame,
@@ -1955,7 +2270,7 @@ void Miniscope::captureThread(void *msPtr)
 
         // add display frame to ringbuffer, and record the raw
         // frame to disk if we want to record it.
-        self->addDisplayFrameToBuffer(displayFrame, frameTimestamp);
+        self->addDisplayFrameToBuffer(displayFrame, frameTimestamp, frameStats);
         if (recordFrames) {
             if (!vwriter->pushFrame(frame, frameTimestamp))
                 self->fail(QStringLiteral("Unable to send frames to encoder: %1").arg(vwriter->lastError()));
@@ -1974,10 +2289,17 @@ void Miniscope::captureThread(void *msPtr)
         const auto totalTime = std::chrono::duration_cast<std::chrono::milliseconds>(
             std::chrono::steady_clock::now() - cycleStartTime);
         d->currentFPS = static_cast<uint>(1 / (totalTime.count() / static_cast<double>(1000)));
+        d->captureCycleTime = totalTime;
+        if (recordFrames)
+            self->updateEncoderStats(vwriter->stats());
+        else
+            d->encodeQueueDepth = 0;
     }
 
     // finalize recording (if there was any still ongoing)
     vwriter->finalize();
+    if (recordFrames)
+        self->updateEncoderStats(vwriter->stats());
     d->lastRecordedFrameTime = std::chrono::milliseconds(0);
 
     // finalize BNO writer, just in case
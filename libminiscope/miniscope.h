@@ -20,6 +20,8 @@
 #ifndef MINISCOPE_H
 #define MINISCOPE_H
 
+#include <atomic>
+#include <array>
 #include <QMetaObject>
 #include <QLoggingCategory>
 #include <QFuture>
@@ -82,7 +84,10 @@ class ControlDefinition
 public:
     explicit ControlDefinition()
         : valueMin(-1),
-          valueMax(-1)
+          valueMax(-1),
+          settleFrames(2),
+          settleMaxFrames(0),
+          settleTolerance(0)
     {
     }
 
@@ -97,6 +102,60 @@ public:
 
     QStringList labels;
     std::vector<double> values;
+
+    int settleFrames;       /// frames to wait after a value change before images reflect it
+    int settleMaxFrames;    /// maximum frames to additionally wait for the image brightness to converge
+    double settleTolerance; /// relative mean brightness change between frames below which we consider the image settled
+};
+
+/**
+ * @brief Statistics of a raw frame, computed in a single pass by the capture thread
+ */
+struct FrameStats {
+    int min{0};
+    int max{0};
+    double mean{0};
+    /// Pixel value histogram with 16 bins of 16 values each
+    std::array<quint32, 16> histogram{};
+    /// Mean squared difference between neighboring pixels, higher values mean a sharper image
+    double sharpness{0};
+    /// True if no pixel is brighter than the blank threshold
+    bool blank{true};
+};
+
+/**
+ * @brief The average of consecutive display frames, see Miniscope::averageFrames()
+ */
+struct FrameAverage {
+    /// Mean image, with the same type as the averaged frames
+    cv::Mat mean;
+    /// Per-pixel maximum, empty unless requested
+    cv::Mat max;
+    /// Per-pixel variance as 32-bit float image, empty unless requested
+    cv::Mat variance;
+    /// Number of frames that were averaged
+    uint count{0};
+    /// Number of averaged frames that were flagged as blank
+    uint blankCount{0};
+    /// Sequence numbers of the first and last averaged frame
+    quint64 firstSeq{0};
+    quint64 lastSeq{0};
+    /// Statistics of the mean image
+    FrameStats stats;
+};
+
+/**
+ * @brief A display frame together with the information when it was captured
+ */
+struct TimedFrame {
+    cv::Mat mat;
+    FrameStats stats;
+    /// Number of the frame, increases by one for every frame the Miniscope delivers and is never reset
+    quint64 seq{0};
+    /// Timestamp of the frame, as passed to the display frame callback
+    milliseconds_t timestamp{0};
+    /// Time at which the frame was received, on the steady clock
+    std::chrono::steady_clock::time_point captureTime;
 };
 
 /**
@@ -107,12 +166,33 @@ class MS_LIB_EXPORT TaskProgressEmitter : public QObject
     Q_OBJECT
 public:
     explicit TaskProgressEmitter(QObject *parent = nullptr)
-        : QObject(parent)
+        : QObject(parent),
+          m_cancelRequested(false)
     {
     }
 
+    /**
+     * @brief Ask the task to stop at the next possible point
+     *
+     * Cancellation is cooperative, the task will check for it between
+     * acquiring individual planes and then fail with an error.
+     */
+    void requestCancel()
+    {
+        m_cancelRequested = true;
+    }
+
+    bool isCancelRequested() const
+    {
+        return m_cancelRequested;
+    }
+
 Q_SIGNALS:
     void progress(int value);
+    void finished();
+
+private:
+    std::atomic_bool m_cancelRequested;
 };
 
 /**
@@ -215,6 +295,66 @@ public:
      */
     cv::Mat currentDisplayFrame();
 
+    /**
+     * @brief Wait for a display frame to become available and retrieve it from the display queue.
+     * @param timeout The maximum time to wait for a new frame.
+     * @return The frame, or an empty matrix if no frame arrived in time or acquisition stopped.
+     */
+    cv::Mat waitForDisplayFrame(const milliseconds_t &timeout);
+
+    /**
+     * @brief Retrieve the newest display frame, without removing anything from the display queue.
+     * @return The frame, with an empty matrix if no frame was captured since acquisition started.
+     */
+    TimedFrame latestFrame();
+
+    /**
+     * @brief Sequence number of the newest display frame.
+     */
+    quint64 frameSeq() const;
+
+    /**
+     * @brief Wait for the first frame with a sequence number higher than seq.
+     *
+     * Only the last few frames are kept, so if that frame is not available anymore,
+     * the oldest frame that is still kept is returned instead.
+     *
+     * @param seq Sequence number of a previous frame, e.g. from frameSeq() before changing a control.
+     * @param timeout The maximum time to wait for a new frame.
+     * @return The frame, with an empty matrix if no frame arrived in time or acquisition stopped.
+     */
+    TimedFrame waitForFrameAfter(quint64 seq, const milliseconds_t &timeout);
+
+    /**
+     * @brief Wait for the first frame that was captured after the given point in time.
+     * @see waitForFrameAfter
+     */
+    TimedFrame waitForFrameAfterTime(
+        const std::chrono::steady_clock::time_point &time,
+        const milliseconds_t &timeout);
+
+    /**
+     * @brief Average consecutive display frames, accumulating them in native code.
+     *
+     * Every frame with a sequence number above afterSeq is added to a floating point
+     * accumulator as it arrives, so no frames are buffered or copied to the caller.
+     * Frames that do not match the size of the first frame (e.g. the dropped frame
+     * placeholder) are skipped.
+     *
+     * @param count Number of frames to average.
+     * @param afterSeq Sequence number of a previous frame, e.g. from frameSeq() before changing a control.
+     * @param withMax Also compute the per-pixel maximum.
+     * @param withVariance Also compute the per-pixel variance.
+     * @param frameTimeout The maximum time to wait for each new frame.
+     * @return The average. Its count is lower than requested if acquisition stopped or a frame did not arrive in time.
+     */
+    FrameAverage averageFrames(
+        uint count,
+        quint64 afterSeq,
+        bool withMax = false,
+        bool withVariance = false,
+        const milliseconds_t &frameTimeout = milliseconds_t(1000));
+
     /**
      * @brief Retrieve the raw frame that was acquired last.
      *
@@ -229,6 +369,8 @@ public:
 
     uint currentFps() const;
     size_t droppedFramesCount() const;
+    milliseconds_t captureCycleTime() const;
+    size_t encodeQueueDepth() const;
 
     double fps() const;
 
@@ -252,6 +394,22 @@ public:
     bool recordLossless() const;
     void setRecordLossless(bool lossless);
 
+    /**
+     * @brief Number of threads the video encoder may use, 0 for one per CPU core.
+     * The default of 1 keeps FFmpeg's own threading defaults of the codec.
+     */
+    int encoderThreads() const;
+    void setEncoderThreads(int count);
+
+    EncoderThreading encoderThreading() const;
+    void setEncoderThreading(EncoderThreading threading);
+
+    /**
+     * @brief Queue depth, latency and drop counters of the video encoder,
+     * for the current recording or the last one that was finished.
+     */
+    EncoderStats encoderStats() const;
+
     int minFluorDisplay() const;
     void setMinFluorDisplay(int value);
 
@@ -261,6 +419,12 @@ public:
     int minFluor() const;
     int maxFluor() const;
 
+    /**
+     * @brief Frames without a pixel brighter than this value are flagged as blank in their FrameStats.
+     */
+    int blankThreshold() const;
+    void setBlankThreshold(int value);
+
     DisplayMode displayMode() const;
     void setDisplayMode(DisplayMode mode);
 
@@ -301,8 +465,9 @@ private:
     bool openCamera();
     void enqueueI2CCommand(long preambleKey, std::vector<quint8> packet);
     void sendCommandsToDevice();
-    void addDisplayFrameToBuffer(const cv::Mat &frame, const milliseconds_t &timestamp);
+    void addDisplayFrameToBuffer(const cv::Mat &frame, const milliseconds_t &timestamp, const FrameStats &stats);
     void setLastRawFrame(const cv::Mat &frame);
+    void updateEncoderStats(const EncoderStats &stats);
     static void captureThread(void *msPtr);
     void startCaptureThread();
     void finishCaptureThread();
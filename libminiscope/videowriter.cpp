@@ -21,10 +21,14 @@
 
 #include <QString>
 #include <iostream>
+#include <algorithm>
 #include <atomic>
 #include <thread>
 #include <mutex>
+#include <condition_variable>
 #include <queue>
+#include <deque>
+#include <utility>
 #include <fstream>
 #include <opencv2/imgproc/imgproc.hpp>
 extern "C" {
@@ -44,6 +48,15 @@ extern "C" {
  */
 static const uint FRAME_QUEUE_MAX_COUNT = 512;
 
+/**
+ * @brief A frame waiting to be encoded.
+ */
+struct QueuedFrame {
+    cv::Mat mat;
+    std::chrono::milliseconds timestamp;
+    std::chrono::steady_clock::time_point pushTime;
+};
+
 #pragma GCC diagnostic push
 #pragma GCC diagnostic ignored "-Wpadded"
 class VideoWriter::Private
@@ -68,12 +81,18 @@ public:
         cctx = nullptr;
         swsctx = nullptr;
         lossless = false;
+        encoderThreads = 1; // leave the threading of the encoder alone unless asked to
+        totalLatencyMs = 0;
+        encoderThreading = EncoderThreading::Auto;
     }
 
     QString lastError;
     std::thread *thread;
     std::mutex mutex;
-    std::queue<std::pair<cv::Mat, std::chrono::milliseconds>> frameQueue;
+    std::condition_variable queueCond;
+    std::queue<QueuedFrame> frameQueue;
+    EncoderStats stats;
+    double totalLatencyMs;
 
     QString fnameBase;
     uint fileSliceIntervalMin;
@@ -87,9 +106,12 @@ public:
     int height;
     AVRational fps;
     bool lossless;
+    int encoderThreads;
+    EncoderThreading encoderThreading;
 
     bool saveTimestamps;
     std::ofstream timestampFile;
+    std::deque<std::pair<int64_t, std::chrono::milliseconds>> pendingTimestamps; // pts and timestamp of frames in the encoder
     std::chrono::milliseconds captureStartTimestamp;
 
     AVFrame *frame;
@@ -149,6 +171,20 @@ static AVFrame *vw_alloc_frame(int pix_fmt, int width, int height, bool allocate
     return aframe;
 }
 
+/**
+ * @brief Number of FFV1 slices that keeps @p threads encoder threads busy.
+ *
+ * FFV1 only encodes slices in parallel, and only supports slice counts
+ * that split the frame into a near-square grid.
+ */
+static int ffv1SliceCount(int threads)
+{
+    for (const int slices : {4, 6, 9, 12, 16, 24})
+        if (slices >= threads)
+            return slices;
+    return 24;
+}
+
 void VideoWriter::initializeInternal()
 {
     // sanity check. 'Raw' is the only "codec" that we allow to only actually work with one
@@ -322,6 +358,27 @@ void VideoWriter::initializeInternal()
         // Keeping a good balance between recording space/performance/integrity is difficult sometimes.
     }
 
+    // spread the encoding over several threads if that was requested, 0 threads lets FFmpeg use one per core
+    if (d->encoderThreads != 1) {
+        d->cctx->thread_count = d->encoderThreads;
+        switch (d->encoderThreading) {
+        case EncoderThreading::Slice:
+            d->cctx->thread_type = FF_THREAD_SLICE;
+            break;
+        case EncoderThreading::Frame:
+            d->cctx->thread_type = FF_THREAD_FRAME;
+            break;
+        default:
+            d->cctx->thread_type = FF_THREAD_SLICE | FF_THREAD_FRAME;
+            break;
+        }
+        if (d->codec == VideoCodec::FFV1) {
+            const auto threads = d->encoderThreads > 0 ? d->encoderThreads
+                                                       : static_cast<int>(std::thread::hardware_concurrency());
+            d->cctx->slices = ffv1SliceCount(threads);
+        }
+    }
+
     // Adjust pixel color formats for selected video codecs
     switch (d->codec) {
     case VideoCodec::FFV1:
@@ -376,6 +433,7 @@ void VideoWriter::initializeInternal()
         throw std::runtime_error(QStringLiteral("Failed to write format header: %1").arg(ret).toStdString());
     }
     d->framePts = 0;
+    d->pendingTimestamps.clear();
 
     if (d->saveTimestamps) {
         d->timestampFile.close(); // ensure file is closed
@@ -400,8 +458,16 @@ void VideoWriter::finalizeInternal(bool writeTrailer, bool stopRecThread)
         stopEncodeThread();
 
     if (d->initialized) {
-        if (d->vstrm != nullptr)
+        if (d->vstrm != nullptr) {
+            // write the frames the encoder still holds back, e.g. when encoding several frames in parallel
             avcodec_send_frame(d->cctx, nullptr);
+            auto pkt = av_packet_alloc();
+            while ((pkt != nullptr) && (avcodec_receive_packet(d->cctx, pkt) == 0)) {
+                writePacket(pkt);
+                av_packet_unref(pkt);
+            }
+            av_packet_free(&pkt);
+        }
 
         // write trailer
         if (writeTrailer && (d->octx != nullptr))
@@ -579,6 +645,35 @@ bool VideoWriter::prepareFrame(const cv::Mat &inImage)
     return true;
 }
 
+/**
+ * @brief Write an encoded packet, and the timestamp of its frame if we save timestamps.
+ */
+void VideoWriter::writePacket(AVPacket *pkt)
+{
+    const auto pts = pkt->pts;
+
+    // rescale packet timestamp
+    pkt->duration = 1;
+    av_packet_rescale_ts(pkt, d->cctx->time_base, d->vstrm->time_base);
+
+    // write packet
+    av_write_frame(d->octx, pkt);
+    d->frames_n++;
+
+    // store timestamp (if necessary). Encoders that hold frames back hand out their packets later,
+    // so the timestamp is the one that was sent along with the frame of this packet.
+    if (d->saveTimestamps) {
+        for (auto it = d->pendingTimestamps.begin(); it != d->pendingTimestamps.end(); ++it) {
+            if (it->first != pts)
+                continue;
+            // frames are counted from 1 in the timestamps file
+            d->timestampFile << it->first + 1 << "; " << it->second.count() << "\n";
+            d->pendingTimestamps.erase(it);
+            break;
+        }
+    }
+}
+
 bool VideoWriter::encodeFrame(const cv::Mat &frame, const std::chrono::milliseconds &timestamp)
 {
     int ret;
@@ -597,6 +692,8 @@ bool VideoWriter::encodeFrame(const cv::Mat &frame, const std::chrono::milliseco
         std::cerr << "Unable to send frame to encoder. N:" << d->frames_n + 1 << std::endl;
         return false;
     }
+    if (d->saveTimestamps)
+        d->pendingTimestamps.emplace_back(d->frame->pts, timestamp);
 
     pkt = av_packet_alloc();
     if (!pkt) {
@@ -606,27 +703,15 @@ bool VideoWriter::encodeFrame(const cv::Mat &frame, const std::chrono::milliseco
 
     const auto tsMsec = timestamp.count();
 
-    ret = avcodec_receive_packet(d->cctx, pkt);
-    if (ret != 0) {
-        // some encoders need to be fed a few frames before they produce a useful result
-        // ignore errors in that case for a little bit.
-        if ((ret == AVERROR(EAGAIN))
-            && ((d->codec == VideoCodec::VP9) || (d->codec == VideoCodec::H264) || (d->codec == VideoCodec::HEVC)))
-            success = true;
-        goto out;
+    // write all packets the encoder has ready, which may be none if it holds frames back
+    // (e.g. encoders that need a few frames before they produce a useful result, or that
+    // encode several frames at once), or several once it catches up
+    while ((ret = avcodec_receive_packet(d->cctx, pkt)) == 0) {
+        writePacket(pkt);
+        av_packet_unref(pkt);
     }
-
-    // rescale packet timestamp
-    pkt->duration = 1;
-    av_packet_rescale_ts(pkt, d->cctx->time_base, d->vstrm->time_base);
-
-    // write packet
-    av_write_frame(d->octx, pkt);
-    d->frames_n++;
-
-    // store timestamp (if necessary)
-    if (d->saveTimestamps)
-        d->timestampFile << d->framePts << "; " << tsMsec << "\n";
+    if (ret != AVERROR(EAGAIN))
+        goto out;
 
     if (d->fileSliceIntervalMin != 0) {
         const auto tsMin = static_cast<double>(tsMsec - d->captureStartTimestamp.count()) / 1000.0 / 60.0;
@@ -660,9 +745,14 @@ void VideoWriter::startEncodeThread()
     // clear last error message
     d->lastError.clear();
     stopEncodeThread();
-    while (!d->frameQueue.empty())
-        d->frameQueue.pop();
-    d->acceptFrames = true;
+    {
+        std::lock_guard<std::mutex> lock(d->mutex);
+        while (!d->frameQueue.empty())
+            d->frameQueue.pop();
+        d->stats = EncoderStats();
+        d->totalLatencyMs = 0;
+        d->acceptFrames = true;
+    }
     d->thread = new std::thread(encodeThread, this);
 }
 
@@ -672,27 +762,54 @@ void VideoWriter::stopEncodeThread()
         return;
     assert(d->initialized);
 
-    d->acceptFrames = false;
+    {
+        std::lock_guard<std::mutex> lock(d->mutex);
+        d->acceptFrames = false;
+    }
+    d->queueCond.notify_all();
     d->thread->join();
     delete d->thread;
     d->thread = nullptr;
 }
 
+/**
+ * @brief Queue a frame for encoding.
+ *
+ * The frame data is shared with the queue, not copied, so the caller must not
+ * write to it afterwards. The capture thread retrieves every frame into a new matrix.
+ */
 bool VideoWriter::pushFrame(const cv::Mat &frame, const std::chrono::milliseconds &time)
 {
-    std::lock_guard<std::mutex> lock(d->mutex);
-    if (!d->acceptFrames)
-        return false;
-    if (d->frameQueue.size() > FRAME_QUEUE_MAX_COUNT) {
-        d->lastError =
-            "Frame encoding buffer was full and new frame could not be added. Maybe encoding or storage is too slow.";
-        return false;
-    }
+    {
+        std::lock_guard<std::mutex> lock(d->mutex);
+        if (!d->acceptFrames)
+            return false;
+        if (d->frameQueue.size() > FRAME_QUEUE_MAX_COUNT) {
+            d->lastError =
+                "Frame encoding buffer was full and new frame could not be added. Maybe encoding or storage is too slow.";
+            d->stats.droppedFrames++;
+            return false;
+        }
 
-    d->frameQueue.push(std::make_pair(frame, time));
+        d->frameQueue.push(QueuedFrame{frame, time, std::chrono::steady_clock::now()});
+        d->stats.queueDepth = d->frameQueue.size();
+        d->stats.maxQueueDepth = std::max(d->stats.maxQueueDepth, d->stats.queueDepth);
+    }
+    d->queueCond.notify_one();
     return true;
 }
 
+/**
+ * @brief Queue depth, latency and drop counters since the recording was started.
+ */
+EncoderStats VideoWriter::stats() const
+{
+    std::lock_guard<std::mutex> lock(d->mutex);
+    auto stats = d->stats;
+    stats.queueDepth = d->frameQueue.size();
+    return stats;
+}
+
 VideoCodec VideoWriter::codec() const
 {
     return d->codec;
@@ -733,6 +850,33 @@ void VideoWriter::setLossless(bool enabled)
     d->lossless = enabled;
 }
 
+int VideoWriter::encoderThreads() const
+{
+    return d->encoderThreads;
+}
+
+/**
+ * @brief Set the number of encoder threads, 0 to use one per CPU core.
+ *
+ * The default of 1 leaves the threading of the encoder at FFmpeg's defaults,
+ * the threading mode and FFV1 slice count only apply with other values.
+ * Takes effect when the next file is initialized.
+ */
+void VideoWriter::setEncoderThreads(int count)
+{
+    d->encoderThreads = std::max(0, count);
+}
+
+EncoderThreading VideoWriter::encoderThreading() const
+{
+    return d->encoderThreading;
+}
+
+void VideoWriter::setEncoderThreading(EncoderThreading threading)
+{
+    d->encoderThreading = threading;
+}
+
 uint VideoWriter::fileSliceInterval() const
 {
     return d->fileSliceIntervalMin;
@@ -756,25 +900,38 @@ void VideoWriter::setContainer(VideoContainer container)
 void VideoWriter::encodeThread(void *vwPtr)
 {
     VideoWriter *self = static_cast<VideoWriter *>(vwPtr);
+    auto d = self->d.data();
+
+    while (true) {
+        QueuedFrame item;
+        {
+            std::unique_lock<std::mutex> lock(d->mutex);
+            d->queueCond.wait(lock, [d] {
+                return !d->frameQueue.empty() || !d->acceptFrames;
+            });
+            // only stop once all frames that made it into the queue are encoded
+            if (d->frameQueue.empty())
+                break;
+            item = std::move(d->frameQueue.front());
+            d->frameQueue.pop();
+            d->stats.queueDepth = d->frameQueue.size();
+        }
 
-    while (self->d->acceptFrames) {
-        cv::Mat frame;
-        std::chrono::milliseconds timestamp;
-        while (self->getNextFrameFromQueue(&frame, &timestamp)) {
-            self->encodeFrame(frame, timestamp);
+        // a failed file slice leaves us without an encoder, drop what is left
+        const auto encoded = d->initialized && self->encodeFrame(item.mat, item.timestamp);
+
+        const auto latencyMs = std::chrono::duration<double, std::milli>(
+                                   std::chrono::steady_clock::now() - item.pushTime)
+                                   .count();
+        std::lock_guard<std::mutex> lock(d->mutex);
+        if (encoded) {
+            d->stats.encodedFrames++;
+            d->stats.lastLatencyMs = latencyMs;
+            d->stats.maxLatencyMs = std::max(d->stats.maxLatencyMs, latencyMs);
+            d->totalLatencyMs += latencyMs;
+            d->stats.meanLatencyMs = d->totalLatencyMs / static_cast<double>(d->stats.encodedFrames);
+        } else {
+            d->stats.droppedFrames++;
         }
     }
 }
-
-bool VideoWriter::getNextFrameFromQueue(cv::Mat *frame, std::chrono::milliseconds *timestamp)
-{
-    std::lock_guard<std::mutex> lock(d->mutex);
-    if (d->frameQueue.empty())
-        return false;
-
-    auto pair = d->frameQueue.front();
-    *frame = pair.first;
-    *timestamp = pair.second;
-    d->frameQueue.pop();
-    return true;
-}
@@ -25,6 +25,8 @@
 #include <opencv2/core.hpp>
 #include "mediatypes.h"
 
+struct AVPacket;
+
 using namespace MScope;
 
 /**
@@ -49,6 +51,7 @@ public:
     void setCaptureStartTimestamp(const std::chrono::milliseconds &startTimestamp);
 
     bool pushFrame(const cv::Mat &frame, const std::chrono::milliseconds &time);
+    EncoderStats stats() const;
 
     VideoCodec codec() const;
     void setCodec(VideoCodec codec);
@@ -63,6 +66,12 @@ public:
     bool lossless() const;
     void setLossless(bool enabled);
 
+    int encoderThreads() const;
+    void setEncoderThreads(int count);
+
+    EncoderThreading encoderThreading() const;
+    void setEncoderThreading(EncoderThreading threading);
+
     uint fileSliceInterval() const;
     void setFileSliceInterval(uint minutes);
 
@@ -76,8 +85,8 @@ private:
     void initializeInternal();
     void finalizeInternal(bool writeTrailer, bool stopRecThread = true);
     static void encodeThread(void *vwPtr);
-    bool getNextFrameFromQueue(cv::Mat *frame, std::chrono::milliseconds *timestamp);
     bool prepareFrame(const cv::Mat &inImage);
+    void writePacket(AVPacket *pkt);
     bool encodeFrame(const cv::Mat &frame, const std::chrono::milliseconds &timestamp);
     void startEncodeThread();
     void stopEncodeThread();
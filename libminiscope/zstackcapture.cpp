@@ -31,6 +31,28 @@ static void emitProgress(TaskProgressEmitter *progress, int value)
         emit progress->progress(value);
 }
 
+/**
+ * Emits the finished signal of a progress emitter when going out of scope,
+ * so listeners are notified even if the task failed with an exception.
+ */
+class FinishedNotifier
+{
+public:
+    explicit FinishedNotifier(TaskProgressEmitter *progress)
+        : m_progress(progress)
+    {
+    }
+
+    ~FinishedNotifier()
+    {
+        if (m_progress != nullptr)
+            emit m_progress->finished();
+    }
+
+private:
+    TaskProgressEmitter *m_progress;
+};
+
 class ZStackException : public QException
 {
 public:
@@ -59,13 +81,44 @@ public:
 
     const char *what() const noexcept override
     {
-        return qPrintable(msg);
+        // qPrintable() would return a pointer into a temporary
+        return msgUtf8.constData();
     }
 
 private:
     QString msg;
+    QByteArray msgUtf8{msg.toUtf8()};
 };
 
+static void throwIfCancelled(TaskProgressEmitter *progress)
+{
+    if (progress != nullptr && progress->isCancelRequested())
+        throw ZStackException("Z-Stack acquisition was cancelled.");
+}
+
+/**
+ * Wait until the mean image brightness stops changing after a control was adjusted,
+ * for at most the maximum number of settle frames of that control.
+ */
+static void waitForImageSettled(Miniscope *mscope, const ControlDefinition &control)
+{
+    if (control.settleTolerance <= 0)
+        return;
+
+    cv::Mat raw;
+    double prevMean = -1;
+    for (int i = 0; i < control.settleMaxFrames; i++) {
+        mscope->waitForAcquiredFrameCount(1);
+        if (!mscope->fetchLastRawFrame(raw) || raw.empty())
+            continue;
+
+        const auto mean = cv::mean(raw)[0];
+        if (prevMean >= 0 && std::abs(mean - prevMean) <= control.settleTolerance * std::max(prevMean, 1.0))
+            break;
+        prevMean = mean;
+    }
+}
+
 static std::vector<cv::Mat> acquire3DData(
     Miniscope *mscope,
     const ControlDefinition &ewlControl,
@@ -74,7 +127,7 @@ static std::vector<cv::Mat> acquire3DData(
     uint step,
     uint averageCount,
     TaskProgressEmitter *progress,
-    uint adjFrameWaitTime = 2)
+    uint adjFrameWaitTime = 0)
 {
     if (fromEWL - toEWL == 0)
         throw ZStackException("EWL start and end positions must be different.");
@@ -91,6 +144,10 @@ static std::vector<cv::Mat> acquire3DData(
     if (averageCount > 36000)
         throw ZStackException("Image average count is too large.");
 
+    // use the settle time from the device configuration, unless we were given an explicit wait time
+    if (adjFrameWaitTime == 0)
+        adjFrameWaitTime = std::max(ewlControl.settleFrames, 1);
+
     int stepSigned;
     if (fromEWL - toEWL < 0)
         stepSigned = step;
@@ -105,11 +162,13 @@ static std::vector<cv::Mat> acquire3DData(
         // sanity check
         if (currentPos < ewlControl.valueMin || currentPos > ewlControl.valueMax)
             break;
+        throwIfCancelled(progress);
 
         // adjust
         mscope->setControlValue(ewlControl.id, currentPos);
-        // wait for some frames to give the EWL time to adjust
+        // wait for some frames to give the EWL time to adjust, then until the image has settled
         mscope->waitForAcquiredFrameCount(adjFrameWaitTime);
+        waitForImageSettled(mscope, ewlControl);
 
         // FIXME: Ideally we should verify that the device has actually adjusted the EWL,
         // but this feature is not yet iplemented in the library (we currently always
@@ -203,6 +262,7 @@ QFuture<void> launchZStackCapture(
     // TODO: Make use of QPromise when we can switch to Qt6, obsolete ProgressEmitter
     emitProgress(progress, 0);
     return QtConcurrent::run([=]() {
+        FinishedNotifier notifier(progress);
         captureZStack(mscope, fromEWL, toEWL, step, averageCount, outFilename, progress);
     });
 }
@@ -353,6 +413,7 @@ static void acquire3DAccumulation(
 
     QStringList rawFileList;
     for (uint i = 0; i < count; ++i) {
+        throwIfCancelled(progress);
         auto fnameRaw = QStringLiteral("%1/%2_zstack_%3.tiff").arg(outDirRaw.absolutePath(), outName).arg(i);
 
         int hwFromEWL;
@@ -430,6 +491,7 @@ QFuture<void> launch3DAccumulation(
     // TODO: Make use of QPromise when we can switch to Qt6, obsolete ProgressEmitter
     emitProgress(progress, 0);
     return QtConcurrent::run([=]() {
+        FinishedNotifier notifier(progress);
         acquire3DAccumulation(mscope, fromEWL, toEWL, step, count, saveRaw, outDir, outName, progress);
     });
 }
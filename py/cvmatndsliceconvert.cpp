@@ -389,5 +389,63 @@ PyObject *NDArrayConverter::toNDArray(const cv::Mat &m)
     return o;
 }
 
+static void releaseMatCapsule(PyObject *capsule)
+{
+    delete static_cast<Mat *>(PyCapsule_GetPointer(capsule, "cv::Mat"));
+}
+
+PyObject *NDArrayConverter::toNDArrayView(const cv::Mat &m)
+{
+    if (!m.data)
+        Py_RETURN_NONE;
+
+    const int depth = m.depth();
+    const int typenum = depth == CV_8U    ? NPY_UBYTE
+                        : depth == CV_8S  ? NPY_BYTE
+                        : depth == CV_16U ? NPY_USHORT
+                        : depth == CV_16S ? NPY_SHORT
+                        : depth == CV_32S ? NPY_INT
+                        : depth == CV_32F ? NPY_FLOAT
+                        : depth == CV_64F ? NPY_DOUBLE
+                                          : -1;
+
+    // anything we can not describe with plain strides is copied like before
+    if (typenum < 0 || m.dims != 2 || m.allocator == &g_numpyAllocator)
+        return toNDArray(m);
+
+    const int cn = m.channels();
+    const int ndims = cn > 1 ? 3 : 2;
+    npy_intp sizes[3] = {m.rows, m.cols, cn};
+    npy_intp strides[3] = {(npy_intp)m.step[0], (npy_intp)m.step[1], (npy_intp)m.elemSize1()};
+
+    // Only hand out a writable view if nobody else holds on to this buffer, otherwise
+    // Python could modify frames that are still in use elsewhere (e.g. the shared
+    // "dropped frame" image).
+    const bool writable = m.u != nullptr && m.u->refcount == 1;
+
+    // the heap copy of the header shares the refcounted buffer with 'm'
+    Mat *holder = new Mat(m);
+    PyObject *o = PyArray_New(
+        &PyArray_Type, ndims, sizes, typenum, strides, holder->data, 0, writable ? NPY_ARRAY_WRITEABLE : 0, nullptr);
+    if (!o) {
+        delete holder;
+        return nullptr;
+    }
+
+    PyObject *capsule = PyCapsule_New(holder, "cv::Mat", releaseMatCapsule);
+    if (!capsule) {
+        delete holder;
+        Py_DECREF(o);
+        return nullptr;
+    }
+    // steals the capsule reference
+    if (PyArray_SetBaseObject((PyArrayObject *)o, capsule) < 0) {
+        Py_DECREF(o);
+        return nullptr;
+    }
+
+    return o;
+}
+
 // warn about old-style casts again
 #pragma GCC diagnostic pop
@@ -30,6 +30,10 @@ public:
 
     static bool toMat(PyObject *o, cv::Mat &m);
     static PyObject *toNDArray(const cv::Mat &mat);
+
+    // wraps the matrix data in a NumPy array without copying it, the array
+    // keeps a reference on the matrix buffer for as long as it is alive
+    static PyObject *toNDArrayView(const cv::Mat &mat);
 };
 
 namespace pybind11
@@ -49,7 +53,7 @@ public:
 
     static handle cast(const cv::Mat &m, return_value_policy, handle)
     {
-        return handle(NDArrayConverter::toNDArray(m));
+        return handle(NDArrayConverter::toNDArrayView(m));
     }
 };
 } // namespace detail
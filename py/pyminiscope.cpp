@@ -19,10 +19,15 @@
 
 #include <string>
 #include <sstream>
+#include <memory>
+#include <mutex>
+#include <condition_variable>
+#include <chrono>
 
 #include <pybind11/pybind11.h>
 #include <pybind11/stl_bind.h>
 #include <pybind11/chrono.h>
+#include <QDir>
 #include "qstringtopy.h"
 #include "cvmatndsliceconvert.h"
 #include "miniscope.h"
@@ -33,6 +38,170 @@ namespace py = pybind11;
 PYBIND11_MAKE_OPAQUE(std::vector<ControlDefinition>);
 PYBIND11_MAKE_OPAQUE(std::vector<double>);
 
+/**
+ * @brief Handle for a Z-stack task running in the background
+ *
+ * Progress and completion are tracked via direct connections to the task's
+ * progress emitter, so this works without a running Qt event loop.
+ */
+class ZStackTask
+{
+public:
+    explicit ZStackTask(const QString &outputPath)
+        : m_emitter(std::make_unique<TaskProgressEmitter>()),
+          m_outputPath(outputPath),
+          m_progress(0),
+          m_finished(false)
+    {
+        QObject::connect(
+            m_emitter.get(),
+            &TaskProgressEmitter::progress,
+            m_emitter.get(),
+            [this](int value) {
+                m_progress = value;
+            },
+            Qt::DirectConnection);
+        QObject::connect(
+            m_emitter.get(),
+            &TaskProgressEmitter::finished,
+            m_emitter.get(),
+            [this]() {
+                std::lock_guard<std::mutex> lock(m_mutex);
+                m_finished = true;
+                m_finishedCond.notify_all();
+            },
+            Qt::DirectConnection);
+    }
+
+    ~ZStackTask()
+    {
+        // the task still references our progress emitter, so it must not outlive us
+        cancel();
+        try {
+            m_future.waitForFinished();
+        } catch (...) {
+        }
+    }
+
+    TaskProgressEmitter *emitter() const
+    {
+        return m_emitter.get();
+    }
+
+    void setFuture(const QFuture<void> &future)
+    {
+        m_future = future;
+    }
+
+    int progress() const
+    {
+        return m_progress;
+    }
+
+    bool isDone() const
+    {
+        return m_finished;
+    }
+
+    void cancel()
+    {
+        m_emitter->requestCancel();
+    }
+
+    bool wait(const milliseconds_t &timeout)
+    {
+        std::unique_lock<std::mutex> lock(m_mutex);
+        if (timeout.count() < 0) {
+            m_finishedCond.wait(lock, [this] {
+                return m_finished.load();
+            });
+            return true;
+        }
+
+        return m_finishedCond.wait_for(lock, timeout, [this] {
+            return m_finished.load();
+        });
+    }
+
+    QString result()
+    {
+        std::string error;
+        {
+            py::gil_scoped_release release;
+            try {
+                m_future.waitForFinished();
+            } catch (const std::exception &e) {
+                error = e.what();
+            } catch (...) {
+                error = "Z-Stack task failed with an unknown error.";
+            }
+        }
+
+        if (!error.empty())
+            throw std::runtime_error(error);
+        return m_outputPath;
+    }
+
+private:
+    std::unique_ptr<TaskProgressEmitter> m_emitter;
+    QFuture<void> m_future;
+    QString m_outputPath;
+
+    std::atomic_int m_progress;
+    std::atomic_bool m_finished;
+    std::mutex m_mutex;
+    std::condition_variable m_finishedCond;
+};
+
+static py::object matOrNone(const cv::Mat &mat)
+{
+    if (mat.empty())
+        return py::none();
+    return py::cast(mat);
+}
+
+static py::object timedFrameOrNone(const TimedFrame &frame)
+{
+    if (frame.mat.empty())
+        return py::none();
+    return py::cast(frame);
+}
+
+/**
+ * @brief Time @p repeat conversions of the NumPy array @p array to a matrix, in seconds.
+ */
+static double benchToMat(py::handle array, uint repeat)
+{
+    const auto start = std::chrono::steady_clock::now();
+    for (uint i = 0; i < repeat; i++) {
+        cv::Mat mat;
+        if (!NDArrayConverter::toMat(array.ptr(), mat))
+            throw py::error_already_set();
+    }
+    return std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+}
+
+/**
+ * @brief Time @p repeat conversions of the matrix @p mat to a NumPy array, in seconds.
+ *
+ * With @p copy, the data is copied into a new array, otherwise the array is a view
+ * on the matrix, like the frames returned by the Miniscope.
+ */
+static double benchToNDArray(const cv::Mat &mat, uint repeat, bool copy)
+{
+    // frames from the capture thread are allocated by OpenCV, not by NumPy
+    const cv::Mat frame = mat.clone();
+
+    const auto start = std::chrono::steady_clock::now();
+    for (uint i = 0; i < repeat; i++) {
+        PyObject *array = copy ? NDArrayConverter::toNDArray(frame) : NDArrayConverter::toNDArrayView(frame);
+        if (array == nullptr)
+            throw py::error_already_set();
+        Py_DECREF(array);
+    }
+    return std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+}
+
 PYBIND11_MODULE(miniscope, m)
 {
     m.doc() = "Access a Miniscope through Python"; // optional module docstring
@@ -59,6 +228,11 @@ PYBIND11_MODULE(miniscope, m)
         .value("RAW_FRAMES", DisplayMode::RawFrames)
         .value("BACKGROUND_DIFF", DisplayMode::BackgroundDiff);
 
+    py::enum_<EncoderThreading>(m, "EncoderThreading", py::arithmetic())
+        .value("AUTO", EncoderThreading::Auto)
+        .value("SLICE", EncoderThreading::Slice)
+        .value("FRAME", EncoderThreading::Frame);
+
     py::enum_<ControlKind>(m, "ControlKind", py::arithmetic())
         .value("UNKNOWN", ControlKind::Unknown)
         .value("SELECTOR", ControlKind::Selector)
@@ -81,7 +255,115 @@ PYBIND11_MODULE(miniscope, m)
             &ControlDefinition::labels,
             "Labels for individual values (mostly used for ControlKind.SELECTOR types, their index can be set as "
             "control value)")
-        .def_readwrite("values", &ControlDefinition::values, "Possible values for this control");
+        .def_readwrite("values", &ControlDefinition::values, "Possible values for this control")
+
+        .def_readwrite(
+            "settle_frames",
+            &ControlDefinition::settleFrames,
+            "Number of frames to wait after a value change before images reflect it")
+        .def_readwrite(
+            "settle_max_frames",
+            &ControlDefinition::settleMaxFrames,
+            "Maximum number of frames to additionally wait for the image brightness to converge")
+        .def_readwrite(
+            "settle_tolerance",
+            &ControlDefinition::settleTolerance,
+            "Relative change of the mean brightness between frames below which the image is considered settled "
+            "(0 disables the convergence check)");
+
+    py::class_<FrameStats>(m, "FrameStats")
+        .def_readonly("min", &FrameStats::min, "Smallest pixel value")
+        .def_readonly("max", &FrameStats::max, "Largest pixel value")
+        .def_readonly("mean", &FrameStats::mean, "Mean pixel value")
+        .def_property_readonly(
+            "histogram",
+            [](const FrameStats &s) {
+                py::list hist;
+                for (const auto &count : s.histogram)
+                    hist.append(count);
+                return hist;
+            },
+            "Pixel value histogram, 16 bins of 16 values each")
+        .def_readonly(
+            "sharpness",
+            &FrameStats::sharpness,
+            "Mean squared difference between neighboring pixels, higher values mean a sharper image")
+        .def_readonly("blank", &FrameStats::blank, "Is True if no pixel is brighter than the blank threshold");
+
+    py::class_<TimedFrame>(m, "TimedFrame")
+        .def_readonly("frame", &TimedFrame::mat, "The image")
+        .def_readonly("stats", &TimedFrame::stats, "Statistics of the raw frame, as FrameStats")
+        .def_readonly("seq", &TimedFrame::seq, "Sequence number, increases by one with every frame")
+        .def_readonly("timestamp", &TimedFrame::timestamp, "Timestamp of the frame")
+        .def_property_readonly(
+            "capture_time",
+            [](const TimedFrame &f) {
+                return std::chrono::duration<double>(f.captureTime.time_since_epoch()).count();
+            },
+            "Time the frame was received, in seconds on the monotonic clock (like time.monotonic())");
+
+    py::class_<FrameAverage>(m, "FrameAverage")
+        .def_property_readonly(
+            "mean",
+            [](const FrameAverage &a) {
+                return matOrNone(a.mean);
+            },
+            "Mean image, or None if no frame was averaged")
+        .def_property_readonly(
+            "max",
+            [](const FrameAverage &a) {
+                return matOrNone(a.max);
+            },
+            "Per-pixel maximum, or None if it was not requested")
+        .def_property_readonly(
+            "variance",
+            [](const FrameAverage &a) {
+                return matOrNone(a.variance);
+            },
+            "Per-pixel variance as float32 image, or None if it was not requested")
+        .def_readonly("count", &FrameAverage::count, "Number of frames that were averaged")
+        .def_readonly("blank_count", &FrameAverage::blankCount, "Number of averaged frames that were blank")
+        .def_readonly("first_seq", &FrameAverage::firstSeq, "Sequence number of the first averaged frame")
+        .def_readonly("last_seq", &FrameAverage::lastSeq, "Sequence number of the last averaged frame")
+        .def_readonly("stats", &FrameAverage::stats, "Statistics of the mean image, as FrameStats");
+
+    py::class_<EncoderStats>(m, "EncoderStats")
+        .def_readonly("queue_depth", &EncoderStats::queueDepth, "Number of frames waiting to be encoded")
+        .def_readonly(
+            "max_queue_depth",
+            &EncoderStats::maxQueueDepth,
+            "Largest number of waiting frames since the recording started")
+        .def_readonly("encoded_frames", &EncoderStats::encodedFrames, "Number of frames written to the video")
+        .def_readonly(
+            "dropped_frames",
+            &EncoderStats::droppedFrames,
+            "Number of frames that were not encoded, because the queue was full or the encoder failed")
+        .def_readonly(
+            "last_latency_ms",
+            &EncoderStats::lastLatencyMs,
+            "Time from pushing the last frame until it was written, in milliseconds")
+        .def_readonly("mean_latency_ms", &EncoderStats::meanLatencyMs, "Mean encode latency in milliseconds")
+        .def_readonly("max_latency_ms", &EncoderStats::maxLatencyMs, "Largest encode latency in milliseconds");
+
+    py::class_<ZStackTask>(m, "ZStackTask")
+        .def_property_readonly("progress", &ZStackTask::progress, "Progress of the task in percent")
+        .def_property_readonly("done", &ZStackTask::isDone, "Is True once the task has finished or failed")
+        .def(
+            "cancel",
+            &ZStackTask::cancel,
+            "Ask the task to stop before acquiring the next plane. The result will then raise an error.")
+        .def(
+            "wait",
+            &ZStackTask::wait,
+            py::arg("timeout") = milliseconds_t(-1),
+            py::call_guard<py::gil_scoped_release>(),
+            "Wait up to timeout (seconds or timedelta, wait forever if negative) for the task to finish. Returns "
+            "True if it finished.")
+        .def(
+            "result",
+            &ZStackTask::result,
+            "Wait for the task to finish and return the path of the written TIFF stack. Raises RuntimeError if "
+            "the task failed or was cancelled.");
 
     py::class_<Miniscope>(m, "Miniscope")
         .def(py::init<>())
@@ -107,7 +389,51 @@ PYBIND11_MODULE(miniscope, m)
         .def("start_recording", &Miniscope::startRecording, "Start recording a video file")
         .def("stop_recording", &Miniscope::stopRecording, "Finish the current recording")
 
-        // .def("capture_zstack", &captureZStack, "Capture a Z-stack")
+        .def(
+            "capture_zstack",
+            [](Miniscope &self, int fromEWL, int toEWL, uint step, uint averageCount, const QString &outFilename) {
+                QString outFilenameReal = outFilename;
+                if (!outFilename.endsWith(".tiff") && !outFilename.endsWith(".tif"))
+                    outFilenameReal = QStringLiteral("%1.tiff").arg(outFilename);
+
+                auto task = std::make_unique<ZStackTask>(outFilenameReal);
+                task->setFuture(
+                    self.acquireZStack(fromEWL, toEWL, step, averageCount, outFilename, task->emitter()));
+                return task;
+            },
+            py::arg("from_ewl"),
+            py::arg("to_ewl"),
+            py::arg("step"),
+            py::arg("average_count"),
+            py::arg("out_filename"),
+            py::keep_alive<0, 1>(),
+            "Capture a Z-stack into a multi-page TIFF file in the background, returns a ZStackTask")
+        .def(
+            "accumulate_3d_view",
+            [](Miniscope &self,
+               int fromEWL,
+               int toEWL,
+               uint step,
+               uint count,
+               bool saveRaw,
+               const QString &outDir,
+               const QString &outName) {
+                auto task = std::make_unique<ZStackTask>(
+                    QStringLiteral("%1/%2/%2_mip3D.tiff").arg(QDir(outDir).absolutePath(), outName));
+                task->setFuture(
+                    self.accumulate3DView(fromEWL, toEWL, step, count, saveRaw, outDir, outName, task->emitter()));
+                return task;
+            },
+            py::arg("from_ewl"),
+            py::arg("to_ewl"),
+            py::arg("step"),
+            py::arg("count"),
+            py::arg("save_raw"),
+            py::arg("out_dir"),
+            py::arg("out_name"),
+            py::keep_alive<0, 1>(),
+            "Acquire multiple Z-stacks and compute a brightness-balanced 3D maximum intensity projection in the "
+            "background, returns a ZStackTask")
 
         .def_property_readonly("controls", &Miniscope::controls, "Get available controls for this device")
         .def("control_value", &Miniscope::controlValue, "Retrieve current control value for the given control ID")
@@ -130,8 +456,89 @@ PYBIND11_MODULE(miniscope, m)
             "current_disp_frame",
             &Miniscope::currentDisplayFrame,
             "Retrieve the current frame intended for display. May not be the recorded frame.")
+        .def(
+            "wait_for_frame",
+            &Miniscope::waitForDisplayFrame,
+            py::arg("timeout") = milliseconds_t(1000),
+            py::call_guard<py::gil_scoped_release>(),
+            "Wait up to timeout (seconds or timedelta) for the next frame intended for display. Returns None if no "
+            "frame arrived in time or acquisition stopped.")
+        .def_property_readonly(
+            "latest_frame",
+            [](Miniscope &self) {
+                return timedFrameOrNone(self.latestFrame());
+            },
+            "The newest frame as TimedFrame, or None. Does not consume frames from the display queue.")
+        .def_property_readonly("frame_seq", &Miniscope::frameSeq, "Sequence number of the newest frame")
+        .def(
+            "wait_for_frame_after",
+            [](Miniscope &self, quint64 seq, const milliseconds_t &timeout) {
+                TimedFrame frame;
+                {
+                    py::gil_scoped_release release;
+                    frame = self.waitForFrameAfter(seq, timeout);
+                }
+                return timedFrameOrNone(frame);
+            },
+            py::arg("seq"),
+            py::arg("timeout") = milliseconds_t(1000),
+            "Wait up to timeout for the first frame with a sequence number above seq, and return it as TimedFrame. "
+            "Returns None if no frame arrived in time or acquisition stopped.")
+        .def(
+            "wait_for_frame_after_time",
+            [](Miniscope &self, double time, const milliseconds_t &timeout) {
+                const auto timePoint = std::chrono::steady_clock::time_point(
+                    std::chrono::duration_cast<std::chrono::steady_clock::duration>(
+                        std::chrono::duration<double>(time)));
+                TimedFrame frame;
+                {
+                    py::gil_scoped_release release;
+                    frame = self.waitForFrameAfterTime(timePoint, timeout);
+                }
+                return timedFrameOrNone(frame);
+            },
+            py::arg("time"),
+            py::arg("timeout") = milliseconds_t(1000),
+            "Wait up to timeout for the first frame captured after time (seconds on the monotonic clock, like "
+            "time.monotonic()), and return it as TimedFrame. Returns None if no frame arrived in time.")
+        .def(
+            "average_frames",
+            [](Miniscope &self,
+               uint count,
+               py::object afterSeq,
+               bool withMax,
+               bool withVariance,
+               const milliseconds_t &timeout) {
+                const quint64 seq = afterSeq.is_none() ? self.frameSeq() : afterSeq.cast<quint64>();
+                py::gil_scoped_release release;
+                return self.averageFrames(count, seq, withMax, withVariance, timeout);
+            },
+            py::arg("count"),
+            py::arg("after_seq") = py::none(),
+            py::arg("with_max") = false,
+            py::arg("with_variance") = false,
+            py::arg("timeout") = milliseconds_t(1000),
+            "Average the next count frames with a sequence number above after_seq (by default the newest frame) in "
+            "native code, and return a FrameAverage. timeout applies to each frame. If acquisition stops, the "
+            "average has fewer frames than requested.")
+        .def_property_readonly(
+            "acquired_frame_count", &Miniscope::acquiredFrameCount, "Number of frames acquired by the DAQ box")
+        .def(
+            "wait_for_acquired_frame_count",
+            &Miniscope::waitForAcquiredFrameCount,
+            py::arg("count"),
+            py::call_guard<py::gil_scoped_release>(),
+            "Block until the given number of new frames were acquired")
         .def_property_readonly("current_fps", &Miniscope::currentFps)
         .def_property_readonly("dropped_frames_count", &Miniscope::droppedFramesCount)
+        .def_property_readonly(
+            "capture_cycle_time",
+            &Miniscope::captureCycleTime,
+            "Duration of the last capture thread cycle, from grabbing a frame to queueing it")
+        .def_property_readonly(
+            "encode_queue_depth",
+            &Miniscope::encodeQueueDepth,
+            "Number of recorded frames waiting for the video encoder")
         .def_property_readonly("last_recorded_frame_time", &Miniscope::lastRecordedFrameTime)
 
         .def_property(
@@ -144,6 +551,20 @@ PYBIND11_MODULE(miniscope, m)
             &Miniscope::recordLossless,
             &Miniscope::setRecordLossless,
             "Toggle lossless recording, if the codec supports it")
+        .def_property(
+            "encoder_threads",
+            &Miniscope::encoderThreads,
+            &Miniscope::setEncoderThreads,
+            "Number of threads the video encoder may use, 0 for one per CPU core, 1 (the default) for the codec defaults")
+        .def_property(
+            "encoder_threading",
+            &Miniscope::encoderThreading,
+            &Miniscope::setEncoderThreading,
+            "Whether the encoder threads work on slices of a frame or on several frames at once")
+        .def_property_readonly(
+            "encoder_stats",
+            &Miniscope::encoderStats,
+            "Queue and latency counters of the video encoder, as EncoderStats")
 
         .def_property(
             "min_fluor_display",
@@ -155,6 +576,11 @@ PYBIND11_MODULE(miniscope, m)
             &Miniscope::maxFluorDisplay,
             &Miniscope::setMaxFluorDisplay,
             "Maximum fluorescence to display")
+        .def_property(
+            "blank_threshold",
+            &Miniscope::blankThreshold,
+            &Miniscope::setBlankThreshold,
+            "Frames without a pixel brighter than this value are flagged as blank in their stats")
         .def_property_readonly(
             "min_fluor", &Miniscope::minFluor, "Minimum fluorescence (pixel value) in the current image")
         .def_property_readonly(
@@ -193,4 +619,20 @@ PYBIND11_MODULE(miniscope, m)
             &Miniscope::setPrintExtraDebug,
             "Set whether protocol transmission debug messages should be printed to stdout")
         .def_property_readonly("last_error", &Miniscope::lastError, "Message of the last error, if there was one");
+
+    // hooks for timelapse/mscopebench.py, not part of the API
+    py::module_ bench = m.def_submodule("_bench", "Benchmarks of the native conversions");
+    bench.def(
+        "to_mat",
+        &benchToMat,
+        py::arg("array"),
+        py::arg("repeat"),
+        "Time converting a NumPy array to a cv::Mat 'repeat' times, in seconds");
+    bench.def(
+        "to_ndarray",
+        &benchToNDArray,
+        py::arg("array"),
+        py::arg("repeat"),
+        py::arg("copy") = false,
+        "Time converting a cv::Mat to a NumPy array (a view, or a copy with 'copy') 'repeat' times, in seconds");
 }
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# benchmarks of the capture, conversion, image writing and encoding hot paths of the time lapse
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import cv2
+
+from mscopesim import SimulatedMiniscope
+from mscopewriter import ImageWriter, write_file, encode_and_write_stack
+from mscopeindex import ImageIndex
+from mscopecontrol import get_frame_after
+from mscopecorrect import FlatFieldCorrector
+import timelapse
+
+import logging
+logger = logging.getLogger(__name__)
+
+# stored results to compare against, next to this script
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+# a benchmark whose median is this much slower than its baseline counts as a regression
+DEFAULT_TOLERANCE = 0.25
+# frame size of the Miniscope V4
+FRAME_WIDTH = 608
+FRAME_HEIGHT = 608
+
+def make_frame(width = FRAME_WIDTH, height = FRAME_HEIGHT, seed = 0):
+    '''Synthetic 8 bit frame with blobs and noise, which compresses about as well as a real one.'''
+    rng = np.random.default_rng(seed)
+    frame = np.zeros((height, width), dtype = np.float32)
+    for i in range(40):
+        cv2.circle(frame, (int(rng.integers(width)), int(rng.integers(height))), int(rng.integers(5, 30)), float(rng.uniform(60, 200)), -1)
+    frame = cv2.GaussianBlur(frame, (0, 0), 6) + rng.normal(20, 3, frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+def measure(func, repeat, warmup = 1):
+    '''Call 'func' 'warmup' + 'repeat' times and return the durations of the last 'repeat' calls in seconds.'''
+    for i in range(warmup):
+        func()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+def summarize(times, unit = 'sec'):
+    '''Reduce the durations of a benchmark to its median, 95th percentile and minimum.'''
+    times = np.array(times)
+    return {'median': float(np.median(times)),
+            'p95': float(np.percentile(times, 95)),
+            'min': float(np.min(times)),
+            'runs': len(times),
+            'unit': unit}
+
+def bench_convert(repeat):
+    '''cv::Mat <-> NumPy conversion of pyminiscope, timed in native code. Needs the compiled miniscope module.'''
+    try:
+        from miniscope import _bench
+    except ImportError:
+        logger.warning('Skipping convert benchmarks, the compiled miniscope module is not available')
+        return {}
+
+    frame = make_frame()
+    count = 1000
+    results = {}
+    results['convert_to_mat'] = summarize([_bench.to_mat(frame, count) / count for i in range(repeat)])
+    results['convert_to_ndarray_view'] = summarize([_bench.to_ndarray(frame, count) / count for i in range(repeat)])
+    results['convert_to_ndarray_copy'] = summarize([_bench.to_ndarray(frame, count, copy = True) / count for i in range(repeat)])
+    return results
+
+def bench_dequeue(repeat, scope_factory):
+    '''Latency of getting a frame out of a running Miniscope: the cost of a current_disp_frame call, and the time
+    from the capture of a frame to wait_for_frame_after returning it.'''
+    m = timelapse.connect_miniscope(scope_factory, 0)
+    try:
+        # the display queue is empty most of the time, so this is the cost of the call itself
+        calls = measure(lambda: m.current_disp_frame, repeat * 10)
+
+        latencies = []
+        seq = m.frame_seq
+        while len(latencies) < repeat:
+            tf = get_frame_after(m, seq)
+            if tf is None:
+                raise RuntimeError('The Miniscope stopped delivering frames: ' + m.last_error)
+            latencies.append(time.monotonic() - tf.capture_time)
+            seq = tf.seq
+    finally:
+        timelapse.disconnect_miniscope(m)
+
+    return {'dequeue_current_disp_frame': summarize(calls),
+            'dequeue_capture_to_python': summarize(latencies)}
+
+def bench_imwrite(repeat, out_dir, planes = 25):
+    '''Encoding and writing (with fsync) a photo like the ImageWriter does for take_zstack, per image format,
+    and a z-stack of 'planes' photos as a multi-page TIFF for the 'stack' layout.'''
+    frame = make_frame()
+    results = {}
+    for img_format in ['png', 'tiff', 'jpg']:
+        path = os.path.join(out_dir, 'bench.' + img_format)
+        def write():
+            ok, buf = cv2.imencode('.' + img_format, frame)
+            write_file(path, buf)
+        results['imwrite_' + img_format] = summarize(measure(write, repeat))
+
+    frames = [make_frame(seed = i) for i in range(planes)]
+    path = os.path.join(out_dir, 'bench_stack.tiff')
+    results['imwrite_stack_' + str(planes)] = summarize(measure(lambda: encode_and_write_stack(path, frames), max(1, repeat // 10)))
+    return results
+
+def bench_correct(repeat):
+    '''Dark frame and flat-field correction of a photo, and of a 25-plane z-stack at once.'''
+    frame = make_frame()
+    ys, xs = np.mgrid[0:FRAME_HEIGHT, 0:FRAME_WIDTH].astype(np.float32)
+    illumination = 1.0 - 0.35 * (((xs - FRAME_WIDTH / 2) / FRAME_WIDTH) ** 2 + ((ys - FRAME_HEIGHT / 2) / FRAME_HEIGHT) ** 2)
+    corrector = FlatFieldCorrector()
+    corrector.set_references(0, 20, np.full(frame.shape, 5, np.float32), illumination * 100)
+    stack = np.stack([make_frame(seed = i) for i in range(25)])
+    return {'correct_frame': summarize(measure(lambda: corrector.correct(frame, 0, 20), repeat * 10)),
+            'correct_stack_25': summarize(measure(lambda: corrector.correct(stack, 0, 20), repeat))}
+
+def bench_zstack(repeat, out_dir, scope_factory, zstack = (-60, 60, 10)):
+    '''End to end time of take_zstack against a synthetic frame source, with background image writing
+    and indexing, from the first focus change until all images are on disk.'''
+    zparams = timelapse.zstack_to_zparams(zstack)
+    m = timelapse.connect_miniscope(scope_factory, 0)
+    writer = ImageWriter()
+    index = ImageIndex(os.path.join(out_dir, 'bench_index.sqlite'))
+    step = [0]
+    def shoot():
+        if not timelapse.take_zstack(m, out_dir, step[0], zparams, 20, 0, index, 'png', writer):
+            raise RuntimeError('The z-stack failed')
+        writer.flush()
+        step[0] += 1
+
+    try:
+        timelapse.set_led(m, 20)
+        timelapse.warm_up_miniscope(m)
+        times = measure(shoot, repeat)
+    finally:
+        writer.close()
+        index.close()
+        timelapse.disconnect_miniscope(m)
+
+    return {'zstack_' + str(timelapse.count_planes(zparams)) + '_planes': summarize(times)}
+
+def bench_encode(videowriter_bench, frames = 600, threads = 1):
+    '''VideoWriter throughput per codec at the Miniscope resolutions, by running the native videowriter-bench
+    (built with -DBENCHMARKS=ON) with 'threads' encoder threads (0 for one per core). Reported as seconds per frame.'''
+    if videowriter_bench is None:
+        logger.warning('Skipping encode benchmarks, pass the path of videowriter-bench with --videowriter-bench')
+        return {}
+
+    output = subprocess.run([videowriter_bench, str(frames), str(threads)], check = True, capture_output = True, text = True).stdout
+    results = {}
+    for line in output.splitlines():
+        if not line.startswith('{'):
+            continue
+        r = json.loads(line)
+        per_frame = r['seconds'] / r['frames']
+        results[r['name']] = {'median': per_frame, 'p95': per_frame, 'min': per_frame, 'runs': 1, 'unit': 'sec/frame'}
+    return results
+
+def machine_info():
+    return {'node': platform.node(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'cpus': os.cpu_count()}
+
+def read_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def write_baseline(path, results, old_baseline = None):
+    '''Store 'results' as the baseline, keeping the baselines of benchmarks that did not run this time.'''
+    benchmarks = dict(old_baseline['benchmarks']) if old_baseline is not None else {}
+    benchmarks.update(results)
+    with open(path, 'w') as f:
+        json.dump({'machine': machine_info(), 'benchmarks': benchmarks}, f, indent = 2, sort_keys = True)
+        f.write('\n')
+
+def compare(results, baseline, tolerance = DEFAULT_TOLERANCE):
+    '''Print every result next to its baseline. Returns the names of the benchmarks whose median is more than
+    'tolerance' slower than the baseline.'''
+    regressions = []
+    print('{:36} {:>12} {:>12} {:>8}'.format('benchmark', 'median', 'baseline', 'change'))
+    for name, r in sorted(results.items()):
+        base = baseline['benchmarks'].get(name) if baseline is not None else None
+        if base is None:
+            print('{:36} {:>12.6f} {:>12} {:>8}'.format(name, r['median'], '-', ''))
+            continue
+        change = r['median'] / base['median'] - 1 if base['median'] > 0 else 0.0
+        flag = ''
+        if change > tolerance:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print('{:36} {:>12.6f} {:>12.6f} {:>+7.0%}{}'.format(name, r['median'], base['median'], change, flag))
+    return regressions
+
+def setup_parser(p):
+    help_only = '''Benchmark groups to run (convert, dequeue, imwrite, correct, zstack, encode). All by default.'''
+    help_repeat = '''Number of measured runs of each benchmark.'''
+    help_baseline = '''JSON file with the baseline results to compare against.'''
+    help_update = '''Store the results as the new baseline instead of failing on regressions.'''
+    help_tolerance = '''Fraction by which a median may be slower than its baseline before it counts as a regression.'''
+    help_hardware = '''Run the dequeue and z-stack benchmarks against the Miniscope on the DAQ box
+                instead of the simulated one.'''
+    help_vwb = '''Path of the native videowriter-bench executable, built with -DBENCHMARKS=ON.'''
+    help_threads = '''Number of encoder threads for the encode benchmarks, 0 for one per CPU core. Default 1, which keeps the codec defaults.'''
+
+    p.add_argument('--only', type = str, nargs = '+', default = None, help = help_only)
+    p.add_argument('--repeat', type = int, default = 20, help = help_repeat)
+    p.add_argument('--baseline', type = str, default = BASELINE_PATH, help = help_baseline)
+    p.add_argument('--update-baseline', action = 'store_true', default = False, help = help_update)
+    p.add_argument('--tolerance', type = float, default = DEFAULT_TOLERANCE, help = help_tolerance)
+    p.add_argument('--hardware', action = 'store_true', default = False, help = help_hardware)
+    p.add_argument('--videowriter-bench', type = str, default = None, help = help_vwb)
+    p.add_argument('--encoder-threads', type = int, default = 1, help = help_threads)
+
+def main():
+    parser = argparse.ArgumentParser()
+    setup_parser(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.WARNING)
+
+    if args.hardware:
+        if timelapse.Miniscope is None:
+            parser.error('the compiled miniscope module could not be imported, --hardware is not available.')
+        scope_factory = timelapse.Miniscope
+    else:
+        # fast enough that the benchmarks measure our code rather than the frame rate
+        scope_factory = lambda: SimulatedMiniscope(fps = 200, warmup_frames = 10)
+
+    groups = args.only if args.only is not None else ['convert', 'dequeue', 'imwrite', 'correct', 'zstack', 'encode']
+    results = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        for group in groups:
+            if group == 'convert':
+                results.update(bench_convert(args.repeat))
+            elif group == 'dequeue':
+                results.update(bench_dequeue(args.repeat, scope_factory))
+            elif group == 'imwrite':
+                results.update(bench_imwrite(args.repeat, out_dir))
+            elif group == 'correct':
+                results.update(bench_correct(args.repeat))
+            elif group == 'zstack':
+                results.update(bench_zstack(max(1, args.repeat // 4), out_dir, scope_factory))
+            elif group == 'encode':
+                results.update(bench_encode(args.videowriter_bench, threads = args.encoder_threads))
+            else:
+                parser.error('unknown benchmark group: ' + group)
+
+    baseline = read_baseline(args.baseline)
+    if baseline is not None and baseline.get('machine', {}).get('node') != platform.node():
+        logger.warning('The baseline was recorded on ' + str(baseline.get('machine', {}).get('node')) + ', results may not be comparable')
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.update_baseline:
+        write_baseline(args.baseline, results, baseline)
+        print('Baseline written to ' + args.baseline)
+    elif len(regressions) > 0:
+        print('Regressions: ' + ', '.join(regressions))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import cv2
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# frames are compared at this width, which is plenty to see the sample change and averages out the shot noise
+DEFAULT_COMPARE_WIDTH = 64
+# number of the sharpest planes of a z-stack that are compared with the previous z-stack
+DEFAULT_FOCUS_PLANES = 3
+# below this change the period grows, above it the period drops to the minimum
+DEFAULT_LOW_CHANGE = 0.02
+DEFAULT_HIGH_CHANGE = 0.05
+# factor by which the period grows after a quiet z-stack
+DEFAULT_GROWTH = 1.5
+
+def downsample(frame, width = DEFAULT_COMPARE_WIDTH):
+    '''Shrink 'frame' to 'width' pixels wide by area averaging, scaled to a mean of 1 so a change of the overall
+    brightness, e.g. from bleaching, does not count as a change of the sample.'''
+    height = max(1, round(frame.shape[0] * width / frame.shape[1]))
+    small = cv2.resize(frame, (width, height), interpolation = cv2.INTER_AREA).astype(np.float32)
+    return small / max(float(small.mean()), 1.0)
+
+def change_metric(previous, current):
+    '''Mean absolute difference between the downsampled planes of two z-stacks, as dictionaries of z-index to
+    plane, over the planes of 'current' that 'previous' has too. None if they have no plane in common.'''
+    common = [z for z in current if z in previous]
+    if len(common) == 0:
+        return None
+    return float(np.mean([np.mean(np.abs(current[z] - previous[z])) for z in common]))
+
+class ChangeDetector:
+    '''Adapts the period of a time lapse to how fast the sample changes.
+
+    Every z-stack is compared with the previous one on its 'focus_planes' sharpest planes, downsampled to 'width'
+    pixels wide. If the change is above 'high', the period drops to 'min_period' right away, so a burst of activity
+    is not missed; below 'low', it grows by 'growth' up to 'max_period', so a quiet sample is shot less often.
+    The period starts at 'period_sec'.
+    '''
+
+    def __init__(self, period_sec, min_period, max_period, low = DEFAULT_LOW_CHANGE, high = DEFAULT_HIGH_CHANGE, \
+                 growth = DEFAULT_GROWTH, focus_planes = DEFAULT_FOCUS_PLANES, width = DEFAULT_COMPARE_WIDTH):
+        if not 0 < min_period <= period_sec <= max_period:
+            raise ValueError('The period must be between the minimum and maximum period.')
+        if low > high:
+            raise ValueError('The low change threshold must not be above the high one.')
+        self.period_sec = period_sec
+        self.min_period = min_period
+        self.max_period = max_period
+        self.low = low
+        self.high = high
+        self.growth = growth
+        self.focus_planes = focus_planes
+        self.width = width
+        self.last_change = None
+        self._previous = None # z-index -> downsampled plane of the previous z-stack
+
+    def add_stack(self, planes):
+        '''Compare the z-stack 'planes', as (z_index, sharpness, frame) tuples, with the previous one and
+        adapt the period. Returns the new period in seconds.'''
+        current = {z: downsample(frame, self.width) for z, sharpness, frame in planes}
+        previous = self._previous
+        self._previous = current
+        if previous is None:
+            return self.period_sec
+
+        in_focus = sorted(planes, key = lambda plane: -plane[1])[:self.focus_planes]
+        change = change_metric(previous, {z: current[z] for z, sharpness, frame in in_focus})
+        self.last_change = change
+
+        if change is None or change > self.high:
+            # without planes in common with the last z-stack, the focus moved a lot
+            period = self.min_period
+        elif change < self.low:
+            period = min(self.max_period, self.period_sec * self.growth)
+        else:
+            period = self.period_sec
+        if period != self.period_sec:
+            logger.info('Change since the last z-stack ' + ('unknown' if change is None else '{:.3f}'.format(change)) + \
+                        ', period {:.0f}s -> {:.0f}s'.format(self.period_sec, period))
+        self.period_sec = period
+        return period
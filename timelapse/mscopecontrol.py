@@ -1,4 +1,6 @@
-import time
+import asyncio
+
+from mscopetrace import span
 
 import logging
 logger = logging.getLogger(__name__)
@@ -8,40 +10,109 @@ logger = logging.getLogger(__name__)
 # gain - gain, default "Low"
 # frameRate - frame rate, default 30
 
+# used for controls that have no settle policy in miniscopes.json
+DEFAULT_SETTLE_FRAMES = 2
+
+def settle_policy(m, control_id):
+    '''Look up how long to wait for a change of control 'control_id' to show up in the images of the miniscope 'm'.
+    Returns a (frames, max_frames, tolerance) tuple, see the 'settle' entries in miniscopes.json.'''
+    for ctl in m.controls:
+        if ctl.id == control_id:
+            return (getattr(ctl, 'settle_frames', DEFAULT_SETTLE_FRAMES),
+                    getattr(ctl, 'settle_max_frames', 0),
+                    getattr(ctl, 'settle_tolerance', 0))
+    return (DEFAULT_SETTLE_FRAMES, 0, 0)
+
+def wait_for_settle(m, control_id, since_seq = None):
+    '''Wait until a change of control 'control_id' on the miniscope 'm' is visible in its frames.
+    'since_seq' is the frame sequence number from before the change, by default the newest frame.
+    First waits the fixed number of settle frames for the device to apply the value, then - if the control
+    has a tolerance - until the mean brightness of consecutive frames stops changing.
+    Returns a sequence number after which all frames show the new value, for take_photo.'''
+    if since_seq is None:
+        since_seq = m.frame_seq
+    with span('settle', control = control_id):
+        if not m.is_running:
+            return since_seq
+
+        frames, max_frames, tolerance = settle_policy(m, control_id)
+        # the first frames after the change may still have been taken with the old value
+        seq = since_seq + max(frames, 1) - 1
+        tf = get_frame_after(m, seq)
+        if tf is None:
+            return m.frame_seq
+        if tolerance <= 0:
+            return tf.seq - 1
+
+        prev_mean = tf.stats.mean
+        for i in range(max_frames):
+            tf = get_frame_after(m, tf.seq)
+            if tf is None:
+                return m.frame_seq
+
+            mean = tf.stats.mean
+            if abs(mean - prev_mean) <= tolerance * max(prev_mean, 1.0):
+                logger.debug('Control {} settled after {} frames'.format(control_id, tf.seq - since_seq))
+                return tf.seq - 1
+            prev_mean = mean
+
+        logger.debug('Control {} did not settle within {} frames'.format(control_id, tf.seq - since_seq))
+        return tf.seq
+
 def set_led(m, val):
-    '''Set the LED on the miniscope 'm' to the value 'val' (0 - 100).'''
+    '''Set the LED on the miniscope 'm' to the value 'val' (0 - 100).
+    Returns the sequence number after which frames show the new value.'''
     if 0 <= val <= 100:
-        time.sleep(1)
         logger.info('Setting LED excitation to {}'.format(val))
+        seq = m.frame_seq
         m.set_control_value('led0', val)
-        # time.sleep(1)
+        return wait_for_settle(m, 'led0', seq)
     else:
         logger.error("Please input a value between 0 and 100.")
 
 def set_focus(m, val):
-    '''Set the focus/EWL on the miniscope 'm' to the value 'val' (-127 - +127).'''
+    '''Set the focus/EWL on the miniscope 'm' to the value 'val' (-127 - +127).
+    Returns the sequence number after which frames show the new value.'''
     if -127 <= val <= 127:
-        time.sleep(1)
         logger.info('Setting working distance to {}'.format(val))
+        seq = m.frame_seq
         m.set_control_value('ewl', val)
-        # time.sleep(1)
+        return wait_for_settle(m, 'ewl', seq)
     else:
         logger.error("Please input a value between -127 and 127.")
 
 def set_gain(m, val):
     '''Set the gain on the miniscope 'm' to the value 'val' (0 - 2).
-    0 --> 'Low', 1 --> 'Medium', 2 --> 'High'.'''
+    0 --> 'Low', 1 --> 'Medium', 2 --> 'High'.
+    Returns the sequence number after which frames show the new value.'''
     if 0 <= val <= 2:
-        time.sleep(1)
         logger.info('Setting gain to {}'.format(val))
+        seq = m.frame_seq
         m.set_control_value('gain', val)
-        # time.sleep(1)
+        return wait_for_settle(m, 'gain', seq)
     else:
         logger.error("Please input a value between 0 and 2.")
 
-def get_frame(m):
-    '''Get the current frame from the miniscope 'm'.'''
-    time.sleep(0.1)
-    frame = m.current_disp_frame
-    # time.sleep(0.05)
-    return frame
+def get_frame_after(m, seq, timeout = 1.0):
+    '''Get the first frame from the miniscope 'm' with a sequence number above 'seq', as a TimedFrame with
+    'frame', 'seq', 'timestamp' and 'capture_time'. This never returns frames that were captured before 'seq',
+    no matter how many frames queued up. Returns None if no frame arrived within 'timeout' seconds.'''
+    return m.wait_for_frame_after(seq, timeout)
+
+async def wait_task(task, on_progress = None, poll_interval = 0.1):
+    '''Await a background z-stack task (from capture_zstack or accumulate_3d_view) without blocking the event loop.
+    'on_progress' is called with the progress in percent whenever it changes. If the awaiting coroutine
+    is cancelled, the task is cancelled as well. Returns the path of the written TIFF stack.'''
+    last_progress = None
+    try:
+        while not task.done:
+            # the native wait releases the GIL, so the worker thread does not hold up the interpreter
+            await asyncio.to_thread(task.wait, poll_interval)
+            if on_progress is not None and task.progress != last_progress:
+                last_progress = task.progress
+                on_progress(last_progress)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+    return task.result()
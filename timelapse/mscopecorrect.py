@@ -0,0 +1,144 @@
+import os
+import numpy as np
+import cv2
+
+from mscopecontrol import set_led, set_focus
+
+import logging
+logger = logging.getLogger(__name__)
+
+# sub-directory of the time lapse with the dark and flat references, as float32 TIFFs
+REFERENCE_DIRNAME = 'references'
+# when to capture the references: once for the whole time lapse, or again after every new connection
+CORRECT_RUN = 'run'
+CORRECT_CONNECTION = 'connection'
+CORRECT_MODES = [CORRECT_RUN, CORRECT_CONNECTION]
+
+# frames averaged into every dark and flat reference
+DEFAULT_REFERENCE_FRAMES = 16
+# the captured flat is smoothed by a Gaussian of this fraction of the frame width, which removes the sample
+# and keeps the slow illumination falloff
+FLAT_SMOOTHING = 1 / 16
+# limit of the correction gain, so the darkest corners are not amplified into noise
+MAX_GAIN = 4.0
+
+def gain_map(illumination):
+    '''Correction gain of every pixel from the 'illumination', a flat frame of a uniform sample with the dark frame
+    subtracted: its mean divided by the value of the pixel, so the corrected flat is uniform.'''
+    signal = np.maximum(illumination.astype(np.float32), 1e-3)
+    gains = float(signal.mean()) / signal
+    np.minimum(gains, MAX_GAIN, out = gains)
+    return gains
+
+def smooth_flat(flat):
+    '''Remove the sample from a frame used as flat reference, keeping only the illumination.'''
+    return cv2.GaussianBlur(flat.astype(np.float32), (0, 0), max(1.0, flat.shape[1] * FLAT_SMOOTHING))
+
+class FlatFieldCorrector:
+    '''Dark frame and flat-field correction of the planes saved by the time lapse.
+
+    corrected = (raw - dark) * gain, with the dark frame captured with the LED off and the gain map from a flat
+    reference (see gain_map). The references are captured with capture() for every (gain, LED) setting, and the
+    maps are computed once per setting and kept. Without a measured flat image 'flat', the flat reference is the
+    mean of the planes at both ends of the z-stack, smoothed after subtracting the dark frame until only the
+    illumination is left. The dark frame and illumination are saved in 'reference_dir', and picked up again from
+    there, e.g. by a resumed time lapse.
+
+    correct() works in one float32 buffer that is reused for every frame, so correcting a plane only allocates
+    its output. Not safe to use from several threads, every device of a multi-device time lapse has its own.
+    '''
+
+    def __init__(self, reference_dir = None, flat = None, frames = DEFAULT_REFERENCE_FRAMES):
+        self.reference_dir = reference_dir
+        self.flat = flat
+        self.frames = frames
+        self._maps = {} # (gain, led) -> (dark frame, gain map)
+        self._scratch = None
+
+    def _reference_paths(self, gain, led):
+        suffix = '_led' + str(led) + '_gain' + str(gain) + '.tiff'
+        return (os.path.join(self.reference_dir, 'dark' + suffix),
+                os.path.join(self.reference_dir, 'illumination' + suffix))
+
+    def has(self, gain, led, load = True):
+        '''Whether the maps for 'gain' and 'led' are there. With 'load', their references are loaded from 'reference_dir' if needed.'''
+        if (gain, led) in self._maps:
+            return True
+        if not load or self.reference_dir is None:
+            return False
+        dark_path, illumination_path = self._reference_paths(gain, led)
+        if not (os.path.exists(dark_path) and os.path.exists(illumination_path)):
+            return False
+        dark = cv2.imread(dark_path, cv2.IMREAD_UNCHANGED)
+        illumination = cv2.imread(illumination_path, cv2.IMREAD_UNCHANGED)
+        if dark is None or illumination is None:
+            return False
+        logger.info('Using the dark and flat references in ' + self.reference_dir)
+        self.set_references(gain, led, dark, illumination, save = False)
+        return True
+
+    def clear(self):
+        '''Forget all maps, so the references are captured again, e.g. after reconnecting.'''
+        self._maps = {}
+
+    def set_references(self, gain, led, dark, illumination, save = True):
+        '''Compute the maps for 'gain' and 'led' from a 'dark' frame and the 'illumination' (see gain_map),
+        and save both references.'''
+        dark = dark.astype(np.float32)
+        illumination = illumination.astype(np.float32)
+        self._maps[(gain, led)] = (dark, gain_map(illumination))
+        if save and self.reference_dir is not None:
+            if not os.path.exists(self.reference_dir):
+                os.makedirs(self.reference_dir)
+            dark_path, illumination_path = self._reference_paths(gain, led)
+            cv2.imwrite(dark_path, dark)
+            cv2.imwrite(illumination_path, illumination)
+
+    def capture(self, m, gain, led, zparams):
+        '''Capture the references of the Miniscope 'm' at the current 'gain' and 'led', at the ends of the z-stack 'zparams'.
+        The LED is back on at 'led' afterwards. Returns False if the Miniscope failed to deliver the frames.'''
+        logger.info('Capturing dark and flat references')
+        flat = self.flat
+        if flat is None:
+            planes = []
+            for focus in (zparams['start'], zparams['end']):
+                avg = m.average_frames(self.frames, set_focus(m, focus))
+                if avg.count < self.frames:
+                    return False
+                planes.append(avg.mean.astype(np.float32))
+            flat = (planes[0] + planes[1]) / 2
+
+        seq = set_led(m, 0)
+        avg = m.average_frames(self.frames, seq)
+        set_led(m, led)
+        if avg.count < self.frames:
+            return False
+        dark = avg.mean.astype(np.float32)
+        if flat.shape != dark.shape:
+            raise ValueError('The flat-field image is ' + str(flat.shape) + ', the frames are ' + str(dark.shape))
+        illumination = flat - dark
+        if self.flat is None:
+            illumination = smooth_flat(illumination)
+        self.set_references(gain, led, dark, illumination)
+        dark, gains = self._maps[(gain, led)]
+        logger.info('Dark level {:.1f}, flat-field gain {:.2f} to {:.2f}'.format(float(dark.mean()), float(gains.min()), float(gains.max())))
+        return True
+
+    def correct(self, frames, gain, led, out = None):
+        '''Correct a frame, or a batch of frames stacked along the first axis, taken at 'gain' and 'led'.
+        The result has the data type of 'frames' and is written to 'out', a new array by default;
+        pass 'frames' itself to correct in place.'''
+        dark, gains = self._maps[(gain, led)]
+        if self._scratch is None or self._scratch.shape != frames.shape:
+            self._scratch = np.empty(frames.shape, np.float32)
+        buf = self._scratch
+        np.subtract(frames, dark, out = buf)
+        np.multiply(buf, gains, out = buf)
+        if np.issubdtype(frames.dtype, np.integer):
+            info = np.iinfo(frames.dtype)
+            np.clip(buf, info.min, info.max, out = buf)
+            np.rint(buf, out = buf)
+        if out is None:
+            out = np.empty(frames.shape, frames.dtype)
+        np.copyto(out, buf, casting = 'unsafe')
+        return out
@@ -0,0 +1,88 @@
+import json
+import threading
+from contextlib import contextmanager
+
+from mscopetrace import span
+
+import logging
+logger = logging.getLogger(__name__)
+
+# settings every device of a multi-device time lapse can override, the defaults come from the command line
+DEVICE_SETTINGS = ['device_type', 'daq_id', 'zstack', 'excitation', 'gain']
+
+def load_devices(path, defaults):
+    '''Read a multi-device configuration file. It is a JSON object like
+
+        {"stagger": 60, "usb_slots": 1,
+         "devices": [{"name": "left", "daq_id": 0, "zstack": [-60, 60, 10]},
+                     {"name": "right", "daq_id": 2, "excitation": 30}]}
+
+    Every device needs a unique name, which is also the name of its output directory. Settings from DEVICE_SETTINGS
+    that a device does not set are taken from 'defaults'. Returns the configuration with the defaults filled in.'''
+    with open(path, 'r') as f:
+        config = json.load(f)
+    return check_devices(config, defaults)
+
+def check_devices(config, defaults):
+    '''Validate a multi-device configuration and fill in the defaults, see load_devices.'''
+    devices = config.get('devices', [])
+    if len(devices) == 0:
+        raise ValueError('The device configuration has no devices.')
+
+    result = []
+    names = set()
+    daq_ids = set()
+    for dev in devices:
+        name = dev.get('name', '')
+        if name == '' or '/' in name or name.startswith('.'):
+            raise ValueError('Invalid device name: "' + name + '"')
+        if name in names:
+            raise ValueError('Device name "' + name + '" is used more than once.')
+        names.add(name)
+
+        settings = {'name': name}
+        for key in DEVICE_SETTINGS:
+            settings[key] = dev.get(key, defaults[key])
+        if settings['daq_id'] in daq_ids:
+            raise ValueError('DAQ ID ' + str(settings['daq_id']) + ' is used by more than one device.')
+        daq_ids.add(settings['daq_id'])
+        result.append(settings)
+
+    return {'stagger': config.get('stagger', 0),
+            'usb_slots': max(1, config.get('usb_slots', len(result))),
+            'devices': result}
+
+class DeviceCoordinator:
+    '''Coordinates the USB bus between the Miniscopes of a multi-device time lapse.
+
+    Connecting to a DAQ box is done by one device at a time, as opening several video devices at once is
+    unreliable. At most 'usb_slots' devices are connected at the same time; the others wait for a slot, so
+    the DAQ boxes on a shared bus do not starve each other of bandwidth. A connected Miniscope streams frames
+    until it is disconnected, so a device holds its slot for the whole connection: a single z-stack, or all
+    z-stacks of a persistent connection.
+    '''
+
+    def __init__(self, usb_slots):
+        self.usb_slots = usb_slots
+        self._connect_lock = threading.Lock()
+        self._usb_slots = threading.BoundedSemaphore(usb_slots)
+
+    @contextmanager
+    def connecting(self):
+        '''Context manager held while a device connects to its DAQ box.'''
+        with span('connect_wait'):
+            self._connect_lock.acquire()
+        try:
+            yield
+        finally:
+            self._connect_lock.release()
+
+    @contextmanager
+    def usb_slot(self):
+        '''Context manager held while a device is connected to its DAQ box.'''
+        with span('usb_wait'):
+            self._usb_slots.acquire()
+        try:
+            yield
+        finally:
+            self._usb_slots.release()
@@ -0,0 +1,101 @@
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# planes scoring at least this fraction of the way from the worst to the best plane of a sweep are in focus
+DEFAULT_BAND_THRESHOLD = 0.5
+# coarse steps added on each side of the band when tracking it on the next timestep
+DEFAULT_TRACK_MARGIN = 1
+# a sweep whose best plane is not at least this much sharper than its worst one shows no focus at all
+DEFAULT_MIN_CONTRAST = 0.2
+
+def focus_score(stats):
+    '''Focus measure of a photo from its FrameStats: the gradient energy computed by the capture thread (the mean
+    squared difference between neighboring pixels), normalized by the squared brightness so changes of the LED or
+    gain do not move the focus band.'''
+    return stats.sharpness / max(stats.mean, 1.0) ** 2
+
+class FocusTracker:
+    '''Plans adaptive z-stacks that only sample the in-focus band of the 'zparams' range densely.
+
+    A z-stack starts with a sweep of single photos every 'coarse_step' (a multiple of the z-stack step) over
+    the whole range. The planes whose focus score is within 'threshold' of the best one, padded by one coarse
+    step on each side, form the focus band, which is then shot at the full z-stack step. On later timesteps,
+    the sweep only covers the band widened by 'margin' coarse steps, so the band follows the sample as it drifts.
+    If the best plane of such a tracking sweep lies at its edge, or the sweep shows no focus, the band was lost
+    and the whole range is swept again.
+    '''
+
+    def __init__(self, zparams, coarse_step, threshold = DEFAULT_BAND_THRESHOLD, margin = DEFAULT_TRACK_MARGIN, min_contrast = DEFAULT_MIN_CONTRAST):
+        if coarse_step <= 0 or coarse_step % zparams['step'] != 0:
+            raise ValueError('The coarse step must be a multiple of the z-stack step (' + str(zparams['step']) + ').')
+        self.zparams = zparams
+        self.coarse_step = coarse_step
+        self.threshold = threshold
+        self.margin = margin
+        self.min_contrast = min_contrast
+        self.band = None # (first, last) focus of the band, None until it was found
+
+    def _clip(self, focus):
+        return min(max(focus, self.zparams['start']), self.zparams['end'])
+
+    def _grid(self, first, last, step):
+        '''Positions from 'first' to 'last' (both included) every 'step', on the grid of the z-stack.'''
+        start = self.zparams['start']
+        first = start + -(-(first - start) // self.zparams['step']) * self.zparams['step']
+        positions = list(range(first, last + 1, step))
+        if len(positions) == 0 or positions[-1] != last:
+            positions.append(last)
+        return positions
+
+    def sweep_positions(self):
+        '''Focus positions of the next sweep: the whole range, or the band and its margin when tracking.'''
+        if self.band is None:
+            return self._grid(self.zparams['start'], self.zparams['end'], self.coarse_step)
+        margin = self.margin * self.coarse_step
+        return self._grid(self._clip(self.band[0] - margin), self._clip(self.band[1] + margin), self.coarse_step)
+
+    def update(self, positions, scores):
+        '''Find the focus band from the focus 'scores' of a sweep over 'positions'.
+        Returns False if a tracking sweep lost the band, then the next sweep covers the whole range again.'''
+        full_sweep = self.band is None
+        scores = np.array(scores, dtype = np.float64)
+        best = int(np.argmax(scores))
+        low = float(np.min(scores))
+        high = float(scores[best])
+
+        if high <= low * (1 + self.min_contrast):
+            if not full_sweep:
+                logger.info('Lost the focus band, sweeping the whole range')
+                self.band = None
+                return False
+            # nothing stands out, so nothing may be left out either; without a band, the next sweep is a full one again
+            logger.warning('No plane is in focus, shooting the whole range')
+            return True
+
+        at_edge = (best == 0 and positions[0] > self.zparams['start']) or \
+                  (best == len(positions) - 1 and positions[-1] < self.zparams['end'])
+        if not full_sweep and at_edge:
+            logger.info('The focus band moved out of the tracking sweep, sweeping the whole range')
+            self.band = None
+            return False
+
+        # grow the band from the best plane while the neighbors are in focus
+        in_focus = (scores - low) >= self.threshold * (high - low)
+        first = best
+        while first > 0 and in_focus[first - 1]:
+            first -= 1
+        last = best
+        while last < len(positions) - 1 and in_focus[last + 1]:
+            last += 1
+
+        # the sharpest plane may lie between the coarse planes next to the band
+        self.band = (self._clip(positions[first] - self.coarse_step), self._clip(positions[last] + self.coarse_step))
+        logger.info('Focus band ' + str(self.band[0]) + ' to ' + str(self.band[1]) + ', sharpest at ' + str(positions[best]))
+        return True
+
+    def fine_positions(self):
+        '''Focus positions of the z-stack: the band at the full z-stack step, or the whole range without a band.'''
+        first, last = self.band if self.band is not None else (self.zparams['start'], self.zparams['end'])
+        return list(range(self._grid(first, last, self.zparams['step'])[0], last + 1, self.zparams['step']))
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = 'image_index.sqlite'
+# line based index written by older versions of the time lapse script
+CSV_INDEX_FILENAME = 'image_filename_index.csv'
+
+STATUS_OK = 'OK'
+STATUS_FAILED = 'FAILED'
+STATUS_BLANK = 'BLANK'
+
+# bump when the table layout changes, stored as the user_version of the database
+SCHEMA_VERSION = 5
+
+TABLES = '''
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL DEFAULT '',
+    timestep INTEGER NOT NULL,
+    z_index INTEGER NOT NULL,
+    z_dir TEXT NOT NULL,
+    focus INTEGER NOT NULL,
+    led INTEGER,
+    gain INTEGER,
+    capture_time REAL NOT NULL,
+    status TEXT NOT NULL,
+    path TEXT NOT NULL,
+    page INTEGER NOT NULL DEFAULT 0,
+    stat_min INTEGER,
+    stat_max INTEGER,
+    stat_mean REAL,
+    sharpness REAL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    start_time REAL NOT NULL,
+    first_timestep INTEGER NOT NULL,
+    settings TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shifts (
+    device TEXT NOT NULL DEFAULT '',
+    reference TEXT NOT NULL,
+    timestep INTEGER NOT NULL,
+    dx REAL NOT NULL,
+    dy REAL NOT NULL,
+    capture_time REAL NOT NULL,
+    PRIMARY KEY (device, reference, timestep)
+);
+CREATE TABLE IF NOT EXISTS plans (
+    device TEXT NOT NULL DEFAULT '',
+    timestep INTEGER NOT NULL,
+    planes INTEGER NOT NULL,
+    start_time REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (device, timestep)
+);
+'''
+
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS images_z ON images (device, z_dir, id);
+CREATE INDEX IF NOT EXISTS images_time ON images (capture_time);
+CREATE INDEX IF NOT EXISTS images_status ON images (status, device, z_dir);
+CREATE INDEX IF NOT EXISTS images_timestep ON images (device, timestep, status);
+'''
+
+class ImageIndex:
+    '''SQLite index of the images of a time lapse.
+
+    Every captured (or failed) image is one row with its device, timestep, z-level, focus, LED, gain, capture time,
+    frame statistics, status and storage location (path and page). The database runs in WAL mode and every
+    row is committed on its own, so an interrupted time lapse loses at most the image that was being indexed.
+    Rows can be queried by device, z-level, capture time range and status without scanning the image directories.
+    Time lapses of a single Miniscope leave the device empty.
+    Every start of the time lapse, including resumes, is recorded in a separate table with its settings, the
+    number of planes planned for the z-stack of every timestep in another, and the lateral drift of every
+    timestep measured by mscoperegister is cached in a fourth one.
+    The index is safe to use from several threads.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode = WAL')
+        # in WAL mode, NORMAL only loses the last commits on power loss, never corrupts the database
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError('Image index ' + path + ' was written by a newer version (schema ' + str(version) + ').')
+        with self._db:
+            self._db.executescript(TABLES)
+            if version == 1:
+                # indexes of single Miniscope time lapses, before the device column existed
+                self._db.execute("ALTER TABLE images ADD COLUMN device TEXT NOT NULL DEFAULT ''")
+                for name in ('images_z', 'images_status', 'images_timestep'):
+                    self._db.execute('DROP INDEX IF EXISTS ' + name)
+            if version == 4:
+                # plans without the start of their attempt count the images of every attempt
+                self._db.execute('ALTER TABLE plans ADD COLUMN start_time REAL NOT NULL DEFAULT 0')
+            self._db.executescript(INDEXES)
+        if version < SCHEMA_VERSION:
+            self._db.execute('PRAGMA user_version = ' + str(SCHEMA_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def add(self, timestep, z_index, z_dir, focus, path, page = 0, status = STATUS_OK, led = None, gain = None, capture_time = None, stats = None, device = ''):
+        '''Add an image to the index. 'capture_time' is in seconds since the epoch (default now),
+        'stats' the FrameStats of the image, if it was captured, and 'device' the name of the Miniscope that took it.'''
+        if capture_time is None:
+            capture_time = time.time()
+        row = (device, timestep, z_index, z_dir, focus, led, gain, capture_time, status, path, page,
+               stats.min if stats is not None else None,
+               stats.max if stats is not None else None,
+               stats.mean if stats is not None else None,
+               stats.sharpness if stats is not None else None)
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO images (device, timestep, z_index, z_dir, focus, led, gain, capture_time, status, path, page, '
+                             'stat_min, stat_max, stat_mean, sharpness) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+    def add_run(self, settings, first_timestep = 0, start_time = None):
+        '''Record a start of the time lapse at timestep 'first_timestep', with its settings as a JSON serializable dictionary.'''
+        if start_time is None:
+            start_time = time.time()
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO runs (start_time, first_timestep, settings) VALUES (?, ?, ?)',
+                             (start_time, first_timestep, json.dumps(settings, sort_keys = True)))
+
+    def first_run(self):
+        '''Return the start time and settings of the first run of the time lapse, or None if no run was recorded.'''
+        with self._lock:
+            row = self._db.execute('SELECT start_time, settings FROM runs ORDER BY id LIMIT 1').fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def supersede(self, timestep, device = ''):
+        '''Mark the good images of 'device' at 'timestep' as failed, before the z-stack of the timestep is shot again.
+        The new attempt overwrites their files, and may put other planes on the pages of a multi-page TIFF.'''
+        with self._lock, self._db:
+            self._db.execute('UPDATE images SET status = ? WHERE device = ? AND timestep = ? AND status = ?',
+                             (STATUS_FAILED, device, timestep, STATUS_OK))
+
+    def set_plan(self, timestep, num_planes, device = '', start_time = None):
+        '''Record that the attempt at the z-stack of 'device' at 'timestep' starting at 'start_time' (in seconds since
+        the epoch, default now) has 'num_planes' planes, replacing the plan of an earlier attempt.'''
+        if start_time is None:
+            start_time = time.time()
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO plans (device, timestep, planes, start_time) VALUES (?, ?, ?, ?)',
+                             (device, timestep, num_planes, start_time))
+
+    def last_complete_timestep(self, num_planes, device = ''):
+        '''Return the last timestep of 'device' with a good image at each z-level of its plan (see set_plan), or at each of
+        'num_planes' z-levels for timesteps without one, or -1 if there is none. Only the images of the planned attempt
+        count, as the attempts of an adaptive z-stack cover different planes and may add up to the plan without any
+        of them being complete. Images with a negative z-index, like the projections of a z-stack, are not planes
+        and do not count.'''
+        with self._lock:
+            row = self._db.execute('SELECT images.timestep FROM images LEFT JOIN plans '
+                                   'ON plans.device = images.device AND plans.timestep = images.timestep '
+                                   'WHERE images.device = ? AND images.status = ? AND images.z_index >= 0 '
+                                   'AND images.capture_time >= COALESCE(plans.start_time, 0) GROUP BY images.timestep '
+                                   'HAVING COUNT(DISTINCT images.z_index) >= COALESCE(MAX(plans.planes), ?) '
+                                   'ORDER BY images.timestep DESC LIMIT 1',
+                                   (device, STATUS_OK, num_planes)).fetchone()
+        return row[0] if row is not None else -1
+
+    def query(self, z_dir = None, start_time = None, end_time = None, status = None, device = None):
+        '''Return the index rows (as sqlite3.Row, in capture order) of z-level 'z_dir' of 'device', captured
+        in [start_time, end_time) and with the given status. Criteria that are None are ignored.'''
+        where = []
+        args = []
+        if device is not None:
+            where.append('device = ?')
+            args.append(device)
+        if z_dir is not None:
+            where.append('z_dir = ?')
+            args.append(z_dir)
+        if start_time is not None:
+            where.append('capture_time >= ?')
+            args.append(start_time)
+        if end_time is not None:
+            where.append('capture_time < ?')
+            args.append(end_time)
+        if status is not None:
+            where.append('status = ?')
+            args.append(status)
+
+        sql = 'SELECT * FROM images'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY id'
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def devices(self):
+        '''Return the names of the Miniscopes in the index.'''
+        with self._lock:
+            rows = self._db.execute('SELECT DISTINCT device FROM images ORDER BY device').fetchall()
+        return [r[0] for r in rows]
+
+    def z_levels(self, device = ''):
+        '''Return the z-level directory names of 'device' in the index, ordered by z-index.'''
+        with self._lock:
+            rows = self._db.execute('SELECT z_dir FROM images WHERE device = ? GROUP BY z_dir ORDER BY MIN(z_index)', (device,)).fetchall()
+        return [r[0] for r in rows]
+
+    def sharpest_z_level(self, device = ''):
+        '''Return the z-level directory name of 'device' with the highest mean sharpness of its good images, or None.'''
+        with self._lock:
+            row = self._db.execute('SELECT z_dir FROM images WHERE device = ? AND status = ? AND sharpness IS NOT NULL '
+                                   'GROUP BY z_dir ORDER BY AVG(sharpness) DESC LIMIT 1', (device, STATUS_OK)).fetchone()
+        return row[0] if row is not None else None
+
+    def shifts(self, reference, device = ''):
+        '''Return the cached drift of 'device' measured on the z-level 'reference', as a dictionary of
+        timestep -> (dx, dy, capture time of the reference image it was measured on).'''
+        with self._lock:
+            rows = self._db.execute('SELECT timestep, dx, dy, capture_time FROM shifts WHERE device = ? AND reference = ?',
+                                    (device, reference)).fetchall()
+        return {timestep: (dx, dy, capture_time) for timestep, dx, dy, capture_time in rows}
+
+    def set_shifts(self, reference, shifts, device = ''):
+        '''Cache the drift of 'device' measured on the z-level 'reference', as (timestep, dx, dy, capture time) tuples.'''
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO shifts (device, reference, timestep, dx, dy, capture_time) VALUES (?, ?, ?, ?, ?, ?)',
+                                 [(device, reference) + tuple(row) for row in shifts])
+
+    def merge_entries(self, device = ''):
+        '''Return the images of 'device' as a dictionary for the merge functions:
+        key = z-level string, value = list of (path, page, status) of all images at that z-level, in capture order.'''
+        img_fn_dict = {}
+        with self._lock:
+            rows = self._db.execute('SELECT z_dir, path, page, status FROM images WHERE device = ? ORDER BY id', (device,)).fetchall()
+        for z_dir, path, page, status in rows:
+            img_fn_dict.setdefault(z_dir, []).append((path, page, status))
+        return img_fn_dict
+
+def read_csv_index(path):
+    '''Read the CSV index of an older time lapse into the same dictionary as ImageIndex.merge_entries().
+    Its status column holds the capture time of good images.'''
+    img_fn_dict = {}
+    with open(path, 'r') as infile:
+        for line in infile:
+            splitline = line.strip().split(',')
+            z_dir = splitline[0]
+            img_path = splitline[1]
+            status = splitline[2]
+            # index files written before the 'stack' layout existed have no page column
+            page = int(splitline[3]) if len(splitline) > 3 else 0
+            if status not in (STATUS_FAILED, STATUS_BLANK):
+                status = STATUS_OK
+            img_fn_dict.setdefault(z_dir, []).append((img_path, page, status))
+    return img_fn_dict
+
+def read_image_index(img_dir, device = ''):
+    '''Read the image index of the time lapse in 'img_dir' into a dictionary for the merge functions,
+    from the SQLite index or - for time lapses shot with older versions - the CSV index.
+    'device' selects the Miniscope of a multi-device time lapse.'''
+    db_path = os.path.join(img_dir, INDEX_FILENAME)
+    if os.path.exists(db_path):
+        with ImageIndex(db_path) as index:
+            return index.merge_entries(device)
+    logger.info('No ' + INDEX_FILENAME + ' found, reading ' + CSV_INDEX_FILENAME)
+    return read_csv_index(os.path.join(img_dir, CSV_INDEX_FILENAME))
@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import queue
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from mscopewriter import read_stack_page
+from mscoperegister import apply_shift
+from mscopeindex import STATUS_FAILED, STATUS_BLANK
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_FPS = 5
+DEFAULT_SIZE = '680x680'
+DEFAULT_CODEC = 'libx264'
+DEFAULT_CRF = 17
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+# bump when the manifest contents change, so old manifests are not trusted
+MANIFEST_VERSION = 1
+
+def merge_entries(entries):
+    '''Select the frames that go into a video from the (path, page, status) index entries of a z-level, in capture order.
+    Skips failed captures, including the planes of z-stacks that were retaken, and planes that were indexed
+    again when a failed z-stack was retaken by older versions.'''
+    seen = set()
+    result = []
+    for path, page, status in entries:
+        if status in (STATUS_FAILED, STATUS_BLANK) or (path, page) in seen:
+            continue
+        seen.add((path, page))
+        result.append((path, page))
+    return result
+
+def video_path_for(img_dir, z_dir, entries):
+    '''Generate the path of the merged video of a z-level, with the led and gain information from its first image.'''
+    suffixlist = [z_dir]
+    # slice up first filename to get led and gain information
+    filename0 = entries[0][0]
+    suffixlist.extend(os.path.basename(filename0).split('.')[0].split('_')[-2:])
+    suffix = '_'.join(suffixlist)
+
+    merged_video_name = 'miniscope_timelapse_' + suffix + '.mp4'
+    return os.path.join(img_dir, z_dir, merged_video_name)
+
+def ffmpeg_command(ffmpeg_path, width, height, pix_fmt, video_path, fps = DEFAULT_FPS, size = DEFAULT_SIZE, codec = DEFAULT_CODEC, crf = DEFAULT_CRF, threads = 0):
+    '''Build the ffmpeg command line to encode raw frames of the given size from stdin into 'video_path'.
+    'size' is the output size as WIDTHxHEIGHT, or None to keep the frame size.'''
+    cmd = [ffmpeg_path, \
+           '-f', 'rawvideo', \
+           '-pix_fmt', pix_fmt, \
+           '-s:v', str(width) + 'x' + str(height), \
+           '-framerate', str(fps), \
+           '-i', '-', \
+           '-hide_banner', '-loglevel', 'error', \
+           '-y']
+    if size is not None:
+        cmd.extend(['-s:v', size])
+    cmd.extend(['-c:v', codec, \
+                '-crf', str(crf), \
+                '-pix_fmt', 'yuv420p'])
+    if threads > 0:
+        cmd.extend(['-threads', str(threads)])
+    cmd.append(video_path)
+    return cmd
+
+def encode_frames(ffmpeg_path, frames, video_path, **settings):
+    '''Stream the frames from the iterable 'frames' to ffmpeg, encoding them into 'video_path'.
+    'settings' are passed on to ffmpeg_command. Returns the number of encoded frames,
+    raises RuntimeError if ffmpeg fails.'''
+    proc = None
+    count = 0
+    # not a pipe, so a chatty ffmpeg can never block us while we write frames
+    errfile = tempfile.TemporaryFile()
+    try:
+        for frame in frames:
+            if proc is None:
+                # the frame size is only known once we read the first frame
+                pix_fmt = 'gray' if frame.ndim == 2 else 'bgr24'
+                cmd = ffmpeg_command(ffmpeg_path, frame.shape[1], frame.shape[0], pix_fmt, video_path, **settings)
+                proc = subprocess.Popen(cmd, stdin = subprocess.PIPE, stderr = errfile)
+            try:
+                proc.stdin.write(np.ascontiguousarray(frame).tobytes())
+            except BrokenPipeError:
+                break # ffmpeg died, the return code tells us why
+            count += 1
+
+        if proc is None:
+            raise RuntimeError('no frames to encode')
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if proc.wait() != 0:
+            errfile.seek(0)
+            msg = errfile.read().decode(errors = 'replace').strip()
+            raise RuntimeError('ffmpeg exited with code ' + str(proc.returncode) + (': ' + msg if msg else ''))
+    finally:
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        errfile.close()
+
+    return count
+
+def manifest_path_for(video_path):
+    return video_path + '.manifest.json'
+
+def read_manifest(video_path):
+    '''Read the manifest of the source frames and encoder settings of a merged video.
+    Returns None if there is none, or if it does not belong to the current video file.'''
+    try:
+        with open(manifest_path_for(video_path), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION or not os.path.exists(video_path):
+        return None
+    return manifest
+
+def write_manifest(video_path, settings, frames):
+    '''Record which source frames, as [path, page, size, mtime] (and the dx and dy they were translated by, if the
+    time lapse was registered), and which encoder settings made up a merged video.'''
+    manifest = {'version': MANIFEST_VERSION, 'settings': settings, 'frames': frames}
+    tmp_path = manifest_path_for(video_path) + '.part'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(tmp_path, manifest_path_for(video_path))
+
+def source_frames(entries, shifts = None):
+    '''Get the frames that go into a video from the index entries of a z-level as [path, page, size, mtime] lists,
+    so a change of a source file can be detected later on. With the 'shifts' of a registered time lapse
+    ((path, page) -> (dx, dy), see mscoperegister), each frame also gets the dx and dy it is translated by.'''
+    frames = []
+    for path, page in merge_entries(entries):
+        try:
+            st = os.stat(path)
+        except OSError:
+            logger.warning('Missing image ' + path)
+            continue
+        frame_info = [path, page, st.st_size, st.st_mtime_ns]
+        if shifts is not None:
+            dx, dy = shifts.get((path, page), (0.0, 0.0))
+            frame_info.extend([round(dx, 2) + 0.0, round(dy, 2) + 0.0]) # no -0.0 in the manifest
+        frames.append(frame_info)
+    return frames
+
+def concat_videos(ffmpeg_path, video_paths, out_path):
+    '''Join videos with identical encoder settings into 'out_path' without re-encoding them.'''
+    with tempfile.NamedTemporaryFile('w', suffix = '.txt', delete = False) as f:
+        for path in video_paths:
+            f.write("file '" + os.path.abspath(path).replace("'", "'\\''") + "'\n")
+        list_path = f.name
+    try:
+        proc = subprocess.run([ffmpeg_path, \
+                               '-f', 'concat', \
+                               '-safe', '0', \
+                               '-i', list_path, \
+                               '-hide_banner', '-loglevel', 'error', \
+                               '-y', \
+                               '-c', 'copy', \
+                               out_path], stderr = subprocess.PIPE)
+    finally:
+        os.remove(list_path)
+    if proc.returncode != 0:
+        raise RuntimeError('ffmpeg concat exited with code ' + str(proc.returncode) + ': ' + proc.stderr.decode(errors = 'replace').strip())
+
+def merge_z_level(ffmpeg_path, img_dir, z_dir, entries, threads = 0, force = False, shifts = None, **settings):
+    '''Merge the frames of one z-level into its video. The video is skipped if its manifest shows it is up to date,
+    and only new frames are encoded and appended if the old video has the first frames of the new one.
+    Frames are translated by their 'shifts' (see source_frames) as they are read, the images are not changed.
+    Returns the number of encoded frames, the time it took, and whether the video was 'skipped', 'appended' or 'encoded'.'''
+    start = time.monotonic()
+    video_path = video_path_for(img_dir, z_dir, entries)
+    if not os.path.exists(os.path.dirname(video_path)):
+        os.makedirs(os.path.dirname(video_path))
+
+    frames = source_frames(entries, shifts)
+    manifest = None if force else read_manifest(video_path)
+    old_frames = None
+    if manifest is not None and manifest['settings'] == settings:
+        old_frames = manifest['frames']
+
+    if old_frames == frames:
+        return 0, time.monotonic() - start, 'skipped'
+
+    append = old_frames is not None and len(old_frames) > 0 and frames[:len(old_frames)] == old_frames
+    new_frames = frames[len(old_frames):] if append else frames
+    encoded = []
+
+    def read_frames():
+        for frame_info in new_frames:
+            frame = read_stack_page(frame_info[0], frame_info[1]) # also reads plain image files as page 0
+            if frame is None:
+                logger.warning('Could not read page ' + str(frame_info[1]) + ' of ' + frame_info[0])
+                continue
+            if len(frame_info) > 4 and (frame_info[4] != 0 or frame_info[5] != 0):
+                frame = apply_shift(frame, frame_info[4], frame_info[5])
+            encoded.append(frame_info)
+            yield frame
+
+    # never leave a half-written video or a manifest that does not match its video behind
+    part_path = video_path[:-len('.mp4')] + '.part.mp4'
+    segment_path = video_path[:-len('.mp4')] + '.segment.mp4'
+    try:
+        if append:
+            count = encode_frames(ffmpeg_path, read_frames(), segment_path, threads = threads, **settings)
+            concat_videos(ffmpeg_path, [video_path, segment_path], part_path)
+            encoded = old_frames + encoded
+        else:
+            count = encode_frames(ffmpeg_path, read_frames(), part_path, threads = threads, **settings)
+
+        if os.path.exists(manifest_path_for(video_path)):
+            os.remove(manifest_path_for(video_path))
+        os.replace(part_path, video_path)
+        write_manifest(video_path, settings, encoded)
+    finally:
+        for path in (part_path, segment_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return count, time.monotonic() - start, 'appended' if append else 'encoded'
+
+def merge_timelapse(ffmpeg_path, img_dir, img_fn_dict, workers = DEFAULT_WORKERS, fps = DEFAULT_FPS, size = DEFAULT_SIZE, codec = DEFAULT_CODEC, crf = DEFAULT_CRF, force = False, shifts = None):
+    '''Use ffmpeg to merge the miniscope images into a single video for each z-level.
+    Up to 'workers' z-levels are encoded at the same time. The frames are read in the order of the image index
+    and streamed to ffmpeg. Videos that are up to date are skipped and videos with new timesteps are extended,
+    unless 'force' is set. With the 'shifts' of a registered time lapse (see mscoperegister.register_timelapse),
+    the frames are aligned as they are encoded. Returns a list of the z-levels that failed to merge.'''
+    start = time.monotonic()
+    workers = max(1, workers)
+    # share the cores between the parallel encoders, instead of every ffmpeg starting a thread per core
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        jobs = {}
+        for z_dir in img_fn_dict.keys():
+            jobs[z_dir] = executor.submit(merge_z_level, ffmpeg_path, img_dir, z_dir, img_fn_dict[z_dir], \
+                                          threads = threads, force = force, shifts = shifts, \
+                                          fps = fps, size = size, codec = codec, crf = crf)
+
+        for z_dir, job in jobs.items():
+            try:
+                count, seconds, mode = job.result()
+                if mode == 'skipped':
+                    logger.info('Video of ' + z_dir + ' is up to date')
+                else:
+                    logger.info('Merged ' + str(count) + ' frames of ' + z_dir + ' in ' + '{:.1f}'.format(seconds) + ' seconds (' + mode + ')')
+            except Exception as e:
+                logger.error('Failed to merge ' + z_dir + ': ' + str(e))
+                failed.append(z_dir)
+
+    logger.info('Merged ' + str(len(jobs) - len(failed)) + ' of ' + str(len(jobs)) + ' z-levels in ' + '{:.1f}'.format(time.monotonic() - start) + ' seconds')
+    return failed
+
+class LiveEncoder:
+    '''One long-lived ffmpeg process encoding the video of a single z-level from frames pushed to it.
+    At most 'max_queue' frames wait for ffmpeg; push() blocks when the queue is full, which keeps memory
+    bounded if ffmpeg can not keep up with the time lapse.'''
+
+    def __init__(self, ffmpeg_path, video_path, settings, max_queue = 32):
+        self.ffmpeg_path = ffmpeg_path
+        self.video_path = video_path
+        self.part_path = video_path[:-len('.mp4')] + '.part.mp4'
+        self.settings = settings
+        self.frames = [] # [path, page] of the frames sent to ffmpeg
+        self.error = None
+        self._queue = queue.Queue(maxsize = max_queue)
+        self._thread = threading.Thread(target = self._work, daemon = True)
+        self._thread.start()
+
+    def _put(self, item):
+        '''Queue 'item' for the encoding thread, waiting for room as long as the thread runs.
+        Once encoding failed, nothing takes items off the queue any more and 'item' is dropped.'''
+        start = time.perf_counter()
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout = 0.1)
+                break
+            except queue.Full:
+                pass
+        blocked = time.perf_counter() - start
+        if blocked > 0.01:
+            logger.warning('Live encoder queue of ' + os.path.basename(self.video_path) + ' full, capture waited {:.3f} seconds'.format(blocked))
+
+    def push(self, path, page, frame):
+        '''Queue 'frame', the image at 'path' and 'page', to be encoded. It must not be modified by the caller afterwards.'''
+        self._put((path, page, frame))
+
+    def finish(self):
+        '''Wait for all pushed frames to be encoded and move the video into place. Returns True on success.'''
+        self._put(None)
+        self._thread.join()
+        if self.error is not None:
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+            return False
+
+        os.replace(self.part_path, self.video_path)
+        return True
+
+    def _work(self):
+        def frames():
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                path, page, frame = item
+                self.frames.append([path, page])
+                yield frame
+
+        try:
+            # many of these run at the same time, but each only gets a frame per timestep
+            encode_frames(self.ffmpeg_path, frames(), self.part_path, threads = 1, **self.settings)
+        except Exception as e:
+            self.error = str(e)
+
+class LiveMerger:
+    '''Encode the video of every z-level while the time lapse is still running.
+
+    The frames of each successful z-stack are pushed with add_stack(), and streamed to one ffmpeg process per
+    z-level from a background thread, so the videos are done seconds after the last z-stack instead of after a
+    second pass over all images. finish() writes the manifests, so a following merge_timelapse() skips every
+    z-level that was encoded live and only redoes those that failed.
+    '''
+
+    def __init__(self, ffmpeg_path, img_dir, fps = DEFAULT_FPS, size = DEFAULT_SIZE, codec = DEFAULT_CODEC, crf = DEFAULT_CRF):
+        self.ffmpeg_path = ffmpeg_path
+        self.img_dir = img_dir
+        self.settings = {'fps': fps, 'size': size, 'codec': codec, 'crf': crf}
+        self._encoders = {}
+
+    def add_stack(self, frames):
+        '''Push the frames of a z-stack, as (z_dir, path, page, frame) tuples, to the encoders of their z-levels.'''
+        for z_dir, path, page, frame in frames:
+            if z_dir not in self._encoders:
+                video_path = video_path_for(self.img_dir, z_dir, [(path, page)])
+                if not os.path.exists(os.path.dirname(video_path)):
+                    os.makedirs(os.path.dirname(video_path))
+                self._encoders[z_dir] = LiveEncoder(self.ffmpeg_path, video_path, self.settings)
+            self._encoders[z_dir].push(path, page, frame)
+
+    def finish(self):
+        '''Finish all videos and write their manifests. The source images must be on disk at this point,
+        so close the ImageWriter first. Returns a list of the z-levels whose video failed.'''
+        failed = []
+        for z_dir, encoder in self._encoders.items():
+            if not encoder.finish():
+                logger.error('Live encoding of ' + z_dir + ' failed: ' + encoder.error)
+                failed.append(z_dir)
+                continue
+
+            frames = []
+            for path, page in encoder.frames:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    frames = None
+                    break
+                frames.append([path, page, st.st_size, st.st_mtime_ns])
+            if frames is None:
+                logger.warning('Images of ' + z_dir + ' are missing, its video will be merged again')
+                continue
+            write_manifest(encoder.video_path, self.settings, frames)
+            logger.info('Finished live video of ' + z_dir + ' with ' + str(len(frames)) + ' frames')
+
+        self._encoders = {}
+        return failed
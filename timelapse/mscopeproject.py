@@ -0,0 +1,79 @@
+import cv2
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+PROJECTION_MIP = 'mip' # maximum intensity projection
+PROJECTION_EDF = 'edf' # extended depth of field composite
+PROJECTIONS = [PROJECTION_MIP, PROJECTION_EDF]
+
+# size of the neighborhood over which the focus of a pixel is measured for the EDF composite
+DEFAULT_FOCUS_SIGMA = 2.0
+# the focus measure is raised to this power for the EDF weights, so the sharpest plane dominates over the noise of the others
+DEFAULT_FOCUS_POWER = 2
+# keeps the EDF weights of flat regions, which are in focus on no plane, from dividing by zero
+EDF_WEIGHT_FLOOR = 1e-3
+
+def focus_map(frame, sigma = DEFAULT_FOCUS_SIGMA):
+    '''Per-pixel focus measure of 'frame': the local energy of its Laplacian, smoothed over 'sigma' pixels.'''
+    lap = cv2.Laplacian(frame, cv2.CV_32F)
+    return cv2.GaussianBlur(lap * lap, (0, 0), sigma)
+
+class Projector:
+    '''Builds projections of a z-stack while it is shot, one plane at a time.
+
+    The maximum intensity projection ('mip') keeps the brightest value of every pixel, the extended depth of field
+    composite ('edf') is the mean of the planes weighted by how much in focus each pixel is on each plane, so every
+    part of the sample is taken from the planes it is sharp on. Only the running maximum and the two sums of the
+    weighted mean are kept, so the memory does not grow with the number of planes.
+    '''
+
+    def __init__(self, projections = PROJECTIONS, sigma = DEFAULT_FOCUS_SIGMA, power = DEFAULT_FOCUS_POWER):
+        self.projections = list(projections)
+        self.sigma = sigma
+        self.power = power
+        self.count = 0
+        self._dtype = None
+        self._max = None
+        self._weighted_sum = None
+        self._weight_sum = None
+
+    def add(self, frame):
+        '''Add the next plane of the z-stack.'''
+        if self.count == 0:
+            self._dtype = frame.dtype
+        self.count += 1
+
+        if PROJECTION_MIP in self.projections:
+            if self._max is None:
+                self._max = frame.copy()
+            else:
+                np.maximum(self._max, frame, out = self._max)
+
+        if PROJECTION_EDF in self.projections:
+            weight = focus_map(frame, self.sigma)
+            if self.power != 1:
+                weight **= self.power
+            weight += EDF_WEIGHT_FLOOR
+            if self._weighted_sum is None:
+                self._weighted_sum = weight * frame
+                self._weight_sum = weight
+            else:
+                self._weighted_sum += weight * frame
+                self._weight_sum += weight
+
+    def result(self):
+        '''Return a dictionary of projection name to image, in the data type of the planes. Empty without planes.'''
+        if self.count == 0:
+            return {}
+        images = {}
+        if PROJECTION_MIP in self.projections:
+            images[PROJECTION_MIP] = self._max
+        if PROJECTION_EDF in self.projections:
+            edf = self._weighted_sum / self._weight_sum
+            if np.issubdtype(self._dtype, np.integer):
+                info = np.iinfo(self._dtype)
+                edf = np.clip(np.round(edf), info.min, info.max)
+            images[PROJECTION_EDF] = edf.astype(self._dtype)
+        return images
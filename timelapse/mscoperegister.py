@@ -0,0 +1,151 @@
+import os
+import time
+import numpy as np
+import cv2
+
+from mscopewriter import read_stack_page
+from mscopeindex import ImageIndex, INDEX_FILENAME, STATUS_OK
+from mscopeproject import PROJECTION_EDF
+
+import logging
+logger = logging.getLogger(__name__)
+
+# number of timesteps whose shifts are computed in one batch of FFTs, bounds the memory to a few of these frames
+DEFAULT_BATCH = 16
+
+def hann_window(height, width):
+    '''2D Hann window, which keeps the edges of the frames from dominating the phase correlation.'''
+    return np.outer(np.hanning(height), np.hanning(width)).astype(np.float32)
+
+def _refine_peak(center, before, after):
+    '''Sub-pixel offset of correlation peaks from the values at and next to them, by fitting parabolas.'''
+    denom = before - 2 * center + after
+    safe = np.where(np.abs(denom) > 1e-12, denom, 1.0)
+    return np.where(np.abs(denom) > 1e-12, 0.5 * (before - after) / safe, 0.0)
+
+def phase_correlate(frames):
+    '''Shift of every frame of the (N, height, width) array 'frames' relative to the frame before it, by phase
+    correlation of the whole batch at once. Returns an (N - 1, 2) array of (dx, dy) in pixels with sub-pixel
+    precision, positive if the content moved right or down.'''
+    n, height, width = frames.shape
+    frames = frames.astype(np.float32)
+    frames -= frames.mean(axis = (1, 2), keepdims = True)
+    frames *= hann_window(height, width)
+
+    spectra = np.fft.rfft2(frames)
+    cross = spectra[1:] * np.conj(spectra[:-1])
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    corr = np.fft.irfft2(cross, s = (height, width))
+
+    pairs = np.arange(n - 1)
+    py, px = np.unravel_index(corr.reshape(n - 1, -1).argmax(axis = 1), (height, width))
+    peak = corr[pairs, py, px]
+    dy = py + _refine_peak(peak, corr[pairs, (py - 1) % height, px], corr[pairs, (py + 1) % height, px])
+    dx = px + _refine_peak(peak, corr[pairs, py, (px - 1) % width], corr[pairs, py, (px + 1) % width])
+    # the correlation wraps around, shifts past the middle are negative
+    dy = np.where(dy > height / 2, dy - height, dy)
+    dx = np.where(dx > width / 2, dx - width, dx)
+    return np.stack([dx, dy], axis = 1)
+
+def apply_shift(frame, dx, dy):
+    '''Translate 'frame' by ('dx', 'dy') pixels, filling the uncovered border with black.'''
+    matrix = np.float32([[1, 0, dx], [0, 1, dy]])
+    return cv2.warpAffine(frame, matrix, (frame.shape[1], frame.shape[0]), flags = cv2.INTER_LINEAR, borderMode = cv2.BORDER_CONSTANT)
+
+def choose_reference(index, device = ''):
+    '''The z-level to measure the drift on: the EDF projection if there is one, as it is sharp everywhere,
+    otherwise the sharpest z-level.'''
+    if PROJECTION_EDF in index.z_levels(device):
+        return PROJECTION_EDF
+    return index.sharpest_z_level(device)
+
+def reference_images(index, reference, device = ''):
+    '''The good images of the z-level 'reference' as (timestep, path, page, capture time), one per timestep in
+    timestep order. A timestep that was shot again is represented by its last image.'''
+    images = {}
+    for row in index.query(z_dir = reference, status = STATUS_OK, device = device):
+        images[row['timestep']] = (row['timestep'], row['path'], row['page'], row['capture_time'])
+    return [images[t] for t in sorted(images)]
+
+def estimate_drift(index, device = '', reference = None, batch = DEFAULT_BATCH):
+    '''Measure the lateral drift of every timestep of 'device' relative to its first timestep, on the z-level 'reference'
+    (see choose_reference). The shifts between consecutive timesteps are computed 'batch' timesteps at a time and
+    added up. Results are cached in the ImageIndex 'index', so only timesteps that are new or were shot again since
+    the last call are computed. Returns the reference and a dictionary of timestep -> (dx, dy) in pixels.'''
+    if reference is None:
+        reference = choose_reference(index, device)
+    if reference is None:
+        return None, {}
+
+    images = reference_images(index, reference, device)
+    cached = index.shifts(reference, device)
+    # the cache holds up to the first timestep that was not registered yet or whose reference image changed
+    keep = 0
+    while keep < len(images) and images[keep][0] in cached and cached[images[keep][0]][2] == images[keep][3]:
+        keep += 1
+    drift = {t: cached[t][:2] for t, path, page, capture_time in images[:keep]}
+    if keep == len(images):
+        return reference, drift
+
+    start = time.monotonic()
+    new_shifts = []
+    if keep == 0:
+        # the first timestep is the origin
+        timestep, path, page, capture_time = images[0]
+        new_shifts.append((timestep, 0.0, 0.0, capture_time))
+        keep = 1
+    prev = images[keep - 1]
+    prev_frame = read_stack_page(prev[1], prev[2])
+    if prev_frame is None:
+        logger.warning('Could not read ' + prev[1] + ', the drift after timestep ' + str(prev[0]) + ' is not registered')
+    total = np.array(drift.get(prev[0], (0.0, 0.0)))
+
+    pending = images[keep:]
+    while len(pending) > 0 and prev_frame is not None:
+        chunk = []
+        frames = [prev_frame]
+        for image in pending[:batch]:
+            frame = read_stack_page(image[1], image[2])
+            if frame is None or frame.shape != prev_frame.shape:
+                logger.warning('Could not read ' + image[1] + ' for the registration, skipping timestep ' + str(image[0]))
+                continue
+            chunk.append(image)
+            frames.append(frame)
+        pending = pending[batch:]
+        if len(chunk) == 0:
+            continue
+
+        steps = phase_correlate(np.stack(frames))
+        for (timestep, path, page, capture_time), step in zip(chunk, np.cumsum(steps, axis = 0) + total):
+            new_shifts.append((timestep, float(step[0]), float(step[1]), capture_time))
+        total = np.array(new_shifts[-1][1:3])
+        prev_frame = frames[-1]
+
+    index.set_shifts(reference, new_shifts, device)
+    for timestep, dx, dy, capture_time in new_shifts:
+        drift[timestep] = (dx, dy)
+    largest = max(np.hypot(dx, dy) for dx, dy in drift.values())
+    logger.info('Registered ' + str(len(new_shifts)) + ' timesteps on ' + reference + ' in ' + '{:.1f}'.format(time.monotonic() - start) + \
+                ' seconds, largest drift ' + '{:.1f}'.format(largest) + ' pixels')
+    return reference, drift
+
+def register_timelapse(img_dir, device = '', reference = None, batch = DEFAULT_BATCH):
+    '''Measure the drift of the time lapse in 'img_dir' (see estimate_drift) and return the shift that aligns
+    each of its good images with the first timestep, as a dictionary of (path, page) -> (dx, dy) for the merge
+    functions. None if the time lapse has no SQLite image index to register with.'''
+    db_path = os.path.join(img_dir, INDEX_FILENAME)
+    if not os.path.exists(db_path):
+        logger.warning('No ' + INDEX_FILENAME + ' found, merging without registration')
+        return None
+
+    with ImageIndex(db_path) as index:
+        reference, drift = estimate_drift(index, device, reference, batch)
+        if reference is None:
+            logger.warning('No images to register')
+            return None
+        shifts = {}
+        for row in index.query(status = STATUS_OK, device = device):
+            if row['timestep'] in drift:
+                dx, dy = drift[row['timestep']]
+                shifts[(row['path'], row['page'])] = (-dx, -dy)
+    return shifts
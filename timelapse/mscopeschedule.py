@@ -0,0 +1,100 @@
+import math
+import time
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# what to do when a z-stack (with its retries) took longer than the period
+POLICY_SKIP = 'skip' # drop the slots that already passed and wait for the next one on the grid
+POLICY_COMPRESS = 'compress' # start the late z-stacks right away until the schedule has caught up
+OVERRUN_POLICIES = [POLICY_SKIP, POLICY_COMPRESS]
+
+# a z-stack this late is still started in its slot with the 'skip' policy
+DEFAULT_SKIP_TOLERANCE = 1.0
+
+class Schedule:
+    '''Fixed-rate schedule of the z-stacks of a time lapse.
+
+    Slot k starts at t0 + k * 'period_sec' on the monotonic clock, independent of how long the z-stacks take,
+    so the time lapse does not drift. When a z-stack overruns the period, 'policy' decides whether the passed
+    slots are skipped or the following z-stacks are started back to back until the schedule has caught up.
+    't0' is now, or the time of slot 0 of an earlier run given as 'start_time' in seconds since the epoch.
+    The period can be changed between slots with set_period(), e.g. to sample faster while the sample changes.
+    The clock and sleep function can be replaced, e.g. to test a schedule without waiting. Every slot that was
+    waited for is kept in 'history' as (slot, scheduled time, start time) for the jitter statistics.
+    '''
+
+    def __init__(self, period_sec, policy = POLICY_SKIP, start_time = None, first_slot = 0, skip_tolerance = DEFAULT_SKIP_TOLERANCE, \
+                 clock = time.monotonic, sleep = time.sleep):
+        if policy not in OVERRUN_POLICIES:
+            raise ValueError('Unknown overrun policy: ' + str(policy))
+        self.period_sec = period_sec
+        self.policy = policy
+        self.skip_tolerance = skip_tolerance
+        self.clock = clock
+        self.sleep = sleep
+
+        self.t0 = clock()
+        if start_time is not None:
+            # convert the wall clock start of an earlier run to our monotonic clock
+            self.t0 -= time.time() - start_time
+        self.next_slot = first_slot
+        self.missed_slots = 0
+        self.history = []
+
+    def slot_time(self, slot):
+        '''Monotonic time at which 'slot' starts.'''
+        return self.t0 + slot * self.period_sec
+
+    def set_period(self, period_sec):
+        '''Change the period from the next slot on. The slots already scheduled keep their times, and the next slot
+        starts 'period_sec' after the last one, so the schedule still does not drift.'''
+        if period_sec == self.period_sec:
+            return
+        last_slot = self.next_slot - 1
+        self.t0 = self.slot_time(last_slot) - last_slot * period_sec
+        self.period_sec = period_sec
+
+    def wait(self, policy = None):
+        '''Wait for the next slot and return its number. 'policy' overrides the overrun policy of the schedule for this slot.'''
+        if policy is None:
+            policy = self.policy
+        slot = self.next_slot
+
+        now = self.clock()
+        if policy == POLICY_SKIP and now > self.slot_time(slot) + self.skip_tolerance:
+            late_slot = max(slot, math.ceil((now - self.t0) / self.period_sec))
+            if late_slot > slot:
+                logger.warning('Z-stack overran the period, skipping ' + str(late_slot - slot) + ' slots')
+                self.missed_slots += late_slot - slot
+                slot = late_slot
+
+        delay = self.slot_time(slot) - now
+        if delay > 0:
+            logger.info('Waiting ' + str(round(delay, 1)) + ' seconds to take the next z-stack (slot ' + str(slot) + ')')
+            self.sleep(delay)
+
+        self.history.append((slot, self.slot_time(slot), self.clock()))
+        self.next_slot = slot + 1
+        return slot
+
+    def stats(self):
+        '''Return a dictionary with the number of slots, the number of missed slots, and the mean, 95th percentile
+        and maximum jitter (start time minus scheduled time) in seconds.'''
+        jitter = np.array([started - scheduled for slot, scheduled, started in self.history])
+        result = {'slots': len(self.history), 'missed': self.missed_slots}
+        if len(jitter) > 0:
+            result['mean_sec'] = float(np.mean(jitter))
+            result['p95_sec'] = float(np.percentile(jitter, 95))
+            result['max_sec'] = float(np.max(jitter))
+        else:
+            result['mean_sec'] = 0.0
+            result['p95_sec'] = 0.0
+            result['max_sec'] = 0.0
+        return result
+
+    def log_stats(self):
+        s = self.stats()
+        logger.info('Schedule: {} slots, {} missed, start jitter mean {:.3f}s / p95 {:.3f}s / max {:.3f}s'.format(
+            s['slots'], s['missed'], s['mean_sec'], s['p95_sec'], s['max_sec']))
@@ -5,7 +5,10 @@ logger = logging.getLogger(__name__)
 
 # tell python where compiled miniscope module is installed
 sys.path.append('/lib/python3.10/dist-packages/')
-from miniscope import Miniscope, ControlKind
+try:
+    from miniscope import Miniscope, ControlKind
+except ImportError:
+    pass # only the simulated Miniscope is available
 
 def setup_miniscope(m, miniscope_name, daq_id):
     '''Take a freshly instantiated miniscope 'm', run some setup diagnostics on it, and get it running'''
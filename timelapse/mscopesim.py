@@ -0,0 +1,643 @@
+import os
+import json
+import time
+import threading
+from datetime import timedelta
+from collections import deque, OrderedDict
+import numpy as np
+import cv2
+
+import logging
+logger = logging.getLogger(__name__)
+
+# hardware definitions shared with libminiscope, so simulated devices have the same names and sizes
+DEVICE_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libminiscope', 'miniscopes.json')
+
+# same depth as the display queue in libminiscope's Miniscope::addDisplayFrameToBuffer
+DISPLAY_QUEUE_MAX = 48
+# same size as libminiscope's ring buffer of the newest frames
+FRAME_RING_SIZE = 8
+
+def load_device_configs(path = DEVICE_CONFIG_PATH):
+    '''Read the Miniscope hardware definitions into a dictionary keyed by device type.'''
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def control_start_value(ctl):
+    '''Convert the 'startValue' of a control definition from miniscopes.json into a control value.'''
+    start = ctl.get('startValue', 0)
+    if isinstance(start, str):
+        return ctl.get('displaySpinBoxValues', []).index(start)
+    return start
+
+class SimulatedControl:
+    '''Subset of miniscope.ControlDefinition for a control of a simulated device.'''
+
+    def __init__(self, control_id, ctl):
+        settle = ctl.get('settle', {})
+        self.id = control_id
+        self.name = control_id
+        self.value_min = ctl.get('min', -1)
+        self.value_max = ctl.get('max', -1)
+        self.value_start = control_start_value(ctl)
+        self.step_size = ctl.get('stepSize', 1)
+        self.labels = ctl.get('displaySpinBoxValues', [])
+        self.values = ctl.get('displayTextValues', [])
+        self.settle_frames = settle.get('frames', 2)
+        self.settle_max_frames = settle.get('maxFrames', 0)
+        self.settle_tolerance = settle.get('tolerance', 0)
+
+class SimulatedFrameStats:
+    '''Stand-in for miniscope.FrameStats, computed with numpy instead of libminiscope's single pass.'''
+
+    def __init__(self, frame, blank_threshold = 0):
+        self.min = int(frame.min())
+        self.max = int(frame.max())
+        self.mean = float(frame.mean())
+        self.histogram = np.bincount((frame >> 4).ravel(), minlength = 16).tolist()
+        f = frame.astype(np.int32)
+        grad = np.sum(np.diff(f, axis = 1) ** 2) + np.sum(np.diff(f, axis = 0) ** 2)
+        self.sharpness = float(grad) / frame.size
+        self.blank = self.max <= blank_threshold
+
+class SimulatedTimedFrame:
+    '''Stand-in for miniscope.TimedFrame.'''
+
+    def __init__(self, frame, seq, timestamp, capture_time, stats):
+        self.frame = frame
+        self.stats = stats
+        self.seq = seq
+        self.timestamp = timestamp
+        self.capture_time = capture_time
+
+class SimulatedFrameAverage:
+    '''Stand-in for miniscope.FrameAverage.'''
+
+    def __init__(self):
+        self.mean = None
+        self.max = None
+        self.variance = None
+        self.count = 0
+        self.blank_count = 0
+        self.first_seq = 0
+        self.last_seq = 0
+        self.stats = None
+
+class SimulatedEncoderStats:
+    '''Stand-in for miniscope.EncoderStats. The simulator does not record videos, so all counters stay at 0.'''
+
+    def __init__(self):
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.encoded_frames = 0
+        self.dropped_frames = 0
+        self.last_latency_ms = 0.0
+        self.mean_latency_ms = 0.0
+        self.max_latency_ms = 0.0
+
+class SimulatedZStackTask:
+    '''Stand-in for miniscope.ZStackTask, running a z-stack job of a SimulatedMiniscope in a thread.'''
+
+    def __init__(self, job, output_path):
+        self._output_path = output_path
+        self._progress = 0
+        self._error = None
+        self._cancel_event = threading.Event()
+        self._done_event = threading.Event()
+        self._thread = threading.Thread(target = self._run, args = (job,), daemon = True)
+        self._thread.start()
+
+    @property
+    def progress(self):
+        return self._progress
+
+    @property
+    def done(self):
+        return self._done_event.is_set()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def wait(self, timeout = -1):
+        return self._done_event.wait(None if timeout < 0 else timeout)
+
+    def result(self):
+        self._done_event.wait()
+        if self._error is not None:
+            raise RuntimeError(self._error)
+        return self._output_path
+
+    def _set_progress(self, value):
+        self._progress = int(value)
+
+    def _check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise RuntimeError('Z-Stack acquisition was cancelled.')
+
+    def _run(self, job):
+        try:
+            job(self)
+        except Exception as e:
+            self._error = str(e)
+        finally:
+            self._done_event.set()
+
+class SimulatedMiniscope:
+    '''Hardware-free stand-in for miniscope.Miniscope.
+
+    Frames are synthesized in a background thread at the device frame rate. The image is a fixed
+    field of fluorescent blobs that gets blurred the further the EWL is from 'focal_plane', and
+    scaled by the LED and gain settings. The illumination falls off towards the corners by up to
+    'vignetting', and every frame after the warm-up has a fixed-pattern offset of about 'dark_offset',
+    also with the LED off (set the blank threshold above it). Every run() starts with 'warmup_frames'
+    black frames, like a freshly connected DAQ, and control changes only show up after 'control_latency' frames.
+    Disconnects can be injected with inject_disconnect() or by setting 'disconnect_after' to a
+    number of frames.
+    '''
+
+    def __init__(self, focal_plane = 0, blur_per_step = 0.4, warmup_frames = 30, control_latency = 2,
+                 noise = 1.0, fps = None, disconnect_after = None, seed = 0, vignetting = 0.35, dark_offset = 0):
+        self.focal_plane = focal_plane
+        self.blur_per_step = blur_per_step
+        self.warmup_frames = warmup_frames
+        self.control_latency = control_latency
+        self.noise = noise
+        self.vignetting = vignetting
+        self.dark_offset = dark_offset
+        self.disconnect_after = disconnect_after
+        self.bno_indicator_visible = True
+        self.blank_threshold = 0
+        self.encoder_threads = 1
+        self.encoder_threading = 0
+
+        self._fps_override = fps
+        self._fps = fps if fps is not None else 20
+        self._rng = np.random.default_rng(seed)
+        self._configs = load_device_configs()
+        self._device_type = ''
+        self._config = None
+        self._cam_id = 0
+        self._last_error = ''
+
+        self._values = {}
+        self._gain_factors = [1]
+        self._pending = deque()
+
+        self._connected = False
+        self._running = False
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._frame_cond = threading.Condition(self._lock)
+        self._display_queue = deque()
+        self._frame_ring = deque(maxlen = FRAME_RING_SIZE)
+        self._frame_seq = 0
+        self._last_frame = None
+        self._frame_count = 0
+        self._current_fps = 0
+        self._dropped_frames = 0
+        self._cycle_time = timedelta(0)
+        self._min_fluor = 0
+        self._max_fluor = 0
+
+        self._pattern = None
+        self._blur_cache = OrderedDict()
+        self._shading = None # (vignetting, dark_offset, illumination map, dark frame) the maps were made for
+
+    @property
+    def available_device_types(self):
+        return sorted(self._configs.keys())
+
+    @property
+    def device_type(self):
+        return self._device_type
+
+    @property
+    def controls(self):
+        if self._config is None:
+            return []
+        return [SimulatedControl(cid, ctl) for cid, ctl in self._config.get('controlSettings', {}).items()]
+
+    @property
+    def last_error(self):
+        return self._last_error
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    @property
+    def is_running(self):
+        return self._running
+
+    @property
+    def current_fps(self):
+        return self._current_fps
+
+    @property
+    def acquired_frame_count(self):
+        return self._frame_count if self._running else 0
+
+    @property
+    def dropped_frames_count(self):
+        return self._dropped_frames
+
+    @property
+    def capture_cycle_time(self):
+        return self._cycle_time
+
+    @property
+    def encode_queue_depth(self):
+        # the simulator does not record videos
+        return 0
+
+    @property
+    def encoder_stats(self):
+        return SimulatedEncoderStats()
+
+    @property
+    def min_fluor(self):
+        return self._min_fluor
+
+    @property
+    def max_fluor(self):
+        return self._max_fluor
+
+    @property
+    def current_disp_frame(self):
+        with self._lock:
+            if len(self._display_queue) == 0:
+                return None
+            return self._display_queue.popleft()
+
+    def wait_for_frame(self, timeout = 1.0):
+        with self._frame_cond:
+            self._frame_cond.wait_for(lambda: self._display_queue or not self._running, timeout)
+            if len(self._display_queue) == 0:
+                return None
+            return self._display_queue.popleft()
+
+    @property
+    def latest_frame(self):
+        with self._lock:
+            return self._frame_ring[-1] if self._frame_ring else None
+
+    @property
+    def frame_seq(self):
+        return self._frame_seq
+
+    def wait_for_frame_after(self, seq, timeout = 1.0):
+        with self._frame_cond:
+            self._frame_cond.wait_for(lambda: self._frame_seq > seq or not self._running, timeout)
+            return next((f for f in self._frame_ring if f.seq > seq), None)
+
+    def wait_for_frame_after_time(self, t, timeout = 1.0):
+        with self._frame_cond:
+            self._frame_cond.wait_for(lambda: (self._frame_ring and self._frame_ring[-1].capture_time > t) or not self._running, timeout)
+            return next((f for f in self._frame_ring if f.capture_time > t), None)
+
+    def average_frames(self, count, after_seq = None, with_max = False, with_variance = False, timeout = 1.0):
+        '''Average the next 'count' frames after 'after_seq', like Miniscope.average_frames.'''
+        result = SimulatedFrameAverage()
+        seq = self._frame_seq if after_seq is None else after_seq
+        acc = None
+        sq_acc = None
+        while result.count < count:
+            tf = self.wait_for_frame_after(seq, timeout)
+            if tf is None:
+                self._last_error = 'Frame averaging stopped after {} of {} frames, no new frame arrived.'.format(result.count, count)
+                break
+            seq = tf.seq
+
+            if acc is None:
+                acc = np.zeros(tf.frame.shape, np.float64)
+                if with_variance:
+                    sq_acc = np.zeros_like(acc)
+                if with_max:
+                    result.max = tf.frame.copy()
+                result.first_seq = tf.seq
+            elif with_max:
+                np.maximum(result.max, tf.frame, out = result.max)
+
+            acc += tf.frame
+            if with_variance:
+                sq_acc += np.square(tf.frame, dtype = np.float64)
+            if tf.stats.blank:
+                result.blank_count += 1
+            result.last_seq = tf.seq
+            result.count += 1
+
+        if result.count == 0:
+            return result
+        mean = acc / result.count
+        result.mean = np.clip(np.round(mean), 0, 255).astype(np.uint8)
+        if with_variance:
+            result.variance = np.maximum(sq_acc / result.count - mean * mean, 0).astype(np.float32)
+        result.stats = SimulatedFrameStats(result.mean, self.blank_threshold)
+        return result
+
+    def wait_for_acquired_frame_count(self, count):
+        if not self._running:
+            self._last_error = 'Miniscope was not running.'
+            return False
+        target = self._frame_count + count
+        with self._frame_cond:
+            # like libminiscope, give up after a bit more than the expected time
+            self._frame_cond.wait_for(lambda: self._frame_count >= target or not self._running,
+                                      count * 2.2 / self._fps)
+        return True
+
+    def set_print_extra_debug(self, enabled):
+        pass
+
+    def set_cam_id(self, cam_id):
+        self._cam_id = cam_id
+
+    def load_device_config(self, device_type):
+        if self._connected:
+            self.disconnect()
+        if device_type not in self._configs:
+            self._last_error = "Unable to find device configuration with name '{}'".format(device_type)
+            return False
+
+        self._config = self._configs[device_type]
+        self._device_type = device_type
+
+        controls = self._config.get('controlSettings', {})
+        self._values = {cid: control_start_value(ctl) for cid, ctl in controls.items()}
+        self._gain_factors = controls.get('gain', {}).get('displayTextValues', [1])
+
+        if self._fps_override is None and 'frameRate' in controls:
+            rates = controls['frameRate'].get('displayTextValues', [])
+            if self._values['frameRate'] < len(rates):
+                self._fps = rates[self._values['frameRate']]
+
+        self._pattern = None
+        self._blur_cache.clear()
+        return True
+
+    def connect(self):
+        if self._connected:
+            logger.warning('Tried to reconnect already connected camera.')
+            return False
+        if self._config is None:
+            self._last_error = 'Unable to connect to Miniscope: No device type to connect to was selected.'
+            return False
+        self._connected = True
+        return True
+
+    def disconnect(self):
+        self.stop()
+        self._connected = False
+
+    def hard_reset(self):
+        self.disconnect()
+        return True
+
+    def run(self):
+        if not self._connected:
+            return False
+        self.stop()
+
+        self._last_error = ''
+        self._frame_count = 0
+        self._dropped_frames = 0
+        self._frame_ring.clear()
+        self._stop_event.clear()
+        self._running = True
+        self._thread = threading.Thread(target = self._capture_loop, daemon = True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._running = False
+        self._stop_event.set()
+        with self._frame_cond:
+            self._frame_cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+    def control_value(self, control_id):
+        return self._values.get(control_id, -1)
+
+    def set_control_value(self, control_id, value):
+        if control_id not in self._values:
+            logger.warning('Unable to set nonexisting control {} to {}'.format(control_id, value))
+            return
+        with self._lock:
+            self._pending.append((self._frame_count + self.control_latency, control_id, value))
+
+    def capture_zstack(self, from_ewl, to_ewl, step, average_count, out_filename):
+        '''Capture a z-stack into a multi-page TIFF in the background, like Miniscope.capture_zstack.'''
+        if not out_filename.endswith('.tiff') and not out_filename.endswith('.tif'):
+            out_filename = out_filename + '.tiff'
+
+        def job(task):
+            stack = self._acquire_3d_data(from_ewl, to_ewl, step, average_count, task, task._set_progress)
+            if not cv2.imwritemulti(out_filename, stack, [cv2.IMWRITE_TIFF_COMPRESSION, 5]):
+                raise RuntimeError('Unable to write Z-Stack to ' + out_filename)
+            task._set_progress(100)
+
+        return SimulatedZStackTask(job, out_filename)
+
+    def accumulate_3d_view(self, from_ewl, to_ewl, step, count, save_raw, out_dir, out_name):
+        '''Acquire 'count' z-stacks in alternating direction and save their maximum intensity projection,
+        like Miniscope.accumulate_3d_view (without the brightness balancing).'''
+        out_named = os.path.join(os.path.abspath(out_dir), out_name)
+        mip_path = os.path.join(out_named, out_name + '_mip3D.tiff')
+
+        def job(task):
+            raw_dir = os.path.join(out_named, 'raw')
+            os.makedirs(raw_dir, exist_ok = True)
+            mip_stack = None
+            for i in range(count):
+                task._check_cancelled()
+                if i % 2 == 0:
+                    stack = self._acquire_3d_data(from_ewl, to_ewl, step, 1, task)
+                else:
+                    stack = self._acquire_3d_data(to_ewl, from_ewl, step, 1, task)[::-1]
+                if save_raw:
+                    cv2.imwritemulti(os.path.join(raw_dir, '{}_zstack_{}.tiff'.format(out_name, i)), stack)
+                if mip_stack is None:
+                    mip_stack = [s.copy() for s in stack]
+                else:
+                    for mip, s in zip(mip_stack, stack):
+                        np.maximum(mip, s, out = mip)
+                task._set_progress(100.0 * (i + 1) / (count + 1))
+            if not save_raw:
+                os.rmdir(raw_dir)
+            cv2.imwritemulti(mip_path, mip_stack)
+            task._set_progress(100)
+
+        return SimulatedZStackTask(job, mip_path)
+
+    def _acquire_3d_data(self, from_ewl, to_ewl, step, average_count, task, set_progress = None):
+        '''Python version of acquire3DData from libminiscope's zstackcapture.cpp.'''
+        if from_ewl == to_ewl:
+            raise RuntimeError('EWL start and end positions must be different.')
+        if step == 0:
+            raise RuntimeError('Step size can not be zero.')
+        if average_count == 0:
+            raise RuntimeError('Image average count must not be zero.')
+        if not self._running:
+            raise RuntimeError('Can not acquire Z-Stack while Miniscope is not running.')
+
+        ewl = next(ctl for ctl in self.controls if ctl.id == 'ewl')
+        step_signed = step if from_ewl < to_ewl else -step
+        max_progress = abs(from_ewl - to_ewl) // step
+
+        stack = []
+        for pos in range(from_ewl, to_ewl, step_signed):
+            task._check_cancelled()
+            self.set_control_value('ewl', pos)
+            self.wait_for_acquired_frame_count(max(ewl.settle_frames, 1))
+            if not self._running:
+                raise RuntimeError(self._last_error or 'Miniscope stopped during Z-Stack acquisition.')
+
+            acc = None
+            for i in range(average_count):
+                self.wait_for_acquired_frame_count(1)
+                frame = self._last_frame.astype(np.float32)
+                acc = frame if acc is None else acc + frame
+            stack.append((acc / average_count).astype(np.uint8))
+
+            if set_progress is not None:
+                set_progress(100.0 / max_progress * len(stack))
+        return stack
+
+    def inject_disconnect(self):
+        '''Make the running acquisition fail as if the DAQ box dropped off the USB bus.'''
+        self._fail('Failed to grab frame.')
+
+    def _fail(self, msg):
+        self._last_error = msg
+        self._running = False
+        self._stop_event.set()
+        with self._frame_cond:
+            self._frame_cond.notify_all()
+
+    def _make_pattern(self):
+        '''Generate an in-focus field of fluorescent blobs, normalized to [0, 1].'''
+        height = self._config.get('height', 608)
+        width = self._config.get('width', 608)
+        pattern = np.zeros((height, width), np.float32)
+        nblobs = (height * width) // 400
+        ys = self._rng.integers(0, height, nblobs)
+        xs = self._rng.integers(0, width, nblobs)
+        pattern[ys, xs] = self._rng.uniform(0.3, 1.0, nblobs).astype(np.float32)
+        pattern = cv2.GaussianBlur(pattern, (0, 0), 1.0)
+        pattern *= 1.0 / max(float(np.percentile(pattern, 99.9)), 1e-6)
+        np.minimum(pattern, 1.0, out = pattern)
+        pattern += 0.2 # autofluorescence background, keeps defocused planes above the signal threshold
+        return pattern
+
+    def _blurred_pattern(self, ewl):
+        '''Return the base pattern as seen with the EWL at 'ewl', caching the last few focus positions.'''
+        ewl = int(round(ewl))
+        # keyed by the focal plane as well, so a sample drifting in z is seen right away
+        key = (ewl, self.focal_plane)
+        if key in self._blur_cache:
+            self._blur_cache.move_to_end(key)
+            return self._blur_cache[key]
+
+        if self._pattern is None:
+            self._pattern = self._make_pattern()
+        sigma = self.blur_per_step * abs(ewl - self.focal_plane)
+        blurred = cv2.GaussianBlur(self._pattern, (0, 0), sigma) if sigma > 0.3 else self._pattern
+
+        self._blur_cache[key] = blurred
+        if len(self._blur_cache) > 4:
+            self._blur_cache.popitem(last = False)
+        return blurred
+
+    def _shading_maps(self, height, width):
+        '''Return the illumination falloff and the fixed-pattern dark frame, made again when their settings changed.'''
+        if self._shading is None or self._shading[:2] != (self.vignetting, self.dark_offset) or self._shading[2].shape != (height, width):
+            ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+            r2 = ((xs - width / 2) / (width / 2)) ** 2 + ((ys - height / 2) / (height / 2)) ** 2
+            illumination = 1.0 - self.vignetting * r2 / 2 # 2 is r^2 in the corners
+            rng = np.random.default_rng(1)
+            dark = (self.dark_offset + rng.normal(0, self.dark_offset / 4, (height, width))).astype(np.float32) if self.dark_offset > 0 else None
+            self._shading = (self.vignetting, self.dark_offset, illumination, dark)
+        return self._shading[2], self._shading[3]
+
+    def _render(self):
+        '''Synthesize one grayscale frame for the current control values.'''
+        height = self._config.get('height', 608)
+        width = self._config.get('width', 608)
+        led = self._values.get('led0', 0)
+        if self._frame_count < self.warmup_frames:
+            return np.zeros((height, width), np.uint8)
+        illumination, dark = self._shading_maps(height, width)
+        if led <= 0:
+            if dark is None:
+                return np.zeros((height, width), np.uint8)
+            return np.clip(dark, 0, 255).astype(np.uint8)
+
+        gain_idx = int(self._values.get('gain', 0))
+        gain = self._gain_factors[gain_idx] if gain_idx < len(self._gain_factors) else 1
+        scale = 255.0 * (led / 100.0) * gain
+
+        frame = self._blurred_pattern(self._values.get('ewl', 0)) * scale
+        if self.vignetting > 0:
+            frame *= illumination
+        if dark is not None:
+            frame += dark
+        if self.noise > 0:
+            noise = np.empty_like(frame)
+            cv2.randn(noise, 0, self.noise)
+            frame += noise
+        np.clip(frame, 0, 255, out = frame)
+        return frame.astype(np.uint8)
+
+    def _capture_loop(self):
+        period = 1.0 / self._fps
+        next_time = time.monotonic()
+        last_time = next_time
+
+        while self._running:
+            cycle_start = time.monotonic()
+            # apply control changes once the simulated hardware has caught up with them
+            with self._lock:
+                while self._pending and self._pending[0][0] <= self._frame_count:
+                    _, control_id, value = self._pending.popleft()
+                    self._values[control_id] = value
+
+            frame = self._render()
+            stats = SimulatedFrameStats(frame, self.blank_threshold)
+            self._min_fluor = stats.min
+            self._max_fluor = stats.max
+
+            with self._frame_cond:
+                # drop frames if nobody is reading them, like libminiscope does
+                if len(self._display_queue) < DISPLAY_QUEUE_MAX:
+                    self._display_queue.append(frame)
+                self._frame_seq += 1
+                self._frame_ring.append(SimulatedTimedFrame(frame, self._frame_seq,
+                                                            timedelta(seconds = self._frame_count / self._fps), time.monotonic(),
+                                                            stats))
+                self._last_frame = frame
+                self._frame_count += 1
+                self._frame_cond.notify_all()
+
+            if self.disconnect_after is not None and self._frame_count >= self.disconnect_after:
+                self._fail('Failed to grab frame.')
+                break
+
+            now = time.monotonic()
+            self._cycle_time = timedelta(seconds = now - cycle_start)
+            if now > last_time:
+                self._current_fps = int(1.0 / (now - last_time))
+            last_time = now
+
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay < 0:
+                # we fell behind, don't try to catch up with a burst of frames
+                next_time = time.monotonic()
+                delay = 0
+            if self._stop_event.wait(delay):
+                break
+
+        self._running = False
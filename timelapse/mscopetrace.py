@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+TRACE_FILENAME = 'trace.json'
+
+class Tracer:
+    '''Records how long each phase of a time lapse takes, as a Chrome trace (open it in chrome://tracing or
+    https://ui.perfetto.dev).
+
+    Phases are recorded with span() as complete events, measurements like queue depths with counter(). Every event
+    is appended to the trace file at 'path' as soon as it ends, so a crashed or interrupted time lapse still leaves
+    its trace behind; the JSON array is never closed, which the trace viewers accept. Timestamps are wall clock
+    microseconds, so a resumed time lapse continues the trace of the original run. Each thread, e.g. each device of
+    a multi-device time lapse, gets its own track. Without a 'path', events are only summed up for log_stats().
+    The tracer is safe to use from several threads.
+    '''
+
+    def __init__(self, path = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._threads = set()
+        self._totals = {} # span name -> [count, total seconds, max seconds]
+        # wall clock anchor for the high resolution performance counter
+        self._epoch = time.time()
+        self._perf = time.perf_counter()
+
+        self._file = None
+        if path is not None:
+            new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+            self._file = open(path, 'a')
+            if new_file:
+                self._file.write('[\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _now_us(self):
+        return (self._epoch + time.perf_counter() - self._perf) * 1e6
+
+    def _emit(self, event):
+        '''Write 'event' to the trace file, with the process and thread it happened in. Needs the lock.'''
+        if self._file is None:
+            return
+        thread = threading.current_thread()
+        event['pid'] = self._pid
+        event['tid'] = thread.ident
+        if thread.ident not in self._threads:
+            # name the track of a new thread
+            self._threads.add(thread.ident)
+            self._file.write(json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': thread.ident,
+                                         'args': {'name': thread.name}}) + ',\n')
+        self._file.write(json.dumps(event) + ',\n')
+        self._file.flush()
+
+    @contextmanager
+    def span(self, name, **args):
+        '''Context manager recording the time spent in its block as the phase 'name', with 'args' shown as details.'''
+        start = self._now_us()
+        try:
+            yield
+        finally:
+            duration = self._now_us() - start
+            with self._lock:
+                total = self._totals.setdefault(name, [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += duration / 1e6
+                total[2] = max(total[2], duration / 1e6)
+                self._emit({'name': name, 'ph': 'X', 'ts': start, 'dur': duration, 'args': args})
+
+    def instant(self, name, **args):
+        '''Record a single point in time, like a retry or an error.'''
+        with self._lock:
+            self._emit({'name': name, 'ph': 'i', 's': 't', 'ts': self._now_us(), 'args': args})
+
+    def counter(self, name, **values):
+        '''Record the current 'values' of the counter 'name', shown as a graph by the trace viewers.'''
+        with self._lock:
+            self._emit({'name': name, 'ph': 'C', 'ts': self._now_us(), 'args': values})
+
+    def miniscope_counters(self, m):
+        '''Record the state of the capture and video encoding threads of the Miniscope 'm'.'''
+        self.counter('capture',
+                     cycle_ms = m.capture_cycle_time.total_seconds() * 1000,
+                     fps = m.current_fps,
+                     dropped_frames = m.dropped_frames_count)
+        stats = m.encoder_stats
+        self.counter('encoder',
+                     queue = stats.queue_depth,
+                     latency_ms = stats.last_latency_ms,
+                     dropped_frames = stats.dropped_frames)
+
+    def stats(self):
+        '''Return a dictionary with the count, total, mean and maximum seconds of every span name.'''
+        with self._lock:
+            return {name: {'count': count, 'total_sec': total, 'mean_sec': total / count, 'max_sec': maximum}
+                    for name, (count, total, maximum) in self._totals.items()}
+
+    def log_stats(self):
+        for name, s in sorted(self.stats().items(), key = lambda item: -item[1]['total_sec']):
+            logger.info('Phase {}: {} times, total {:.2f}s, mean {:.3f}s, max {:.3f}s'.format(
+                name, s['count'], s['total_sec'], s['mean_sec'], s['max_sec']))
+
+# the tracer used by the time lapse functions, only sums up the phases until set_tracer() is called
+_tracer = Tracer()
+
+def get_tracer():
+    return _tracer
+
+def set_tracer(tracer):
+    '''Make 'tracer' the tracer of all time lapse functions, e.g. one writing to a trace file.'''
+    global _tracer
+    _tracer = tracer
+
+def span(name, **args):
+    '''Record the phase 'name' with the current tracer, see Tracer.span.'''
+    return _tracer.span(name, **args)
+
+def instant(name, **args):
+    _tracer.instant(name, **args)
+
+def counter(name, **values):
+    _tracer.counter(name, **values)
+
+def read_trace(path):
+    '''Read the events of the trace file at 'path', also if its JSON array was left open.'''
+    with open(path, 'r') as f:
+        text = f.read().rstrip()
+    if not text.endswith(']'):
+        text = text.rstrip(',') + ']'
+    return json.loads(text)
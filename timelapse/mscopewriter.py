@@ -0,0 +1,192 @@
+import os
+import time
+import queue
+import shutil
+import threading
+from collections import deque
+import numpy as np
+import cv2
+
+from mscopetrace import span
+
+import logging
+logger = logging.getLogger(__name__)
+
+# number of recent writes kept for the latency percentiles in ImageWriter.stats()
+LATENCY_HISTORY = 1000
+
+# LZW compressed, like the z-stacks written by libminiscope's zstackcapture
+TIFF_STACK_PARAMS = [cv2.IMWRITE_TIFF_COMPRESSION, 5]
+
+class ImageWriter:
+    '''Bounded background writer for time lapse frames.
+
+    Frames are encoded, written and fsynced by 'num_workers' threads, so image compression stays out of the
+    acquisition loop. At most 'max_queue' frames wait to be written; write() blocks when the queue is full,
+    which keeps memory bounded if the disk can not keep up. Extra paths for a frame (e.g. the zselect copies)
+    are created as hardlinks to the written file instead of encoding the frame again.
+    '''
+
+    def __init__(self, num_workers = 2, max_queue = 32, fsync = True):
+        self.fsync = fsync
+        self._queue = queue.Queue(maxsize = max_queue)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen = LATENCY_HISTORY)
+        self._write_count = 0
+        self._failed_count = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+        self._blocked_time = 0.0
+        self._closed = False
+
+        self._workers = []
+        for i in range(num_workers):
+            t = threading.Thread(target = self._work, name = 'ImageWriter-' + str(i), daemon = True)
+            t.start()
+            self._workers.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, path, frame, links = ()):
+        '''Queue 'frame' to be written to 'path', and hardlinked to every path in 'links' afterwards.
+        The frame must not be modified by the caller after it was queued.'''
+        if self._closed:
+            raise RuntimeError('Can not write to a closed ImageWriter.')
+
+        start = time.perf_counter()
+        self._queue.put((path, frame, tuple(links), start))
+        blocked = time.perf_counter() - start
+        if blocked > 0.01:
+            logger.debug('Image writer queue full, capture waited {:.3f} seconds'.format(blocked))
+            with self._lock:
+                self._blocked_time += blocked
+
+    def write_stack(self, path, frames, links = ()):
+        '''Queue a list of frames to be written to 'path' as one multi-page TIFF, one page per frame.'''
+        self.write(path, list(frames), links)
+
+    @property
+    def queue_depth(self):
+        '''Number of frames waiting to be written.'''
+        return self._queue.qsize()
+
+    def flush(self):
+        '''Wait until all queued frames have been written.'''
+        self._queue.join()
+
+    def close(self):
+        '''Write all remaining frames and stop the worker threads.'''
+        if self._closed:
+            return
+        self._closed = True
+        for t in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+
+    def stats(self):
+        '''Return a dictionary with the number of written and failed frames, the time the capture loop
+        was blocked by a full queue, and the mean, median, 95th percentile and maximum latency in seconds
+        from queueing a frame until it was safely on disk.'''
+        with self._lock:
+            latencies = np.array(self._latencies)
+            result = {'written': self._write_count,
+                      'failed': self._failed_count,
+                      'queued': self._queue.qsize(),
+                      'blocked_sec': self._blocked_time,
+                      'mean_sec': self._total_latency / self._write_count if self._write_count > 0 else 0.0,
+                      'max_sec': self._max_latency}
+        if len(latencies) > 0:
+            result['median_sec'] = float(np.percentile(latencies, 50))
+            result['p95_sec'] = float(np.percentile(latencies, 95))
+        else:
+            result['median_sec'] = 0.0
+            result['p95_sec'] = 0.0
+        return result
+
+    def log_stats(self):
+        s = self.stats()
+        logger.info('Image writer: {} written, {} failed, latency mean {:.3f}s / p95 {:.3f}s / max {:.3f}s, capture blocked {:.2f}s'.format(
+            s['written'], s['failed'], s['mean_sec'], s['p95_sec'], s['max_sec'], s['blocked_sec']))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, frame, links, queued_time = item
+                with span('write_image', file = os.path.basename(path)):
+                    self._write_one(path, frame, links, queued_time)
+            finally:
+                self._queue.task_done()
+
+    def _write_one(self, path, frame, links, queued_time):
+        try:
+            if isinstance(frame, list):
+                encode_and_write_stack(path, frame, self.fsync)
+            else:
+                ok, buf = cv2.imencode(os.path.splitext(path)[1], frame)
+                if not ok:
+                    raise RuntimeError('could not encode image')
+                write_file(path, buf, self.fsync)
+
+            for link in links:
+                link_file(path, link)
+        except Exception as e:
+            logger.error('Failed to write image ' + path + ': ' + str(e))
+            with self._lock:
+                self._failed_count += 1
+            return
+
+        latency = time.perf_counter() - queued_time
+        with self._lock:
+            self._latencies.append(latency)
+            self._write_count += 1
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+
+def write_file(path, buf, fsync = True):
+    '''Write the encoded image 'buf' to 'path', making sure it is on disk if 'fsync' is set.'''
+    with open(path, 'wb') as f:
+        f.write(buf)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+def encode_and_write_stack(path, frames, fsync = True):
+    '''Write 'frames' to 'path' as a multi-page TIFF.'''
+    if hasattr(cv2, 'imencodemulti'):
+        ok, buf = cv2.imencodemulti('.tiff', frames, TIFF_STACK_PARAMS)
+        if not ok:
+            raise RuntimeError('could not encode image stack')
+        write_file(path, buf, fsync)
+        return
+
+    # older OpenCV versions can only write multi-page images to a file directly
+    if not cv2.imwritemulti(path, frames, TIFF_STACK_PARAMS):
+        raise RuntimeError('could not write image stack')
+    if fsync:
+        with open(path, 'rb') as f:
+            os.fsync(f.fileno())
+
+def read_stack_page(path, page):
+    '''Read a single page of a multi-page TIFF, without decoding the other pages.'''
+    ok, frames = cv2.imreadmulti(path, start = page, count = 1, flags = cv2.IMREAD_UNCHANGED)
+    if not ok or len(frames) == 0:
+        return None
+    return frames[0]
+
+def link_file(src, dst):
+    '''Hardlink 'src' to 'dst', replacing an existing 'dst'. Falls back to copying on file systems
+    without hardlink support.'''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
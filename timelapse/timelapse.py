@@ -7,25 +7,47 @@ MINISCOPE_NAME = 'Miniscope_V4_BNO'  # the device type we want to connect to
 DAQ_ID = 0  # the video device ID of our DAQ box
 BASE_IMAGE_DIRNAME = '/home/agroo/niko_miniscope_vids/timelapse_test' # path to the folder we will store time lapse images in
 FFMPEG_PATH = '/home/agroo/src/ffmpeg-git-20240301-amd64-static/ffmpeg' # path to ffmpeg installation
+STACK_DIRNAME = 'stacks' # sub-directory for the multi-page TIFFs of the 'stack' output layout
+PROJECTION_Z_INDEX = -1 # z-index of the projections of each z-stack in the image index, before all planes
+DEFAULT_COARSE_STEPS = 4 # z-stack steps per focus sweep step of adaptive z-stacks, if --coarse-step is not given
+# command line options stored in the image index, and restored when resuming a time lapse
+RUN_SETTINGS = ['zstack', 'excitation', 'gain', 'timesteps', 'period', 'imgformat', 'layout', 'persistent', 'simulate', \
+                'average', 'blank_threshold', 'overrun', 'device_config', 'adaptive', 'coarse_step', 'period_range', 'change_thresholds', 'projections', 'register', 'register_plane', 'correct', 'flat', 'fps', 'size', 'codec', 'crf']
 
 import time
 from datetime import datetime
 import os
 import sys
+import contextlib
+import threading
 import cv2
-import subprocess
 import argparse
-import numpy as np
 
 import logging
 logger = logging.getLogger(__name__)
 
 # tell python where compiled miniscope module is installed
 sys.path.append('/lib/python3.10/dist-packages/')
-from miniscope import Miniscope, ControlKind
+try:
+    from miniscope import Miniscope, ControlKind
+except ImportError:
+    # no compiled module on this machine, only the simulated Miniscope (-s) is usable
+    Miniscope = None
 
 from mscopesetup import setup_miniscope
-from mscopecontrol import set_led, set_focus, set_gain, get_frame
+from mscopecontrol import set_led, set_focus, set_gain, get_frame_after
+from mscopesim import SimulatedMiniscope
+from mscopewriter import ImageWriter
+from mscopetrace import Tracer, TRACE_FILENAME, get_tracer, set_tracer, span, instant, counter
+from mscopedevices import load_devices, DeviceCoordinator
+from mscopeschedule import Schedule, OVERRUN_POLICIES, POLICY_SKIP
+from mscopefocus import FocusTracker, focus_score
+from mscopeproject import Projector, PROJECTIONS
+from mscopecorrect import FlatFieldCorrector, REFERENCE_DIRNAME, CORRECT_MODES, CORRECT_RUN
+from mscopechange import ChangeDetector, DEFAULT_LOW_CHANGE, DEFAULT_HIGH_CHANGE
+from mscopeindex import ImageIndex, read_image_index, INDEX_FILENAME, STATUS_OK, STATUS_FAILED, STATUS_BLANK
+from mscoperegister import register_timelapse
+from mscopemerge import merge_timelapse, LiveMerger, DEFAULT_WORKERS, DEFAULT_FPS, DEFAULT_SIZE, DEFAULT_CODEC, DEFAULT_CRF
 
 def z_int_to_string(z_index, focus):
     '''Convert a z-level integer and its index to a friendlier string for filepaths'''
@@ -58,6 +80,24 @@ def generate_file_path(image_dir, time_step, z_index, focus, led, gain, img_form
 
     return finalpath
 
+def generate_stack_path(image_dir, time_step, led, gain, zselect = False):
+    '''Generate an absolute path for the multi-page TIFF holding the z-stack of one timestep. Create the stacks directory if needed.'''
+    img_name = 'miniscope_t' + str(time_step) + '_led' + str(led) + '_gain' + str(gain) + '.tiff'
+    if zselect:
+        return os.path.join(image_dir, 'zselect', img_name)
+
+    if not os.path.exists(os.path.join(image_dir, STACK_DIRNAME)):
+        os.makedirs(os.path.join(image_dir, STACK_DIRNAME))
+    return os.path.join(image_dir, STACK_DIRNAME, img_name)
+
+def generate_projection_path(image_dir, time_step, projection, led, gain, img_format):
+    '''Generate an absolute path for the projection 'projection' of the z-stack of one timestep, in a directory of its own
+    like a z-level. Create the directory if needed.'''
+    if not os.path.exists(os.path.join(image_dir, projection)):
+        os.makedirs(os.path.join(image_dir, projection))
+    img_name = 'miniscope_t' + str(time_step) + '_' + params_to_suffix(projection, led, gain) + '.' + img_format
+    return os.path.join(image_dir, projection, img_name)
+
 # # orig version of take_photo, hangs if miniscope disconnects, sometimes sends out blank frames
 # def take_photo0(m, nbuffer_frames = 50):
 #     '''Take a photo with the Miniscope'''
@@ -69,45 +109,65 @@ def generate_file_path(image_dir, time_step, z_index, focus, led, gain, img_form
     
 #     return frame
 
-# # less efficient version of take_photo, grabs way more frames than needed for most cases
-# def take_photo1(m):
-#     '''Take a photo with the Miniscope'''
-#     i = 0
-#     frame = None
-#     buffer_frames = 50
-#     while i<buffer_frames:
-#         frame = get_frame(m)
-#         i += 1
-#     return frame    
-
-def frame_debug_info(f):
-    if f is None:
+def frame_debug_info(tf):
+    if tf is None:
         logger.debug('Frame is None')
     else:
-        fmax = np.max(f)
-        fsum = np.sum(f)
-        logger.debug('Frame max: ' + str(fmax))
-        logger.debug('Frame sum: ' + str(fsum))
+        logger.debug('Frame {} min: {} max: {} mean: {:.1f} sharpness: {:.1f} blank: {}'.format(
+            tf.seq, tf.stats.min, tf.stats.max, tf.stats.mean, tf.stats.sharpness, tf.stats.blank))
 
 def warm_up_miniscope(m):
     '''Flushes through a bunch of frames to get the signal started on a freshly connected Miniscope.'''
     i = 0
     flush_size = 100
     signal_threshold = 10
+    seq = m.frame_seq
+    last = None
 
     while i < flush_size:
-        frame = get_frame(m)
-        # frame_debug_info(frame)
+        tf = get_frame_after(m, seq)
+        if tf is not None:
+            seq = tf.seq
+            last = tf
+            # frame_debug_info(tf)
+        elif not m.is_running:
+            return False
         i += 1
     
-    return np.max(frame) > signal_threshold
+    return last is not None and last.stats.max > signal_threshold
+
+def detect_signal(m, signal_threshold = 10, good_frame_min = 3, timeout_frame_max = 100):
+    '''Check that an already running Miniscope delivers frames with signal again, e.g. after turning the LED back on.
+    Returns as soon as 'good_frame_min' consecutive frames have signal, instead of flushing a fixed number of frames.'''
+    seq = m.frame_seq
+
+    good_frame_count = 0
+    for i in range(timeout_frame_max):
+        tf = get_frame_after(m, seq)
+        if tf is None:
+            if not m.is_running:
+                return False
+            continue
+        seq = tf.seq
+
+        if tf.stats.max > signal_threshold:
+            good_frame_count += 1
+            if good_frame_count >= good_frame_min:
+                return True
+        else:
+            good_frame_count = 0
 
-def take_photo(m):
-    '''Take a photo with the Miniscope'''
+    return False
+
+def take_photo(m, after_seq = None):
+    '''Take a photo with the Miniscope, using only frames with a sequence number above 'after_seq'
+    (by default the newest frame), e.g. the value returned by set_focus.
+    Returns the photo as TimedFrame, with the frame statistics computed by the capture thread.'''
 
     i = 0 # frame index
-    frame = None
+    photo = None
     timeout_frame_min = 100 # stop trying after this many blank/none frames
+    seq = m.frame_seq if after_seq is None else after_seq
 
     good_frame_count = 0
     good_frame_min = 3 # take this many frames after we start getting signal
@@ -115,154 +175,431 @@ def take_photo(m):
     # when it first connects, the camera sends zero signal for a few dozen frames
     # wait until a signal is detected for a few frames at a time, then save the newest one
     while i < timeout_frame_min:
-        frame = get_frame(m)
-        # frame_debug_info(frame)
-        
-        if frame is not None:
-            if np.any(frame):
+        tf = get_frame_after(m, seq)
+        photo = tf
+        if tf is not None:
+            seq = tf.seq
+            # frame_debug_info(tf)
+
+            if not tf.stats.blank:
                 good_frame_count += 1
 
             if good_frame_count >= good_frame_min:
                 break
+        elif not m.is_running:
+            break
 
         i += 1
 
-    return frame
+    return photo
+
+def take_averaged_photo(m, after_seq, count):
+    '''Take a photo like take_photo, and average it with the following frames in native code to reduce shot noise.
+    Returns a FrameAverage of 'count' frames, or None if the Miniscope stopped delivering frames.'''
+    photo = take_photo(m, after_seq)
+    if photo is None:
+        return None
+
+    # the photo itself is the first frame of the average
+    avg = m.average_frames(count, photo.seq - 1)
+    if avg.count < count:
+        logger.warning('Averaged only ' + str(avg.count) + ' of ' + str(count) + ' frames')
+        return None
+    return avg
         
 
-def take_zstack(m, image_dir, time_step, zparams, led, gain, index_file, img_format):
-    '''Shoot a z-stack of photos with the Miniscope'''
-    current_focus = zparams['start']
-    z_index = 0
+def take_zstack(m, image_dir, time_step, zparams, led, gain, index, img_format, writer, layout = 'planes', live_merger = None, average = 1, device_name = '', positions = None, change_detector = None, projections = (), corrector = None):
+    '''Shoot a z-stack of photos with the Miniscope. The images are saved in the background by the ImageWriter 'writer',
+    either as one image per plane ('planes' layout) or as one multi-page TIFF per timestep ('stack' layout).
+    Each photo is the mean of 'average' consecutive frames, corrected by the FlatFieldCorrector 'corrector' if given. Every photo, failed or not, is added to the ImageIndex 'index'
+    for the device 'device_name', and the good images of earlier attempts at 'time_step' are marked as failed.
+    The z-stack covers the 'zparams' range, or only the focus 'positions' on its grid, e.g. the focus band of an
+    adaptive z-stack. Planes are numbered by their place in the 'zparams' range either way.
+    The 'projections' of the z-stack (see mscopeproject.Projector) are built plane by plane as they are shot, and
+    saved like a z-level of their own with the z-index PROJECTION_Z_INDEX, if the z-stack succeeds.
+    If the z-stack succeeds, its frames are also passed on to 'live_merger' and the ChangeDetector 'change_detector'.'''
+    if positions is None:
+        positions = range(zparams['start'], zparams['end'] + 1, zparams['step'])
+    # an earlier attempt at this timestep is overwritten, and with the 'stack' layout or adaptive z-stacks
+    # its rows would point at pages and files that hold other planes, or none at all
+    index.supersede(time_step, device_name)
+    # a resumed time lapse compares the good planes of the timestep with this
+    index.set_plan(time_step, len(positions), device_name)
+    stack = [] # frames for the 'stack' layout, written when the z-stack is done
+    captured = [] # (z_dir, path, page, frame) for the live merger
+    planes = [] # (z_index, sharpness, frame) for the change detector
+    projector = Projector(projections) if len(projections) > 0 else None
+    stack_path = generate_stack_path(image_dir, time_step, led, gain) if layout == 'stack' else None
+    status = True
+
+    for current_focus in positions:
+        z_index = (current_focus - zparams['start']) // zparams['step']
 
-    logger.info('Warming up Miniscope')
-    if not warm_up_miniscope(m): # failed to start grabbing frames with signal
-        logger.warning('Failed to detect frames with signal. You may want to check the sample and excitation.')
-        return False
-    
-    while current_focus <= zparams['end']:
         # update focus
-        set_focus(m, current_focus)
+        with span('focus', z = current_focus):
+            settled_seq = set_focus(m, current_focus)
 
         # remember metadata
-        this_file_path = generate_file_path(image_dir, time_step, z_index, current_focus, led, gain, img_format)
-        frame_start_time = get_date_sec()
+        z_str = z_int_to_string(z_index, current_focus)
+        if layout == 'stack':
+            this_file_path = stack_path
+            page = len(stack)
+        else:
+            this_file_path = generate_file_path(image_dir, time_step, z_index, current_focus, led, gain, img_format)
+            page = 0
+        frame_start_time = time.time()
 
         # try to take a photo
-        frame = take_photo(m)
-
-        if frame is None: # disconnected during z-stack
+        with span('photo', z = current_focus, average = average):
+            if average > 1:
+                photo = take_averaged_photo(m, settled_seq, average)
+                frame = None if photo is None else photo.mean
+            else:
+                photo = take_photo(m, settled_seq)
+                frame = None if photo is None else photo.frame
+        if corrector is not None and frame is not None:
+            with span('correct', z = current_focus):
+                frame = corrector.correct(frame, gain, led)
+        get_tracer().miniscope_counters(m)
+        counter('image_writer', queue = writer.queue_depth)
+
+        if photo is None: # disconnected during z-stack
             logger.warning('Failed to take photo!')
-            index_file.write(z_int_to_string(z_index, current_focus) + ',' + this_file_path + ',' + 'FAILED' + '\n')
-            return False
-        elif (not np.any(frame)): # got a blank photo
+            index.add(time_step, z_index, z_str, current_focus, this_file_path, page, STATUS_FAILED, led, gain, frame_start_time, device = device_name)
+            status = False
+            break
+        elif photo.stats.blank: # got a blank photo
             logger.warning('Took a blank photo!')
-            index_file.write(z_int_to_string(z_index, current_focus) + ',' + this_file_path + ',' + 'BLANK' + '\n')
-            return False
+            index.add(time_step, z_index, z_str, current_focus, this_file_path, page, STATUS_BLANK, led, gain, frame_start_time, photo.stats, device_name)
+            status = False
+            break
+        elif layout == 'stack':
+            captured.append((z_str, this_file_path, page, frame))
+            planes.append((z_index, photo.stats.sharpness, frame))
+            if projector is not None:
+                with span('project', z = current_focus):
+                    projector.add(frame)
+            stack.append(frame)
+            index.add(time_step, z_index, z_str, current_focus, this_file_path, page, STATUS_OK, led, gain, frame_start_time, photo.stats, device_name)
         else: # success
-            cv2.imwrite(this_file_path, frame) # write the image itself
-            index_file.write(z_int_to_string(z_index, current_focus) + ',' + this_file_path + ',' + frame_start_time + '\n')
-            
             # on first timestep, add image to z-level selecting folder
+            links = []
             if time_step == 0:
                 if not os.path.exists(os.path.join(image_dir, 'zselect')):
                     os.makedirs(os.path.join(image_dir, 'zselect'))
-                cv2.imwrite(generate_file_path(image_dir, time_step, z_index, current_focus, led, gain, img_format, zselect = True), frame)
-
-
-        current_focus += zparams['step']
-        z_index += 1
-
-    return True
-        
-def shoot_timelapse(image_dir, zparams, excitation_strength, gain, total_timesteps, period_sec, index_file, img_format):
-    '''Shoot a timelapse, which will be a set of folders for each z-level, full of image files at each time point.'''
+                links.append(generate_file_path(image_dir, time_step, z_index, current_focus, led, gain, img_format, zselect = True))
+
+            captured.append((z_str, this_file_path, page, frame))
+            planes.append((z_index, photo.stats.sharpness, frame))
+            if projector is not None:
+                with span('project', z = current_focus):
+                    projector.add(frame)
+            with span('queue_write'):
+                writer.write(this_file_path, frame, links) # write the image itself, off the capture loop
+            index.add(time_step, z_index, z_str, current_focus, this_file_path, page, STATUS_OK, led, gain, frame_start_time, photo.stats, device_name)
+
+    # the planes of a failed z-stack are kept until it is retaken, like in the 'planes' layout
+    if len(stack) > 0:
+        links = []
+        if time_step == 0:
+            if not os.path.exists(os.path.join(image_dir, 'zselect')):
+                os.makedirs(os.path.join(image_dir, 'zselect'))
+            links.append(generate_stack_path(image_dir, time_step, led, gain, zselect = True))
+        with span('queue_write'):
+            writer.write_stack(stack_path, stack, links)
+
+    if status and projector is not None:
+        for name, image in projector.result().items():
+            projection_path = generate_projection_path(image_dir, time_step, name, led, gain, img_format)
+            captured.append((name, projection_path, 0, image))
+            with span('queue_write'):
+                writer.write(projection_path, image)
+            index.add(time_step, PROJECTION_Z_INDEX, name, positions[0], projection_path, 0, STATUS_OK, led, gain, time.time(), device = device_name)
+
+    # frames of a failed z-stack are left to the final merge, the retake overwrites their files
+    if status and live_merger is not None:
+        with span('live_merge'):
+            live_merger.add_stack(captured)
+    if status and change_detector is not None:
+        with span('change_detect'):
+            change_detector.add_stack(planes)
+
+    return status
+
+def sweep_focus(m, tracker):
+    '''Find the focus band of an adaptive z-stack with single photos at the sweep positions of the FocusTracker 'tracker',
+    sweeping the whole range again if a tracking sweep lost the band. Returns the focus positions of the z-stack,
+    or None if the Miniscope failed to deliver a photo.'''
+    while True:
+        positions = tracker.sweep_positions()
+        scores = []
+        for focus in positions:
+            with span('sweep_photo', z = focus):
+                photo = take_photo(m, set_focus(m, focus))
+            if photo is None or photo.stats.blank:
+                logger.warning('Failed to take a photo for the focus sweep!')
+                return None
+            scores.append(focus_score(photo.stats))
+        if tracker.update(positions, scores):
+            return tracker.fine_positions()
+
+def connect_miniscope(scope_factory, gain, blank_threshold = 0, device_type = MINISCOPE_NAME, daq_id = DAQ_ID):
+    '''Create a new Miniscope instance with 'scope_factory', connect it to the DAQ box 'daq_id' as 'device_type',
+    start it running and set the gain. Frames without a pixel above 'blank_threshold' are treated as blank.'''
+    logger.info("Connecting to Miniscope")
+    with span('connect', daq_id = daq_id):
+        mscope = scope_factory() # create new Miniscope instance
+        mscope.blank_threshold = blank_threshold
+        setup_miniscope(mscope, device_type, daq_id) # run some diagnostics and start it running
+        set_gain(mscope, gain)
+    return mscope
+
+def disconnect_miniscope(mscope, led_on = True):
+    '''Turn off the LED and disconnect from the Miniscope. Without 'led_on', the LED is known to be off already
+    and is left alone, e.g. between the z-stacks of a persistent connection.'''
+    with span('disconnect'):
+        if led_on:
+            # waits until the frames show the LED off, so it is off before the connection goes
+            set_led(mscope, 0)
+        mscope.stop()
+        mscope.disconnect()
+
+def zstack_to_zparams(zstack):
+    '''Convert the [start, end, step] of the --zstack option to the 'zparams' dictionary of take_zstack.'''
+    return {'start': zstack[0], 'end': zstack[1], 'step': zstack[2]}
+
+def count_planes(zparams):
+    '''Number of z-levels in a z-stack with the 'start', 'end' and 'step' of 'zparams'.'''
+    return len(range(zparams['start'], zparams['end'] + 1, zparams['step']))
+
+def shoot_timelapse(image_dir, zparams, excitation_strength, gain, total_timesteps, period_sec, index, img_format, scope_factory = Miniscope, persistent = False, writer = None, layout = 'planes', live_merger = None, blank_threshold = 0, average = 1, first_timestep = 0, start_time = None, overrun = POLICY_SKIP, \
+                    device_name = '', device_type = MINISCOPE_NAME, daq_id = DAQ_ID, coordinator = None, adaptive = False, coarse_step = None, \
+                    period_range = None, change_thresholds = (DEFAULT_LOW_CHANGE, DEFAULT_HIGH_CHANGE), projections = (), \
+                    correct = None, flat = None):
+    '''Shoot a timelapse, which will be a set of folders for each z-level, full of image files at each time point.
+    'scope_factory' creates the Miniscope instance for each connection, e.g. SimulatedMiniscope for hardware-free runs.
+    With 'persistent', the connection stays open between z-stacks and is only re-established after a failed z-stack.
+    Every image is recorded in the ImageIndex 'index'.
+    Images are saved by the ImageWriter 'writer'. If none is given, one is created and closed at the end.
+    'layout' selects between one image file per plane ('planes') and one multi-page TIFF per timestep ('stack').
+    With a LiveMerger 'live_merger', the z-level videos are encoded while shooting and finished at the end.
+    Photos without a pixel above 'blank_threshold' count as blank and fail the z-stack.
+    Every photo is the mean of 'average' frames.
+    Z-stack k starts 'period_sec' * k seconds after the first one, with the 'overrun' policy of mscopeschedule
+    deciding what happens when a z-stack takes longer than the period.
+    To resume an interrupted time lapse, pass the timestep to continue with as 'first_timestep' and the start time
+    of the original run (seconds since the epoch) as 'start_time'; the first z-stack then waits for the next slot
+    of the original schedule.
+    'device_type' and 'daq_id' select the Miniscope, and 'device_name' identifies it in the index. In a multi-device
+    time lapse, the DeviceCoordinator 'coordinator' shares the USB bus with the other devices.
+    With 'adaptive', every z-stack starts with a sweep every 'coarse_step' to find the planes in focus, and only
+    those are shot at the z-stack step (see mscopefocus.FocusTracker).
+    With a 'period_range' (minimum, maximum), the period adapts to how much the sample changed between z-stacks,
+    with the low and high 'change_thresholds' (see mscopechange.ChangeDetector), starting at 'period_sec'.
+    The 'projections' ('mip', 'edf') of every z-stack are saved as an image per timestep (see take_zstack).
+    With 'correct', every plane is dark frame and flat-field corrected (see mscopecorrect.FlatFieldCorrector), with
+    references captured once for the time lapse ('run') or after every new connection ('connection'). 'flat' is
+    an optional measured flat-field image to use instead of the one estimated from the z-stack.'''
 
     logger.info("Starting time lapse recording.")
     logger.info("Total timesteps = " + str(total_timesteps))
     logger.info("Period (sec) = " + str(period_sec))
     logger.info("Z-Stack settings = " + str(zparams))
-
-    timestep = 0
+    logger.info("Persistent connection = " + str(persistent))
+    logger.info("Output layout = " + layout)
+    logger.info("Frames averaged per photo = " + str(average))
+    logger.info("Overrun policy = " + overrun)
+    if adaptive:
+        logger.info("Adaptive z-stack, coarse step = " + str(coarse_step))
+    if correct is not None:
+        logger.info("Dark and flat-field correction, references per " + correct)
+    if len(projections) > 0:
+        logger.info("Projections = " + ', '.join(projections))
+    if period_range is not None:
+        logger.info("Adaptive period (sec) = " + str(period_range[0]) + " to " + str(period_range[1]))
+    if device_name != '':
+        logger.info("Device = " + device_name + " (" + device_type + ", DAQ " + str(daq_id) + ")")
+    if first_timestep > 0:
+        logger.info("Resuming at timestep " + str(first_timestep))
+
+    timestep = first_timestep
     attempts = 0
     max_attempts = 3 # number of times we allow a z-stack to fail before aborting
+    mscope = None
+    led_on = False
+    own_writer = writer is None
+    if own_writer:
+        writer = ImageWriter()
+    schedule = Schedule(period_sec, overrun, start_time, first_timestep)
+    tracker = None
+    if adaptive:
+        tracker = FocusTracker(zparams, coarse_step if coarse_step is not None else DEFAULT_COARSE_STEPS * zparams['step'])
+    corrector = None
+    if correct is not None:
+        corrector = FlatFieldCorrector(os.path.join(image_dir, REFERENCE_DIRNAME), flat)
+    change_detector = None
+    if period_range is not None:
+        change_detector = ChangeDetector(period_sec, period_range[0], period_range[1], change_thresholds[0], change_thresholds[1])
+    connect_lock = coordinator.connecting if coordinator is not None else contextlib.nullcontext
+    usb_slot = coordinator.usb_slot if coordinator is not None else contextlib.nullcontext
+    # holds the USB slot of a multi-device time lapse for as long as the connection is open
+    connection = contextlib.ExitStack()
 
     # time lapse loop
-    while timestep < total_timesteps:
-        # connect to the miniscope and set proper control levels
-        logger.info("Connecting to Miniscope")
-        try:
-            mscope = Miniscope() # create new Miniscope instance
-            setup_miniscope(mscope, MINISCOPE_NAME, DAQ_ID) # run some diagnostics and start it running
-            set_gain(mscope, gain)
+    try:
+        while timestep < total_timesteps:
+            if attempts == 0:
+                # retries of a failed z-stack start right away, only new timesteps wait for their slot
+                # a resumed time lapse never tries to catch up with the slots it missed while it was down
+                with span('schedule_wait', timestep = timestep):
+                    schedule.wait(POLICY_SKIP if timestep == first_timestep and start_time is not None else None)
+
+            # connect to the miniscope and set proper control levels
+            fresh_connection = mscope is None
+            if fresh_connection:
+                # other devices of a multi-device time lapse may have to close their connection first
+                connection.enter_context(usb_slot())
+                with connect_lock():
+                    mscope = connect_miniscope(scope_factory, gain, blank_threshold, device_type, daq_id)
+                if corrector is not None and correct != CORRECT_RUN:
+                    corrector.clear()
+            # count the LED as on before setting it, so it is turned off again if setting it fails
+            led_on = True
             set_led(mscope, excitation_strength)
 
-            # take a z-stack at the current state
-            logger.info("Taking z-stack " + str(timestep))
-            status = take_zstack(mscope, image_dir, timestep, zparams, excitation_strength, gain, index_file, img_format)
+            if fresh_connection:
+                logger.info('Warming up Miniscope')
+                with span('warm_up'):
+                    signal = warm_up_miniscope(mscope)
+            else:
+                logger.info('Checking for signal')
+                with span('detect_signal'):
+                    signal = detect_signal(mscope)
+
+            references = True
+            if signal and corrector is not None and not corrector.has(gain, excitation_strength, load = correct == CORRECT_RUN):
+                with span('capture_references'):
+                    references = corrector.capture(mscope, gain, excitation_strength, zparams)
+
+            if not signal: # failed to start grabbing frames with signal
+                logger.warning('Failed to detect frames with signal. You may want to check the sample and excitation.')
+                status = False
+            elif not references:
+                logger.warning('Failed to capture the dark and flat references!')
+                status = False
+            else:
+                # take a z-stack at the current state
+                logger.info("Taking z-stack " + str(timestep))
+                with span('zstack', timestep = timestep, attempt = attempts + 1):
+                    positions = None
+                    if tracker is not None:
+                        with span('focus_sweep'):
+                            positions = sweep_focus(mscope, tracker)
+                    if tracker is not None and positions is None:
+                        status = False
+                    else:
+                        status = take_zstack(mscope, image_dir, timestep, zparams, excitation_strength, gain, index, img_format, writer, layout, live_merger, average, device_name, positions, change_detector, projections, corrector)
             attempts += 1
 
+            if persistent and status:
+                # keep the connection, only turn off the excitation between z-stacks
+                set_led(mscope, 0)
+            else:
+                # turn off and disconnect from the miniscope, reconnecting is also our way to recover from failures
+                disconnect_miniscope(mscope)
+                mscope = None
+                connection.close()
+            led_on = False
+
+            if status: # successful z-stack
+                timestep += 1
+                attempts = 0
+                if change_detector is not None:
+                    schedule.set_period(change_detector.period_sec)
+                    counter('period', period_sec = change_detector.period_sec)
+                    if change_detector.last_change is not None:
+                        counter('change', change = change_detector.last_change)
+            elif attempts >= max_attempts:
+                logger.error('Z-stack failed on attempt ' + str(attempts) + ' (final attempt). Check the Miniscope connection.')
+                instant('abort', timestep = timestep, attempt = attempts)
+                break
+            else:
+                logger.warning('Z-stack failed on attempt ' + str(attempts) + '. Trying again.')            
+                instant('retry', timestep = timestep, attempt = attempts)
+
+    finally:
+        # these resource-closing commands should run no matter what happens
+        try:
+            if mscope is not None:
+                disconnect_miniscope(mscope, led_on)
         finally:
-            # turn off and disconnect from the miniscope
-            set_led(mscope, 0)
-            time.sleep(1)
-            mscope.stop()
-            mscope.disconnect()
-
-        if status: # successful z-stack
-            timestep += 1
-            attempts = 0
-            if timestep < total_timesteps:
-                logger.info("Waiting " + str(period_sec) + " seconds to take next z-stack")
-                time.sleep(period_sec)
-        elif attempts >= max_attempts:
-            logger.error('Z-stack failed on attempt ' + str(attempts) + ' (final attempt). Check the Miniscope connection.')
-            break
-        else:
-            logger.warning('Z-stack failed on attempt ' + str(attempts) + '. Trying again.')            
+            # the other devices must get the USB slot even if disconnecting failed
+            connection.close()
+        # make sure all images are on disk before anything tries to read them
+        with span('flush_writer'):
+            if own_writer:
+                writer.close()
+            else:
+                writer.flush()
+        if own_writer:
+            writer.log_stats()
+        schedule.log_stats()
+        if live_merger is not None:
+            with span('finish_live_merge'):
+                live_merger.finish()
 
     logger.info("Time lapse recording finished.")
 
-def read_image_index(img_dir):
-    '''read an index file of frame paths into a dictionary for merge function'''
-    infile = open(os.path.join(img_dir, 'image_filename_index.csv'), 'r')
-    img_fn_dict = {}
-    for line in infile:
-        splitline = line.strip().split(',')
-        z_dir = splitline[0]
-        img_path = splitline[1]
-        if z_dir not in img_fn_dict.keys():
-            img_fn_dict[z_dir] = [img_path]
-        else:
-            img_fn_dict[z_dir].append(img_path)
-    # for each dict entry: key = z-level string, value = list of paths to all frames at that z-level
-    return img_fn_dict
-
-def merge_timelapse(ffmpeg_path, img_dir, img_fn_dict, img_format):
-    '''Use ffmpeg to merge the miniscope images into a single video for each z-level'''
-
-    for z_dir in img_fn_dict.keys():
-        # remember parameters at this z-level for video filename
-        suffixlist = [z_dir]
-        # slice up first filename to get led and gain information
-        filename0 = img_fn_dict[z_dir][0]
-        suffixlist.extend(os.path.basename(filename0).split('.')[0].split('_')[-2:])
-        suffix = '_'.join(suffixlist)
-
-        merged_video_name = 'miniscope_timelapse_' + suffix + '.mp4'
-        merged_video_path = os.path.join(img_dir, z_dir, merged_video_name)
-        subprocess.call([ffmpeg_path, \
-                        '-framerate', '5', \
-                        '-pattern_type', 'glob', \
-                        '-i', img_dir + '/' + z_dir + '/*.' + img_format, \
-                        '-hide_banner', '-loglevel', 'error', \
-                        '-y', \
-                        '-s:v', '680x680', \
-                        '-c:v', 'libx264', \
-                        '-crf', '17', \
-                        '-pix_fmt', 'yuv420p', \
-                        merged_video_path])
-        
+def run_device(kwargs):
+    '''Thread function of a device in a multi-device time lapse, so a failing device does not take the others down.'''
+    try:
+        shoot_timelapse(**kwargs)
+    except BaseException as e:
+        logger.exception('Time lapse of device ' + kwargs['device_name'] + ' failed: ' + str(e))
+
+def shoot_multi_timelapse(image_dir, device_config, first_timesteps = {}, start_time = None, live_mergers = {}, **kwargs):
+    '''Shoot a time lapse with every Miniscope of 'device_config' (see mscopedevices.load_devices) at the same time,
+    each in its own thread and its own output directory below 'image_dir'. The devices share one ImageWriter, the image
+    index, and a DeviceCoordinator for the USB bus. With a 'stagger' in the configuration, the schedule of device i
+    starts i * stagger seconds after the first one, otherwise all devices shoot on the same schedule.
+    'first_timesteps' and 'live_mergers' map device names to the timestep to resume at and to their LiveMerger.
+    The other arguments are passed on to shoot_timelapse.'''
+    devices = device_config['devices']
+    logger.info("Starting multi-device time lapse with " + ', '.join(dev['name'] for dev in devices))
+    logger.info("Schedule stagger (sec) = " + str(device_config['stagger']) + ", USB slots = " + str(device_config['usb_slots']))
+
+    coordinator = DeviceCoordinator(device_config['usb_slots'])
+    if start_time is None:
+        start_time = time.time()
+
+    threads = []
+    writer = ImageWriter(num_workers = max(2, len(devices)))
+    try:
+        for i, dev in enumerate(devices):
+            dev_kwargs = dict(kwargs, \
+                              image_dir = os.path.join(image_dir, dev['name']), \
+                              zparams = zstack_to_zparams(dev['zstack']), \
+                              excitation_strength = dev['excitation'], \
+                              gain = dev['gain'], \
+                              writer = writer, \
+                              live_merger = live_mergers.get(dev['name']), \
+                              first_timestep = first_timesteps.get(dev['name'], 0), \
+                              start_time = start_time + i * device_config['stagger'], \
+                              device_name = dev['name'], \
+                              device_type = dev['device_type'], \
+                              daq_id = dev['daq_id'], \
+                              coordinator = coordinator)
+            t = threading.Thread(target = run_device, name = dev['name'], args = (dev_kwargs,))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+    finally:
+        writer.close()
+        writer.log_stats()
+
+    logger.info("Multi-device time lapse recording finished.")
+
 def setup_parser(p):
     '''Set up argument parser object and return parsed args'''
 
@@ -272,8 +609,60 @@ def setup_parser(p):
     help_g = '''Gain applied to output images.'''
     help_z = '''Z-stack start, end, and step for each timepoint.'''
     help_t = '''Number of time steps to record in the time lapse.'''
-    help_p = '''Period between time lapse snapshots, in seconds.'''
-    help_f = '''Format to save time lapse images in.'''
+    help_p = '''Period between time lapse snapshots, in seconds. Snapshots start on a fixed grid, 
+                independent of how long each z-stack takes.'''
+    help_o = '''What to do when a z-stack takes longer than the period. 'skip' drops the slots 
+                that already passed and waits for the next one, 'compress' takes the late 
+                z-stacks right away until the schedule has caught up.'''
+    help_adaptive = '''Only shoot the planes that are in focus. Each z-stack starts with a sweep of single 
+                photos every --coarse-step to find the focus band, which is then shot at the step 
+                of --zstack. Later z-stacks track the band as the sample drifts.'''
+    help_coarse = '''Focus step of the sweep of adaptive z-stacks, a multiple of the z-stack step. 
+                By default 4 z-stack steps.'''
+    help_period_range = '''Adapt the period to the sample, between MIN and MAX seconds. The period drops to 
+                MIN when a z-stack differs a lot from the previous one, and grows towards MAX while 
+                the sample stays the same. Starts at --period.'''
+    help_change = '''Change between z-stacks (mean absolute difference of the downsampled, brightness 
+                normalized in-focus planes) below which the adaptive period grows, and above which 
+                it drops to the minimum.'''
+    help_projections = '''Projections of every z-stack to save as one image per timestep, each in its own 
+                directory and video: 'mip' (maximum intensity) and 'edf' (extended depth of field, 
+                each pixel from the planes it is in focus on).'''
+    help_correct = '''Correct the dark offset and vignetting of every saved plane. Dark frames (LED off) 
+                and a flat reference are captured once for the time lapse ('run') or after every 
+                new connection ('connection').'''
+    help_flat = '''Measured flat-field image (e.g. of a uniform fluorescent slide) to correct with, 
+                instead of the flat reference estimated from the ends of the z-stack.'''
+    help_f = '''Format to save time lapse images in. Only used by the 'planes' layout.'''
+    help_l = '''Output layout. 'planes' saves one image per z-level and timestep in a directory 
+                per z-level, 'stack' saves the z-stack of each timestep as one LZW compressed 
+                multi-page TIFF in the 'stacks' directory.'''
+    help_c = '''Keep the connection to the Miniscope open between z-stacks, and only toggle the 
+                LED. The Miniscope is only reconnected if a z-stack fails.'''
+    help_s = '''Use a simulated Miniscope instead of the DAQ box, for testing and benchmarking 
+                without hardware attached.'''
+    help_w = '''Number of z-level videos to encode in parallel when merging.'''
+    help_fps = '''Frame rate of the merged videos.'''
+    help_size = '''Frame size of the merged videos as WIDTHxHEIGHT, or 'source' to keep the image size.'''
+    help_codec = '''ffmpeg video codec for the merged videos.'''
+    help_crf = '''Constant rate factor (quality) for the merged videos, lower is better.'''
+    help_live = '''Encode the z-level videos while the time lapse is shooting, so they are ready 
+                right after the last z-stack.'''
+    help_a = '''Number of consecutive frames to average into each photo, to reduce noise. 
+                The frames are accumulated by libminiscope as they arrive.'''
+    help_b = '''Photos without a pixel brighter than this value count as blank, and the z-stack 
+                is retaken. The default of 0 only rejects completely black photos.'''
+    help_r = '''Re-encode all z-level videos when merging, even if they are up to date.'''
+    help_register = '''Correct the lateral drift of the sample when merging. The shift of every timestep is 
+                measured on a reference z-level and the frames are aligned as they are encoded, 
+                the images themselves are not changed.'''
+    help_register_plane = '''Z-level directory (e.g. z12-0) to measure the drift on. By default the EDF 
+                projection if there is one, otherwise the sharpest z-level.'''
+    help_resume = '''Resume the interrupted time lapse in directory RESUME. The settings of the original 
+                run are used, the last incomplete z-stack is shot again, and the schedule continues 
+                on the wall-clock grid of the original run.'''
+    help_devices = '''JSON file describing several Miniscopes to record at the same time, each with its 
+                own DAQ ID, z-stack, excitation and gain. See the README for the format.'''
     help_m = '''Merge mode does not film a new time lapse, but merges a previously shot 
                 set of images into videos at each z-level. You must provide a directory 
                 with a previous time lapse stored in it.'''
@@ -284,8 +673,32 @@ def setup_parser(p):
     p.add_argument('-z', '--zstack', type = int, choices = range(-120, 121), metavar = '[-120 - 120]', nargs = 3, default = [-120, 120, 10], help = help_z)
     p.add_argument('-t', '--timesteps', type = int, default = 24, help = help_t)
     p.add_argument('-p', '--period', type = int, default = 3600, help = help_p)
+    p.add_argument('-o', '--overrun', type = str, choices = OVERRUN_POLICIES, default = POLICY_SKIP, help = help_o)
+    p.add_argument('--adaptive', action = 'store_true', default = False, help = help_adaptive)
+    p.add_argument('--coarse-step', type = int, default = None, help = help_coarse)
+    p.add_argument('--period-range', type = int, nargs = 2, metavar = ('MIN', 'MAX'), default = None, help = help_period_range)
+    p.add_argument('--change-thresholds', type = float, nargs = 2, metavar = ('LOW', 'HIGH'), default = [DEFAULT_LOW_CHANGE, DEFAULT_HIGH_CHANGE], help = help_change)
+    p.add_argument('--projections', type = str, nargs = '+', choices = PROJECTIONS, default = [], help = help_projections)
+    p.add_argument('--correct', type = str, choices = CORRECT_MODES, default = None, help = help_correct)
+    p.add_argument('--flat', type = str, default = None, help = help_flat)
     p.add_argument('-f', '--imgformat', type = str, choices = ['png', 'jpg', 'tiff'], default = 'png', help = help_f)
+    p.add_argument('-l', '--layout', type = str, choices = ['planes', 'stack'], default = 'planes', help = help_l)
+    p.add_argument('-a', '--average', type = int, default = 1, help = help_a)
+    p.add_argument('-b', '--blank-threshold', type = int, choices = range(0, 256), metavar = '[0-255]', default = 0, help = help_b)
     p.add_argument('-m', '--merge', action = 'store_true', default = False, help = help_m)
+    p.add_argument('-w', '--workers', type = int, default = DEFAULT_WORKERS, help = help_w)
+    p.add_argument('--fps', type = float, default = DEFAULT_FPS, help = help_fps)
+    p.add_argument('--size', type = str, default = DEFAULT_SIZE, help = help_size)
+    p.add_argument('--codec', type = str, default = DEFAULT_CODEC, help = help_codec)
+    p.add_argument('--crf', type = int, default = DEFAULT_CRF, help = help_crf)
+    p.add_argument('--live', action = 'store_true', default = False, help = help_live)
+    p.add_argument('--devices', type = str, default = None, help = help_devices)
+    p.add_argument('--resume', type = str, default = None, help = help_resume)
+    p.add_argument('-r', '--rebuild', action = 'store_true', default = False, help = help_r)
+    p.add_argument('--register', action = 'store_true', default = False, help = help_register)
+    p.add_argument('--register-plane', type = str, default = None, help = help_register_plane)
+    p.add_argument('-c', '--persistent', action = 'store_true', default = False, help = help_c)
+    p.add_argument('-s', '--simulate', action = 'store_true', default = False, help = help_s)
 
 def setup_logger(base_dir):
     '''Set up root logger config to write to stdout and a log file'''
@@ -298,7 +711,7 @@ def setup_logger(base_dir):
 
     # set format
     fmt = logging.Formatter(
-    "%(name)s: %(asctime)s | %(levelname)s | %(filename)s:%(lineno)s | %(process)d >>> %(message)s"
+    "%(name)s: %(asctime)s | %(levelname)s | %(filename)s:%(lineno)s | %(process)d %(threadName)s >>> %(message)s"
     )
     stdoutHandler.setFormatter(fmt)
     logfileHandler.setFormatter(fmt)
@@ -314,13 +727,21 @@ def main():
     setup_parser(parser)
     args = parser.parse_args()
 
-    # prep base image directory 
-    if args.directory[-1] == '/':
-        args.directory = args.directory[:-1]
-    date_sec = get_date_sec()
-    head, tail = os.path.split(args.directory)
-    image_dir_now = head + '/' + str(date_sec) + '_' + tail
-    os.makedirs(image_dir_now)
+    if args.resume is not None:
+        # continue in the directory of the interrupted time lapse
+        if args.merge:
+            parser.error('--resume can not be combined with merge mode.')
+        image_dir_now = args.resume.rstrip('/')
+        if not os.path.exists(os.path.join(image_dir_now, INDEX_FILENAME)):
+            parser.error('--resume requires a directory with an ' + INDEX_FILENAME + ' image index.')
+    else:
+        # prep base image directory 
+        if args.directory[-1] == '/':
+            args.directory = args.directory[:-1]
+        date_sec = get_date_sec()
+        head, tail = os.path.split(args.directory)
+        image_dir_now = head + '/' + str(date_sec) + '_' + tail
+        os.makedirs(image_dir_now)
 
     # set up logger
     setup_logger(image_dir_now)
@@ -329,23 +750,145 @@ def main():
     # if args.mode == 'merge' and args.directory == BASE_IMAGE_DIRNAME:
         parser.error('merge mode requires a previously filmed image directory passed to -d.')
 
+    args.device_config = None
+    if args.devices is not None and args.resume is None:
+        defaults = {'device_type': MINISCOPE_NAME, 'daq_id': DAQ_ID, 'zstack': args.zstack, 'excitation': args.excitation, 'gain': args.gain}
+        try:
+            args.device_config = load_devices(args.devices, defaults)
+        except (OSError, ValueError) as e:
+            parser.error('invalid device configuration ' + args.devices + ': ' + str(e))
+
+    index = None
+    first_timestep = 0
+    first_timesteps = {}
+    start_time = None
+    if args.resume is not None:
+        index = ImageIndex(os.path.join(image_dir_now, INDEX_FILENAME))
+        run = index.first_run()
+        if run is None:
+            parser.error('the image index in ' + image_dir_now + ' has no run settings to resume from.')
+        start_time, settings = run
+        for key in RUN_SETTINGS:
+            if key in settings:
+                setattr(args, key, settings[key])
+        first_timestep = index.last_complete_timestep(count_planes(zstack_to_zparams(args.zstack))) + 1
+        if args.device_config is not None:
+            for dev in args.device_config['devices']:
+                first_timesteps[dev['name']] = index.last_complete_timestep(count_planes(zstack_to_zparams(dev['zstack'])), dev['name']) + 1
+        logger.info('Resuming time lapse in ' + image_dir_now + ' with the original settings: ' + str(settings))
+        if args.live:
+            # a live encoder would start the videos over, the final merge appends the new timesteps instead
+            logger.warning('Live encoding is not available when resuming, the videos are merged at the end.')
+            args.live = False
+
+    if args.adaptive and args.coarse_step is not None and (args.coarse_step <= 0 or args.coarse_step % args.zstack[2] != 0):
+        parser.error('--coarse-step must be a multiple of the z-stack step (' + str(args.zstack[2]) + ').')
+    if args.device_config is not None and args.persistent and args.device_config['usb_slots'] < len(args.device_config['devices']):
+        parser.error('a persistent connection (-c) holds its USB slot until it is closed, the usb_slots of --devices must not be below the number of devices.')
+    if args.period_range is not None:
+        if not 0 < args.period_range[0] <= args.period <= args.period_range[1]:
+            parser.error('--period-range must be positive and include the period (' + str(args.period) + ').')
+        if args.change_thresholds[0] > args.change_thresholds[1]:
+            parser.error('the low change threshold must not be above the high one.')
+        if start_time is not None:
+            # the slots of the original run are not on a fixed grid, so the period starts over right away
+            logger.info('The adaptive period starts over at ' + str(args.period) + ' seconds.')
+            start_time = None
+
+    flat = None
+    if args.flat is not None:
+        if args.correct is None:
+            parser.error('--flat requires --correct.')
+        flat = cv2.imread(args.flat, cv2.IMREAD_GRAYSCALE)
+        if flat is None:
+            parser.error('could not read the flat-field image ' + args.flat)
+
     if args.merge == False: # film mode
     # if args.mode == 'film': # film mode
+        if args.simulate:
+            scope_factory = SimulatedMiniscope
+        elif Miniscope is None:
+            parser.error('the compiled miniscope module could not be imported, use -s to run with a simulated Miniscope.')
+        else:
+            scope_factory = Miniscope
+
+        live_merger = None
+        live_mergers = {}
+        if args.live:
+            live_dirs = {'': image_dir_now}
+            if args.device_config is not None:
+                live_dirs = {dev['name']: os.path.join(image_dir_now, dev['name']) for dev in args.device_config['devices']}
+            for name, live_dir in live_dirs.items():
+                live_mergers[name] = LiveMerger(FFMPEG_PATH, live_dir, \
+                                                fps = args.fps, \
+                                                size = None if args.size == 'source' else args.size, \
+                                                codec = args.codec, \
+                                                crf = args.crf)
+            live_merger = live_mergers.get('')
+
+        if index is None:
+            index = ImageIndex(os.path.join(image_dir_now, INDEX_FILENAME))
+        index.add_run({key: getattr(args, key) for key in RUN_SETTINGS}, first_timestep)
+        # record how long every phase of the time lapse takes, next to the log
+        tracer = Tracer(os.path.join(image_dir_now, TRACE_FILENAME))
+        set_tracer(tracer)
         try:
-            # run timelapse and save all images
-            index_file = open(os.path.join(image_dir_now, 'image_filename_index.csv'), 'w')
-            shoot_timelapse(image_dir = image_dir_now, \
-                            zparams = {'start': args.zstack[0], 'end': args.zstack[1], 'step': args.zstack[2]}, \
-                            excitation_strength = args.excitation, \
-                            gain = args.gain, \
-                            total_timesteps = args.timesteps, \
-                            period_sec = args.period, \
-                            index_file = index_file,
-                            img_format = args.imgformat)
+            if args.device_config is not None:
+                # run the timelapse of all devices at once
+                shoot_multi_timelapse(image_dir = image_dir_now, \
+                                      device_config = args.device_config, \
+                                      first_timesteps = first_timesteps, \
+                                      start_time = start_time, \
+                                      live_mergers = live_mergers, \
+                                      total_timesteps = args.timesteps, \
+                                      period_sec = args.period, \
+                                      index = index, \
+                                      img_format = args.imgformat, \
+                                      scope_factory = scope_factory, \
+                                      persistent = args.persistent, \
+                                      layout = args.layout, \
+                                      blank_threshold = args.blank_threshold, \
+                                      average = args.average, \
+                                      overrun = args.overrun, \
+                                      adaptive = args.adaptive, \
+                                      coarse_step = args.coarse_step, \
+                                      period_range = args.period_range, \
+                                      change_thresholds = args.change_thresholds, \
+                                      projections = args.projections, \
+                                      correct = args.correct, \
+                                      flat = flat)
+            else:
+                # run timelapse and save all images
+                shoot_timelapse(image_dir = image_dir_now, \
+                                zparams = zstack_to_zparams(args.zstack), \
+                                excitation_strength = args.excitation, \
+                                gain = args.gain, \
+                                total_timesteps = args.timesteps, \
+                                period_sec = args.period, \
+                                index = index, \
+                                img_format = args.imgformat, \
+                                scope_factory = scope_factory, \
+                                persistent = args.persistent, \
+                                layout = args.layout, \
+                                live_merger = live_merger, \
+                                blank_threshold = args.blank_threshold, \
+                                average = args.average, \
+                                first_timestep = first_timestep, \
+                                start_time = start_time, \
+                                overrun = args.overrun, \
+                                adaptive = args.adaptive, \
+                                coarse_step = args.coarse_step, \
+                                period_range = args.period_range, \
+                                change_thresholds = args.change_thresholds, \
+                                projections = args.projections, \
+                                correct = args.correct, \
+                                flat = flat)
                 
         finally: # these resource-closing commands should run no matter what happens
-            # close index file
-            index_file.close()
+            # close index database
+            index.close()
+            tracer.log_stats()
+            tracer.close()
 
         # tell the merge function where to find the image index file
         merge_dir = image_dir_now
@@ -355,8 +898,29 @@ def main():
     
     logger.info('Merging timelapse images in directory: ' + merge_dir)
 
+    # a multi-device time lapse has a directory with the z-levels of each device
+    devices = ['']
+    if os.path.exists(os.path.join(merge_dir, INDEX_FILENAME)):
+        with ImageIndex(os.path.join(merge_dir, INDEX_FILENAME)) as index:
+            devices = index.devices() or ['']
+
     # merge images into a time lapse video
-    merge_timelapse(FFMPEG_PATH, merge_dir, read_image_index(merge_dir), args.imgformat)
+    failed = []
+    for device in devices:
+        shifts = None
+        if args.register:
+            shifts = register_timelapse(merge_dir, device, args.register_plane)
+        failed += [os.path.join(device, z) for z in merge_timelapse(FFMPEG_PATH, os.path.join(merge_dir, device), read_image_index(merge_dir, device), \
+                                                                    workers = args.workers, \
+                                                                    fps = args.fps, \
+                                                                    size = None if args.size == 'source' else args.size, \
+                                                                    codec = args.codec, \
+                                                                    crf = args.crf, \
+                                                                    force = args.rebuild, \
+                                                                    shifts = shifts)]
+    if len(failed) > 0:
+        logger.error('Merge failed for z-levels: ' + ', '.join(failed))
+        sys.exit(1)
 
     logger.info('Merge complete!')
 